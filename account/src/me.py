@@ -86,4 +86,7 @@ async def set_privacy(request):
 			insert_stmt.on_duplicate_key_update(**request.privacy)
 		)
 
+	await service.send_strict(
+		"broadcast:privacy", "player", id=request.auth["user"]
+	)
 	await request.end()
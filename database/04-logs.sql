@@ -1,4 +1,5 @@
 CREATE TABLE `player_new` LIKE `player`;
+CREATE TABLE `player_old` LIKE `player`;
 
 CREATE TABLE `player_changelog` LIKE `player`;
 ALTER TABLE `player_changelog`
@@ -10,6 +11,7 @@ ALTER TABLE `player_changelog`
   ADD KEY (`id`);
 
 CREATE TABLE `tribe_new` LIKE `tribe`;
+CREATE TABLE `tribe_old` LIKE `tribe`;
 
 CREATE TABLE `tribe_active` (
   `id` bigint(20) NOT NULL DEFAULT '0',
@@ -36,7 +38,11 @@ ALTER TABLE `tribe_stats_changelog`
   ADD KEY (`log_date`),
   ADD KEY (`id`);
 
+-- Stats tribes had before the last run, used to calculate periods
+CREATE TABLE `tribe_stats_old` LIKE `tribe_stats`;
+
 CREATE TABLE `member_new` LIKE `member`;
+CREATE TABLE `member_old` LIKE `member`;
 
 CREATE TABLE `member_changelog` LIKE `member`;
 ALTER TABLE `member_changelog`
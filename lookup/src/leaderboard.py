@@ -0,0 +1,324 @@
+import json
+import asyncio
+import traceback
+import numpy as np
+
+from shared.models import roles, player, tribe, tribe_stats, periods, \
+	disqualified
+from shared.qualification import player_qualification_query, \
+	tribe_qualification_query
+
+from sqlalchemy import and_
+from sqlalchemy.sql import select
+
+from names import NameIndex, pack
+
+
+CHUNK = 5000  # rows read at once while loading
+
+
+class Leaderboard:
+	"""The ranked rows of a table, kept in memory as numpy columns along
+	with the order of the rows for every rankable field. Names are stored
+	back to back in a single buffer. Columns hold 0 where the database
+	has NULL, and nulls marks those rows, so they are still returned as
+	None and ranked last.
+	"""
+
+	def __init__(self, ids, names, columns, nulls, rankable):
+		self.total = len(ids)
+		self.ids = ids
+
+		# name i is names[offsets[i]:offsets[i + 1]]
+		self.names, self.offsets = pack(names)
+
+		self.columns = columns
+		self.nulls = {
+			column: mask
+			for column, mask in nulls.items()
+			if mask.any()
+		}
+
+		self.orders = {}
+		for field in rankable:
+			key = -self.columns[field].astype(np.int64)
+			if field in self.nulls:
+				key[self.nulls[field]] = np.iinfo(np.int64).max
+
+			# stable, so ties keep the order of the ids
+			self.orders[field] = np.argsort(key, kind="stable")
+
+	def name(self, idx):
+		return self.names[self.offsets[idx]:self.offsets[idx + 1]].decode()
+
+	def page(self, field, offset, limit, columns):
+		"""Returns the rows at [offset, offset + limit) when ordered by
+		field, as dicts with their id, name and the given columns.
+		"""
+		page = []
+		for idx in self.orders[field][offset:offset + limit].tolist():
+			row = {
+				"id": int(self.ids[idx]),
+				"name": self.name(idx),
+			}
+			for column in columns:
+				if column in self.nulls and self.nulls[column][idx]:
+					row[column] = None
+				else:
+					row[column] = int(self.columns[column][idx])
+			page.append(row)
+		return page
+
+
+async def read_chunks(result):
+	"""Yields the rows of a result CHUNK at a time, letting requests
+	through in between.
+	"""
+	while True:
+		rows = await result.fetchmany(CHUNK)
+		if not rows:
+			return
+		yield rows
+		await asyncio.sleep(0)
+
+
+def concat(chunks, dtype):
+	if not chunks:
+		return np.zeros(0, dtype=dtype)
+	return np.concatenate(chunks)
+
+
+async def read_board(result, columns):
+	"""Reads (id, name, *columns) rows into the arguments of a
+	Leaderboard, one chunk of numpy arrays at a time.
+	"""
+	ids, names = [], []
+	values = {column: [] for column in columns}
+	nulls = {column: [] for column in columns}
+
+	async for rows in read_chunks(result):
+		count = len(rows)
+		ids.append(np.fromiter(
+			(row[0] for row in rows), dtype=np.int64, count=count
+		))
+		names.extend((row[1] or "").encode() for row in rows)
+
+		for idx, column in enumerate(columns, start=2):
+			values[column].append(np.fromiter(
+				(row[idx] or 0 for row in rows), dtype=np.int32, count=count
+			))
+			nulls[column].append(np.fromiter(
+				(row[idx] is None for row in rows), dtype=bool, count=count
+			))
+
+	return (
+		concat(ids, np.int64),
+		names,
+		{column: concat(values[column], np.int32) for column in columns},
+		{column: concat(nulls[column], bool) for column in columns},
+	)
+
+
+async def read_names(result, ranked=True):
+	"""Reads (id, name[, rank]) rows into the arguments of a NameIndex"""
+	ids, names, ranks = [], [], []
+
+	async for rows in read_chunks(result):
+		count = len(rows)
+		ids.append(np.fromiter(
+			(row[0] for row in rows), dtype=np.int64, count=count
+		))
+		names.extend((row[1] or "").encode() for row in rows)
+		if ranked:
+			ranks.append(np.fromiter(
+				(row[2] or 0 for row in rows), dtype=np.int64, count=count
+			))
+
+	return (
+		concat(ids, np.int64),
+		names,
+		concat(ranks, np.int64) if ranked else None,
+	)
+
+
+def player_query(period, columns):
+	select_from = player
+	if period is not player:
+		select_from = select_from.join(period, period.c.id == player.c.id)
+
+	return (
+		select(
+			player.c.id,
+			player.c.name,
+			*(getattr(period.c, column) for column in columns),
+		)
+		.select_from(
+			select_from
+			.outerjoin(disqualified, disqualified.c.id == player.c.id)
+		)
+		.where(and_(
+			disqualified.c.id.is_(None),
+			player_qualification_query,
+		))
+		.order_by(player.c.id)
+	)
+
+
+def tribe_query(period, columns):
+	select_from = tribe.join(tribe_stats, tribe_stats.c.id == tribe.c.id)
+	if period is not tribe_stats:
+		select_from = select_from.join(period, period.c.id == tribe.c.id)
+
+	return (
+		select(
+			tribe.c.id,
+			tribe.c.name,
+			*(getattr(period.c, column) for column in columns),
+		)
+		.select_from(select_from)
+		.where(tribe_qualification_query)
+		.order_by(tribe.c.id)
+	)
+
+
+class Leaderboards:
+	"""Every leaderboard (player and tribe, for every period), the name
+	indices of players and tribes and the roles of the players, loaded
+	again after every update. Until the first load is done, get and
+	get_names return None. on_load is called every time they are
+	replaced.
+	"""
+
+	def __init__(self, columns, rankable, on_load=None):
+		self.columns = columns
+		self.rankable = rankable
+		self.on_load = on_load
+		self.boards = {}
+		self.names = {}
+		self.roles = {}  # id: {"cfm": bits, "tfm": bits}
+
+		self.loading = None
+		self.pending = False
+
+	def get(self, what, period):
+		return self.boards.get((what, period))
+
+	def get_names(self, what):
+		return self.names.get(what)
+
+	def get_roles(self, player_id):
+		bits = self.roles.get(player_id)
+		if bits is None:
+			return 0, 0
+		return bits["cfm"], bits["tfm"]
+
+	def reload(self, db, loop):
+		if self.loading is not None and not self.loading.done():
+			# the data changed while loading, so load it once more
+			self.pending = True
+			return
+		self.loading = loop.create_task(self.load_loop(db, loop))
+
+	async def load_loop(self, db, loop):
+		while True:
+			self.pending = False
+			try:
+				await self.load(db, loop)
+			except Exception:
+				traceback.print_exc()
+
+			if not self.pending:
+				break
+
+	async def load(self, db, loop):
+		"""Reads everything in chunks and builds the new leaderboards and
+		indices in a thread, so requests keep being served from the
+		current ones until they are swapped.
+		"""
+		boards = {}
+		names = {}
+		async with db.acquire() as conn:
+			result = await conn.execute(
+				select(roles.c.id, roles.c.cfm, roles.c.tfm)
+			)
+			role_bits = {}
+			async for rows in read_chunks(result):
+				for row in rows:
+					role_bits[row.id] = {"cfm": row.cfm or 0, "tfm": row.tfm or 0}
+
+			for what, make_query in (
+				("player", player_query),
+				("tribe", tribe_query),
+			):
+				for period_name, period in periods[what].items():
+					result = await conn.execute(
+						make_query(period, self.columns)
+					)
+					board = await read_board(result, self.columns)
+
+					boards[(what, period_name)] = await loop.run_in_executor(
+						None, Leaderboard, *board, self.rankable
+					)
+
+			result = await conn.execute(
+				select(player.c.id, player.c.name, player.c.round_played)
+			)
+			names["player"] = await loop.run_in_executor(
+				None, NameIndex, *await read_names(result)
+			)
+
+			result = await conn.execute(select(tribe.c.id, tribe.c.name))
+			names["tribe"] = await loop.run_in_executor(
+				None, NameIndex, *await read_names(result, ranked=False)
+			)
+
+		self.boards = boards
+		self.names = names
+		self.roles = role_bits
+		if self.on_load is not None:
+			self.on_load()
+
+	def update_roles(self, msg):
+		"""Applies a roles broadcast: the kind of roles and the new bits
+		of every player that changed.
+		"""
+		msg = json.loads(msg)
+		kind = msg["type"]
+		if kind not in ("cfm", "tfm"):
+			return
+
+		for key, bits in msg.items():
+			if not key.isdigit():
+				continue
+
+			player_id = int(key)
+			current = self.roles.setdefault(player_id, {"cfm": 0, "tfm": 0})
+			current[kind] = bits
+			if current["cfm"] == current["tfm"] == 0:
+				del self.roles[player_id]
+
+
+class Totals:
+	"""How many rows the leaderboards the database serves rank, by
+	(table, period, tribe). Each one is counted once per update.
+	"""
+
+	def __init__(self):
+		self.totals = {}
+		self.generation = 0
+
+	def clear(self):
+		self.totals.clear()
+		self.generation += 1
+
+	async def get(self, conn, key, query):
+		if key in self.totals:
+			return self.totals[key]
+
+		generation = self.generation
+		result = await conn.execute(query)
+		total = (await result.first()).total
+		if generation == self.generation:
+			# or else it was counted before the update
+			self.totals[key] = total
+		return total
@@ -0,0 +1,118 @@
+import numpy as np
+
+
+TOP = 1000  # rows kept ordered for every popular prefix
+POPULAR = 5000  # rows a prefix needs to have its order kept
+
+
+def name_key(name):
+	"""Case insensitive form of a name. A dash can stand for the #, as it
+	does in the URLs.
+	"""
+	return name.replace("-", "#").casefold().encode()
+
+
+class NameIndex:
+	"""Names sorted by their key, so the ones starting with a prefix are
+	a range found with a binary search. Keys and names are stored back to
+	back in single buffers.
+
+	Rows are given as columns: their ids, names (as bytes) and ranks,
+	in any order. The rows of a prefix are returned from the highest
+	rank. Without ranks, they are returned in key order.
+	"""
+
+	def __init__(self, ids, names, ranks=None):
+		keys = [name_key(name.decode()) for name in names]
+		# Fixed size byte strings sort like bytes (names have no NUL),
+		# and numpy sorts them without comparing python objects
+		order = np.argsort(np.array(keys, dtype=bytes), kind="stable")
+
+		self.ids = ids[order]
+		self.ranks = None if ranks is None else ranks[order]
+
+		order = order.tolist()
+		self.keys, self.key_offsets = pack(keys[idx] for idx in order)
+		self.names, self.name_offsets = pack(names[idx] for idx in order)
+		self.tops = {}  # prefix: positions of its TOP best rows
+
+	def key(self, idx):
+		return self.keys[self.key_offsets[idx]:self.key_offsets[idx + 1]]
+
+	def name(self, idx):
+		return self.names[
+			self.name_offsets[idx]:self.name_offsets[idx + 1]
+		].decode()
+
+	def bound(self, prefix, after):
+		"""First position whose key starts after prefix (after=True) or
+		isn't below it (after=False).
+		"""
+		low, high = 0, len(self.ids)
+		while low < high:
+			mid = (low + high) // 2
+			key = self.key(mid)
+			if after:
+				below = key[:len(prefix)] <= prefix
+			else:
+				below = key < prefix
+			if below:
+				low = mid + 1
+			else:
+				high = mid
+		return low
+
+	def search(self, prefix, offset, limit):
+		"""Returns how many names start with prefix and the (id, name)
+		of the ones at [offset, offset + limit).
+		"""
+		prefix = name_key(prefix)
+		start = self.bound(prefix, False)
+		end = self.bound(prefix, True)
+		total = end - start
+
+		if offset >= total:
+			return total, []
+
+		if self.ranks is None:
+			positions = range(start + offset, min(end, start + offset + limit))
+		else:
+			positions = self.ranked(prefix, start, end, offset + limit)
+			positions = positions[offset:offset + limit].tolist()
+
+		return total, [
+			(int(self.ids[idx]), self.name(idx))
+			for idx in positions
+		]
+
+	def ranked(self, prefix, start, end, needed):
+		"""Positions of the needed best rows in [start, end)"""
+		total = end - start
+		if total >= POPULAR and needed <= TOP:
+			if prefix not in self.tops:
+				self.tops[prefix] = self.best(start, end, TOP)
+			return self.tops[prefix]
+
+		return self.best(start, end, needed)
+
+	def best(self, start, end, needed):
+		ranks = -self.ranks[start:end]
+		if needed < len(ranks):
+			best = np.argpartition(ranks, needed)[:needed]
+		else:
+			best = np.arange(len(ranks))
+		best = best[np.argsort(ranks[best], kind="stable")]
+		return best + start
+
+
+def pack(items):
+	"""Joins byte strings, returning the buffer and where each starts
+	(with the end of the last one at the end)
+	"""
+	items = list(items)
+	offsets = np.zeros(len(items) + 1, dtype=np.int64)
+	np.cumsum(
+		np.fromiter(map(len, items), dtype=np.int64, count=len(items)),
+		out=offsets[1:]
+	)
+	return b"".join(items), offsets
@@ -13,6 +13,8 @@ from shared.models import roles, player, tribe, tribe_stats, member, periods, \
 from shared.qualification import player_qualification_query, \
 	tribe_qualification_query
 
+from leaderboard import Leaderboards, Totals
+
 from aiomysql.sa import create_engine
 from sqlalchemy import and_, or_, desc, func
 from sqlalchemy.sql import select
@@ -23,6 +25,7 @@ class env:
 	cfm_user = os.getenv("DB_USER", "test")
 	cfm_pass = os.getenv("DB_PASS", "test")
 	cfm_db = os.getenv("DB", "api_data")
+	batch_limit = int(os.getenv("BATCH_LIMIT", "300"))
 
 
 service = Service("lookup")
@@ -105,6 +108,53 @@ aliases = {
 	"defilante_round_played": "rounds",
 	"defilante_finished_map": "finished",
 }
+leaderboards = Leaderboards(
+	sorted({
+		field
+		for relation in relations
+		for field in relation.keys + relation.relations
+	}),
+	rankable_fields.values(),
+	# pages cached until now come from the previous leaderboards
+	on_load=lambda: service.cache.clear()
+)
+totals = Totals()
+
+
+def get_relation(db_field):
+	"""Returns the fields shown when ranking by db_field"""
+	for relation in relations:
+		if db_field in relation.keys:
+			return relation.keys + relation.relations
+
+	raise ValueError(f"missing relation for {db_field}")
+
+
+def stat_key(db_field):
+	if db_field.startswith("score_"):
+		return "score"
+	return aliases.get(db_field, db_field)
+
+
+def memory_page(board, db_field, offset, limit, with_roles):
+	"""Builds a leaderboard page out of an in-memory leaderboard"""
+	relation = get_relation(db_field)
+
+	response = []
+	for row in board.page(db_field, offset, limit, relation):
+		row_resp = {
+			"id": row["id"],
+			"name": row["name"],
+		}
+		if with_roles:
+			cfm, tfm = leaderboards.get_roles(row["id"])
+			row_resp["cfm_roles"] = to_cfm_roles(cfm)
+			row_resp["tfm_roles"] = to_tfm_roles(tfm)
+
+		for field in relation:
+			row_resp[stat_key(field)] = row[field]
+		response.append(row_resp)
+	return response
 
 
 @service.event
@@ -120,6 +170,18 @@ async def on_boot(new):
 	)
 
 	service.loop.create_task(ping_db())
+	await service.listen_broadcast("update")
+	await service.listen_broadcast("roles")
+	leaderboards.reload(service.db, service.loop)
+
+
+@service.event
+async def on_broadcast(channel, msg):
+	if channel == "update" and msg == "done":
+		totals.clear()
+		leaderboards.reload(service.db, service.loop)
+	elif channel == "roles":
+		leaderboards.update_roles(msg)
 
 
 async def ping_db():
@@ -131,9 +193,11 @@ async def ping_db():
 
 
 @service.on_request("player")
+@service.cached()
 async def lookup_player(request):
 	offset, limit = request.offset, request.limit
 	tribe = request.tribe
+	total_key = None
 
 	if request.order:
 		if request.order not in rankable_fields:
@@ -146,6 +210,14 @@ async def lookup_player(request):
 
 		db_field = rankable_fields[request.order]
 
+		board = leaderboards.get("player", request.period)
+		if tribe is None and board is not None:
+			await request.send({
+				"total": board.total,
+				"page": memory_page(board, db_field, offset, limit, True),
+			})
+			return
+
 		columns = (player,)
 		select_from = player
 
@@ -161,11 +233,19 @@ async def lookup_player(request):
 		else:
 			period = player
 
+		ranked = and_(
+			disqualified.c.id.is_(None),
+			player_qualification_query,
+		)
 		if tribe is not None:
 			select_from = select_from.join(
 				member, member.c.id_member == player.c.id
 			)
+			ranked = and_(member.c.id_tribe == tribe, ranked)
 
+		select_from = select_from.outerjoin(
+			disqualified, disqualified.c.id == player.c.id
+		)
 		query = (
 			select(
 				*columns,
@@ -176,69 +256,69 @@ async def lookup_player(request):
 			.select_from(
 				select_from
 				.outerjoin(roles, roles.c.id == player.c.id)
-				.outerjoin(disqualified, disqualified.c.id == player.c.id)
 			)
 		)
-		count_query = select(func.count().label("total"))
+		total_key = ("player", request.period, tribe)
+		count_query = (
+			select(func.count().label("total"))
+			.select_from(select_from)
+			.where(ranked)
+		)
 
 		field = getattr(period.c, db_field)
 		if tribe is not None:
-			where = member.c.id_tribe == tribe
-			query = query.where(and_(
-				where,
-				disqualified.c.id.is_(None),
-				player_qualification_query,
-			))
-
-			count_query = count_query.select_from(
-				period
-				.join(member, member.c.id_member == period.c.id)
-			).where(where)
+			query = query.where(ranked)
 		else:
-			if request.period == "overall":
-				without_seek = False
-				response = await service.redis.send(
-					"ranking.getpage",
-					"player",
-					db_field,
-					offset
-				)
-				if isinstance(response, list):
-					if response[2] and offset < 100:
-						# outdated indices and offset is small
-						without_seek = True
-					else:
-						offset -= response[0]
-						query = query.where(and_(
-							field <= response[1],
-							disqualified.c.id.is_(None),
-							player_qualification_query,
-						))
-
-				else:
-					if offset > 10000:
-						await request.reject(
-							"BadRequest",
-							"The page is too far."
-						)
-						return
+			without_seek = False
+			response = await service.redis.send(
+				"ranking.getpage",
+				period.name,
+				db_field,
+				offset
+			)
+			if isinstance(response, list):
+				if response[2] and offset < 100:
+					# outdated indices and offset is small
 					without_seek = True
+				else:
+					offset -= response[0]
+					query = query.where(and_(field <= response[1], ranked))
 
-				if without_seek:
-					query = query.where(and_(
-						disqualified.c.id.is_(None),
-						player_qualification_query,
-					))
 			else:
-				query = query.where(and_(
-					disqualified.c.id.is_(None),
-					player_qualification_query,
-				))
-			count_query = count_query.select_from(period)
+				if offset > 10000:
+					await request.reject(
+						"BadRequest",
+						"The page is too far."
+					)
+					return
+				without_seek = True
+
+			if without_seek:
+				query = query.where(ranked)
 
 		query = query.order_by(desc(field))
 
 	elif request.search:
+		index = leaderboards.get_names("player")
+		if tribe is None and index is not None:
+			total, rows = index.search(request.search, offset, limit)
+
+			response = []
+			for player_id, name in rows:
+				cfm, tfm = leaderboards.get_roles(player_id)
+				response.append({
+					"id": player_id,
+					"name": name,
+					"cfm_roles": to_cfm_roles(cfm),
+					"tfm_roles": to_tfm_roles(tfm),
+				})
+
+			await request.send({
+				"total": total,
+				"page": response,
+			})
+			return
+
 		name = request.search.replace("%", "").replace("_", "\\_") + "%"
 
 		name_query = player.c.name.like(name)
@@ -301,7 +381,9 @@ async def lookup_player(request):
 		)
 
 	async with service.db.acquire() as conn:
-		if count_query is None:
+		if total_key is not None:
+			total = await totals.get(conn, total_key, count_query)
+		elif count_query is None:
 			total = None
 		else:
 			result = await conn.execute(count_query)
@@ -312,13 +394,7 @@ async def lookup_player(request):
 		rows = await result.fetchall()
 
 	if request.order:
-		for relation in relations:
-			if db_field in relation.keys:
-				break
-		else:
-			raise ValueError(f"missing relation for {db_field}")
-
-		relation = relation.keys + relation.relations
+		relation = get_relation(db_field)
 
 	response = []
 	for row in rows:
@@ -332,13 +408,7 @@ async def lookup_player(request):
 
 		if request.order:
 			for db_field in relation:
-				value = getattr(row, db_field)
-				if db_field.startswith("score_"):
-					key = "score"
-				else:
-					key = aliases.get(db_field, db_field)
-
-				row_resp[key] = value
+				row_resp[stat_key(db_field)] = getattr(row, db_field)
 
 	await request.send({
 		"total": total,
@@ -347,8 +417,10 @@ async def lookup_player(request):
 
 
 @service.on_request("tribe")
+@service.cached()
 async def lookup_tribe(request):
 	offset, limit = request.offset, request.limit
+	total_key = None
 
 	if request.order:
 		if request.order not in rankable_fields:
@@ -361,6 +433,14 @@ async def lookup_tribe(request):
 
 		db_field = rankable_fields[request.order]
 
+		board = leaderboards.get("tribe", request.period)
+		if board is not None:
+			await request.send({
+				"total": board.total,
+				"page": memory_page(board, db_field, offset, limit, False),
+			})
+			return
+
 		period = periods["tribe"][request.period]
 		select_from = tribe
 		if period != tribe_stats:
@@ -368,59 +448,68 @@ async def lookup_tribe(request):
 				tribe_stats, tribe_stats.c.id == tribe.c.id
 			)
 
+		select_from = select_from.join(period, period.c.id == tribe.c.id)
 		query = (
 			select(
 				tribe.c.id,
 				tribe.c.name,
 				period,
 			)
-			.select_from(
-				select_from
-				.join(period, period.c.id == tribe.c.id)
-			)
+			.select_from(select_from)
 		)
 
 		field = getattr(period.c, db_field)
-		if request.period == "overall":
-			without_seek = False
-			response = await service.redis.send(
-				"ranking.getpage",
-				"tribe_stats",
-				db_field,
-				offset
-			)
-			if isinstance(response, list):
-				if response[2] and offset < 100:
-					# outdated indices and offset is small
-					without_seek = True
-				else:
-					offset -= response[0]
-					query = query.where(and_(
-						field <= response[1],
-						tribe_qualification_query,
-					))
-
-			else:
-				if offset > 10000:
-					await request.reject(
-						"BadRequest",
-						"The page is too far."
-					)
-					return
+		without_seek = False
+		response = await service.redis.send(
+			"ranking.getpage",
+			period.name,
+			db_field,
+			offset
+		)
+		if isinstance(response, list):
+			if response[2] and offset < 100:
+				# outdated indices and offset is small
 				without_seek = True
+			else:
+				offset -= response[0]
+				query = query.where(and_(
+					field <= response[1],
+					tribe_qualification_query,
+				))
 
-			if without_seek:
-				query = query.where(tribe_qualification_query)
 		else:
+			if offset > 10000:
+				await request.reject(
+					"BadRequest",
+					"The page is too far."
+				)
+				return
+			without_seek = True
+
+		if without_seek:
 			query = query.where(tribe_qualification_query)
 		query = query.order_by(desc(field))
 
+		total_key = ("tribe", request.period, None)
 		count_query = (
 			select(func.count().label("total"))
-			.select_from(period)
+			.select_from(select_from)
+			.where(tribe_qualification_query)
 		)
 
 	elif request.search:
+		index = leaderboards.get_names("tribe")
+		if index is not None:
+			total, rows = index.search(request.search, offset, limit)
+			await request.send({
+				"total": total,
+				"page": [
+					{"id": tribe_id, "name": name}
+					for tribe_id, name in rows
+				],
+			})
+			return
+
 		name = request.search.replace("%", "").replace("_", "\\_") + "%"
 
 		where = tribe.c.name.like(name)
@@ -436,20 +525,17 @@ async def lookup_tribe(request):
 		)
 
 	async with service.db.acquire() as conn:
-		result = await conn.execute(count_query)
-		total = await result.first()
+		if total_key is not None:
+			total = await totals.get(conn, total_key, count_query)
+		else:
+			result = await conn.execute(count_query)
+			total = (await result.first()).total
 
 		result = await conn.execute(query.offset(offset).limit(limit))
 		rows = await result.fetchall()
 
 	if request.order:
-		for relation in relations:
-			if db_field in relation.keys:
-				break
-		else:
-			raise ValueError(f"missing relation for {db_field}")
-
-		relation = relation.keys + relation.relations
+		relation = get_relation(db_field)
 
 	response = []
 	for row in rows:
@@ -461,16 +547,10 @@ async def lookup_tribe(request):
 
 		if request.order:
 			for db_field in relation:
-				value = getattr(row, db_field)
-				if db_field.startswith("score_"):
-					key = "score"
-				else:
-					key = aliases.get(db_field, db_field)
-
-				row_resp[key] = value
+				row_resp[stat_key(db_field)] = getattr(row, db_field)
 
 	await request.send({
-		"total": total.total,
+		"total": total,
 		"page": response,
 	})
 
@@ -500,37 +580,79 @@ async def get_position(request):
 		await request.reject("Unavailable")
 		return
 
-	tbl = player if for_player else tribe_stats
-	outdated, approximate, boundary = response
-	field = getattr(tbl.c, db_field)
-	async with service.db.acquire() as conn:
-		if approximate <= 10000:
-			condition = and_(field <= boundary, field >= value)
-		else:
-			condition = and_(field < boundary, field > value)
-
-		if for_player:
-			tbl = tbl.outerjoin(disqualified, disqualified.c.id == player.c.id)
-			condition = and_(
-				condition,
-				disqualified.c.id.is_(None),
-				player_qualification_query
+	# The index is exact: it counts every ranked row with a higher stat
+	outdated, above, _ = response
+	await request.send({
+		"position": above + 1,
+		"accurate": True,
+		"outdated": outdated == 1,
+	})
+
+
+# the stats a batch answers with, besides the id and name
+batch_stats = (
+	"round_played", "cheese_gathered", "first", "bootcamp",
+	"score_stats", "score_shaman", "score_survivor", "score_racing",
+	"score_defilante", "score_overall",
+)
+
+
+@service.on_request("batch")
+async def lookup_batch(request):
+	ids, names = request.ids or [], request.names or []
+
+	if len(ids) + len(names) > env.batch_limit:
+		await request.reject(
+			"BadRequest",
+			"Can't look up more than {} {}s at once."
+			.format(env.batch_limit, request.what)
+		)
+		return
+
+	if not ids and not names:
+		await request.send([])
+		return
+
+	if request.what == "player":
+		schema = "BatchPlayer"
+		query = (
+			select(
+				player.c.id,
+				player.c.name,
+				*(getattr(player.c, stat) for stat in batch_stats),
+
+				roles.c.cfm.label("cfm_roles"),
+				roles.c.tfm.label("tfm_roles"),
 			)
-		else:
-			condition = and_(condition, tribe_qualification_query)
+			.select_from(
+				player
+				.outerjoin(roles, roles.c.id == player.c.id)
+			)
+			.where(or_(player.c.id.in_(ids), player.c.name.in_(names)))
+		)
 
-		result = await conn.execute(
-			select(func.count().label("count"))
-			.select_from(tbl)
-			.where(condition)
+	else:
+		schema = "BatchTribe"
+		query = (
+			select(
+				tribe.c.id,
+				tribe.c.name,
+				tribe_stats.c.members,
+				tribe_stats.c.active,
+				*(getattr(tribe_stats.c, stat) for stat in batch_stats),
+			)
+			.select_from(
+				tribe
+				.outerjoin(tribe_stats, tribe_stats.c.id == tribe.c.id)
+			)
+			.where(or_(tribe.c.id.in_(ids), tribe.c.name.in_(names)))
 		)
-		count = await result.first()
 
-	await request.send({
-		"position": max(1, count.count + approximate),
-		"accurate": approximate <= 10000,
-		"outdated": outdated == 1,
-	})
+	async with service.db.acquire() as conn:
+		result = await conn.execute(query)
+		rows = await result.fetchall()
+
+	await request.send(as_dict_list(schema, rows))
 
 
 @service.on_request("roles")
@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# The lookup modules are imported the way service.py imports them
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+import names
+
+from names import NameIndex, name_key
+
+
+NAMES = ["Tig#0000", "tigrounette#0001", "Tigre#0095", "Bob#1234", "tom#0020"]
+
+
+def make_index(names, ranks=None):
+	ids = np.arange(1, len(names) + 1, dtype=np.int64)
+	if ranks is not None:
+		ranks = np.array(list(ranks), dtype=np.int64)
+	return NameIndex(ids, [name.encode() for name in names], ranks)
+
+
+def test_name_key():
+	assert name_key("Tig-0000") == b"tig#0000"
+	assert name_key("TIG#0000") == name_key("tig-0000")
+
+
+def test_prefixes_ignore_case():
+	index = make_index(NAMES)
+
+	total, rows = index.search("TIG", 0, 10)
+	assert total == 3
+	assert rows == [(1, "Tig#0000"), (3, "Tigre#0095"), (2, "tigrounette#0001")]
+
+	assert index.search("t", 0, 10)[0] == 4
+	assert index.search("bob#1234", 0, 10) == (1, [(4, "Bob#1234")])
+	assert index.search("zzz", 0, 10) == (0, [])
+	assert index.search("", 0, 10)[0] == len(NAMES)
+
+
+def test_dash_stands_for_the_tag():
+	index = make_index(NAMES)
+
+	assert index.search("tig-", 0, 10) == (1, [(1, "Tig#0000")])
+	assert index.search("Tom-0020", 0, 10) == (1, [(5, "tom#0020")])
+
+
+def test_ranks_order_the_rows():
+	index = make_index(NAMES, ranks=[10, 30, 20, 50, 40])
+
+	total, rows = index.search("ti", 0, 10)
+	assert total == 3
+	assert [_id for _id, _ in rows] == [2, 3, 1]
+	assert index.search("t", 1, 2) == (
+		4, [(2, "tigrounette#0001"), (3, "Tigre#0095")]
+	)
+
+
+@pytest.mark.parametrize("ranks", [None, [10, 30, 20, 50, 40]])
+def test_offset_past_total(ranks):
+	index = make_index(NAMES, ranks)
+
+	assert index.search("tig", 3, 10) == (3, [])
+	assert index.search("tig", 50, 10) == (3, [])
+	assert index.search("tig", 2, 10) == (3, index.search("tig", 0, 10)[1][2:])
+
+
+def test_popular_prefixes_are_cached(monkeypatch):
+	monkeypatch.setattr(names, "TOP", 3)
+	monkeypatch.setattr(names, "POPULAR", 5)
+
+	players = ["Player{}#0000".format(idx) for idx in range(8)] + NAMES
+	index = make_index(players, ranks=range(len(players)))
+
+	sorts = []
+	best = index.best
+	index.best = lambda *args: sorts.append(args) or best(*args)
+
+	total, rows = index.search("player", 0, 2)
+	assert total == 8
+	assert rows == [(8, "Player7#0000"), (7, "Player6#0000")]
+	assert sorts == [(1, 9, 3)]  # Bob#1234 sorts first
+	assert list(index.tops) == [b"player"]
+
+	# Served from the cache while they are within the top rows
+	assert index.search("PLAYER", 1, 2) == (
+		8, [(7, "Player6#0000"), (6, "Player5#0000")]
+	)
+	assert len(sorts) == 1
+
+	total, rows = index.search("player", 2, 3)
+	assert [name for _, name in rows] == [
+		"Player5#0000", "Player4#0000", "Player3#0000",
+	]
+	assert sorts[1:] == [(1, 9, 5)]
+
+	# and small prefixes are never cached
+	index.search("tig", 0, 1)
+	assert list(index.tops) == [b"player"]
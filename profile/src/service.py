@@ -197,7 +197,16 @@ async def account_progress(request):
 	await request.send(period)
 
 
+def sees_last_login(request):
+	if request.auth is None:
+		return False
+
+	me = request.auth["cfm_roles"]
+	return "admin" in me or "dev" in me
+
+
 @service.on_request("player")
+@service.cached(ignore=("auth",), bypass=sees_last_login)
 async def profile_player(request):
 	if request.id is not None:
 		query = player.c.id == request.id
@@ -292,6 +301,7 @@ async def profile_player(request):
 
 
 @service.on_request("tribe")
+@service.cached()
 async def profile_tribe(request):
 	if request.id is not None:
 		query = tribe.c.id == request.id
@@ -7,28 +7,58 @@
 #include <unistd.h>
 #include <signal.h>
 #include <string.h>
+#include <limits.h>
 #include <pthread.h>
+#include <fcntl.h>
+#include <sys/stat.h>
+#include <sys/mman.h>
 #include <mariadb/mysql.h>
 
 #define mysqlError(con) fprintf(stderr, "%s\n", mysql_error(con));
 #define stmtError(stmt) fprintf(stderr, "%s\n", mysql_stmt_error(stmt));
 #define getenvdef(var,default) getenv(var) ? getenv(var) : default;
 
-#define tablesLength 2
+#define tablesLength 8
+// tables kept up to date by the feeds, the period ones are rebuilt every run
+#define feedTablesLength 2
 #define statsLength 10
-#define perIndex 39
+#define maxQualifications 16
+#define feedVersion 1
+#define indexVersion 2
+
+const char indexMagic[8] = "CFMRANK";
 
 volatile sig_atomic_t didShutdown = 0;
 volatile sig_atomic_t didBoot = 0;
+volatile sig_atomic_t updating = 0;
 pthread_t bootThreadId;
 pthread_t generatorThreadId;
 
 const char* tables[tablesLength] = {
   "player",
   "tribe_stats",
+  "player_daily",
+  "player_weekly",
+  "player_monthly",
+  "tribe_daily",
+  "tribe_weekly",
+  "tribe_monthly",
+};
+// slot of the table the rows of each one qualify (or get disqualified) with
+const int qualifySlot[tablesLength] = {0, 1, 0, 0, 0, 1, 1, 1};
+volatile sig_atomic_t available[tablesLength] = {0};
+volatile sig_atomic_t outdated[tablesLength] = {0};
+time_t generatedAt[tablesLength] = {0};
+pthread_rwlock_t indexLock[tablesLength] = {
+  PTHREAD_RWLOCK_INITIALIZER,
+  PTHREAD_RWLOCK_INITIALIZER,
+  PTHREAD_RWLOCK_INITIALIZER,
+  PTHREAD_RWLOCK_INITIALIZER,
+  PTHREAD_RWLOCK_INITIALIZER,
+  PTHREAD_RWLOCK_INITIALIZER,
+  PTHREAD_RWLOCK_INITIALIZER,
+  PTHREAD_RWLOCK_INITIALIZER,
 };
-volatile sig_atomic_t available[tablesLength] = {0, 0};
-volatile sig_atomic_t outdated[tablesLength] = {0, 0};
 
 const char* validStats[statsLength] = {
   "round_played",
@@ -44,12 +74,45 @@ const char* validStats[statsLength] = {
 };
 
 char* globalQualificationQuery;
+int qualificationLength = 0;
+char qualificationFields[maxQualifications][64];
+int qualificationMins[maxQualifications];
 
+// run of the last feed the indices are up to date with
+char* lastRun = NULL;
+
+// every value some row has, from the highest one
 int** statsStart[tablesLength];
 int** statsEnd[tablesLength];
+// rows above every value, and the total rows at the end
+int** statsPos[tablesLength];
+
+// mappings of the index files the arrays live in, NULL if they are on the heap
+void** statsMap[tablesLength];
+size_t* statsMapSize[tablesLength];
 
 int** genStatsStart[tablesLength];
 int** genStatsEnd[tablesLength];
+int** genStatsPos[tablesLength];
+void** genStatsMap[tablesLength];
+size_t* genStatsMapSize[tablesLength];
+
+// Index files are the header, the values and the positions
+typedef struct {
+  char magic[8];
+  uint32_t version;
+  uint32_t values;
+  uint64_t rows;
+  char table[32];
+  char stat[32];
+  // run of the last feed applied, empty if unknown
+  char generation[32];
+  // when the index was last generated from the database
+  int64_t generatedAt;
+  // of the values and the positions
+  uint32_t crc;
+  uint32_t reserved;
+} IndexHeader;
 
 void printfd(const char* fmt, ...) {
   time_t raw;
@@ -124,6 +187,24 @@ bool parseArguments(
   return true;
 }
 
+// Returns the amount of values > value, which is the index of the first
+// value <= value
+int findValue(int* values, int length, long long value) {
+  int l = 0;
+  int r = length - 1;
+  int m;
+  while (l <= r) {
+    m = (l + r) / 2;
+
+    if (values[m] > value) {
+      l = m + 1;
+    } else {
+      r = m - 1;
+    }
+  }
+  return l;
+}
+
 int reply_GETPOS(RedisModuleCtx *ctx, int outdated, int position, int value) {
   RedisModule_ReplyWithArray(ctx, 3);
   RedisModule_ReplyWithLongLong(ctx, outdated);
@@ -132,7 +213,7 @@ int reply_GETPOS(RedisModuleCtx *ctx, int outdated, int position, int value) {
 }
 
 /* RANKING.GETPOS name stat */
-// Returns approximate leaderboard position of stat
+// Returns how many rows have a higher stat, and the highest value <= stat
 int cmd_GETPOS(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
   int slot;
   int statIndex;
@@ -140,34 +221,22 @@ int cmd_GETPOS(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
   if (!parseArguments(ctx, argv, argc, &slot, &statIndex, &stat))
     return REDISMODULE_OK;
 
+  pthread_rwlock_rdlock(&indexLock[slot]);
   int* ptr = statsStart[slot][statIndex];
-  int* end = statsEnd[slot][statIndex];
+  int* pos = statsPos[slot][statIndex];
+  int length = statsEnd[slot][statIndex] - ptr;
 
-  int l = 0;
-  int r = end - ptr - 1;
-  int m;
-  while (l <= r) {
-    m = (l + r) / 2;
+  int index = findValue(ptr, length, stat);
+  int position = pos[index];
+  int value = index < length ? ptr[index] : 0;
+  pthread_rwlock_unlock(&indexLock[slot]);
 
-    // comparisons are inverted because the array is inverted
-    if (ptr[m] > stat) {
-      l = m + 1;
-
-    } else if (ptr[m] < stat) {
-      r = m - 1;
-
-    } else {
-      return reply_GETPOS(ctx, outdated[slot], m * perIndex, ptr[m]);
-    }
-  }
-
-  // r is in the least number greater than stat, which is what we are looking for
-  r = max(r, 0);
-  return reply_GETPOS(ctx, outdated[slot], r * perIndex, ptr[r]);
+  return reply_GETPOS(ctx, outdated[slot], position, value);
 }
 
 /* RANKING.GETPAGE name start */
-// Returns an approximate of the value that the row may have
+// Returns the value of the row at start, and how many rows have a higher
+// value
 int cmd_GETPAGE(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
   int slot;
   int statIndex;
@@ -175,14 +244,37 @@ int cmd_GETPAGE(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
   if (!parseArguments(ctx, argv, argc, &slot, &statIndex, &startRow))
     return REDISMODULE_OK;
 
-  int* ptr = statsStart[slot][statIndex] + startRow / perIndex;
-  int* end = statsEnd[slot][statIndex];
+  pthread_rwlock_rdlock(&indexLock[slot]);
+  int* ptr = statsStart[slot][statIndex];
+  int* pos = statsPos[slot][statIndex];
+  int length = statsEnd[slot][statIndex] - ptr;
 
-  if (ptr >= end)
+  if (startRow < 0 || startRow >= pos[length]) {
+    pthread_rwlock_unlock(&indexLock[slot]);
     return RedisModule_ReplyWithError(ctx, "ERR page too far");
+  }
+
+  // the last value with at most startRow rows above it
+  int l = 0;
+  int r = length - 1;
+  int m;
+  while (l <= r) {
+    m = (l + r) / 2;
+
+    if (pos[m] <= startRow) {
+      l = m + 1;
+    } else {
+      r = m - 1;
+    }
+  }
+
+  int position = pos[r];
+  int value = ptr[r];
+  pthread_rwlock_unlock(&indexLock[slot]);
+
   RedisModule_ReplyWithArray(ctx, 3);
-  RedisModule_ReplyWithLongLong(ctx, startRow / perIndex * perIndex);
-  RedisModule_ReplyWithLongLong(ctx, *ptr);
+  RedisModule_ReplyWithLongLong(ctx, position);
+  RedisModule_ReplyWithLongLong(ctx, value);
   return RedisModule_ReplyWithLongLong(ctx, outdated[slot]);
 }
 
@@ -208,70 +300,180 @@ MYSQL* connectToMySQL(void) {
   return con;
 }
 
+uint32_t crcTable[256];
+
+void setupCrc(void) {
+  for (uint32_t n = 0; n < 256; n++) {
+    uint32_t c = n;
+    for (int k = 0; k < 8; k++)
+      c = c & 1 ? 0xEDB88320 ^ (c >> 1) : c >> 1;
+    crcTable[n] = c;
+  }
+}
+
+uint32_t updateCrc(uint32_t crc, const void* data, size_t length) {
+  const unsigned char* bytes = (const unsigned char*) data;
+  crc = ~crc;
+  for (size_t n = 0; n < length; n++)
+    crc = crcTable[(crc ^ bytes[n]) & 0xff] ^ (crc >> 8);
+  return ~crc;
+}
+
+void freeIndexArrays(int** start, int** end, int** pos, void** map, size_t* mapSize) {
+  for (int i = 0; i < statsLength; i++) {
+    if (map[i] != NULL) {
+      munmap(map[i], mapSize[i]);
+    } else {
+      free(start[i]);
+      free(pos[i]);
+    }
+  }
+
+  free(start);
+  free(end);
+  free(pos);
+  free(map);
+  free(mapSize);
+}
+
 void freeIndices(int slot) {
-  for (int i = 0; i < statsLength; i++)
-    free(statsStart[slot][i]);
+  freeIndexArrays(statsStart[slot], statsEnd[slot], statsPos[slot], statsMap[slot], statsMapSize[slot]);
+}
 
-  free(statsStart[slot]);
-  free(statsEnd[slot]);
+void freeGeneratedIndices(int slot) {
+  freeIndexArrays(genStatsStart[slot], genStatsEnd[slot], genStatsPos[slot], genStatsMap[slot], genStatsMapSize[slot]);
 }
 
-bool loadIndex(int slot, int i, const char* path) {
-  FILE *f = fopen(path, "rb");
-  if (f == NULL) return false;
+void indexPath(char* buffer, int slot, int i) {
+  const char* path = getenvdef("INDEX_SAVE", "/data/rank_%s_index%d.bin");
+  snprintf(buffer, 256, path, tables[slot], i);
+}
 
-  fseek(f, 0, SEEK_END);
-  int size = ftell(f);
-  rewind(f);
+// Maps an index file into the generated arrays. Files that are not
+// complete or that don't belong to the index are rejected.
+bool loadIndex(int slot, int i, const char* path, IndexHeader* header) {
+  int fd = open(path, O_RDONLY);
+  if (fd == -1) return false;
 
-  int *content = (int*) malloc(size);
-  fread(content, 1, size, f);
-  fclose(f);
+  struct stat info;
+  if (fstat(fd, &info) != 0 || info.st_size < (off_t) sizeof(IndexHeader)) {
+    close(fd);
+    return false;
+  }
+
+  void* map = mmap(NULL, info.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+  close(fd);
+  if (map == MAP_FAILED) return false;
+
+  memcpy(header, map, sizeof(IndexHeader));
+  const char* error = NULL;
+  size_t dataSize = ((size_t) header->values * 2 + 1) * sizeof(int);
+  if (memcmp(header->magic, indexMagic, sizeof(header->magic)) != 0 || header->version != indexVersion) {
+    error = "has an unknown format";
+  } else if (strncmp(header->table, tables[slot], sizeof(header->table)) != 0 ||
+             strncmp(header->stat, validStats[i], sizeof(header->stat)) != 0) {
+    error = "belongs to another index";
+  } else if (info.st_size != sizeof(IndexHeader) + dataSize) {
+    error = "is truncated";
+  } else if (updateCrc(0, (char*) map + sizeof(IndexHeader), dataSize) != header->crc) {
+    error = "is corrupted";
+  }
 
-  genStatsStart[slot][i] = content;
-  genStatsEnd[slot][i] = content + (size / sizeof(int));
+  if (error != NULL) {
+    printfd("index file %s %s\n", path, error);
+    munmap(map, info.st_size);
+    return false;
+  }
+
+  int* values = (int*) ((char*) map + sizeof(IndexHeader));
+  genStatsStart[slot][i] = values;
+  genStatsEnd[slot][i] = values + header->values;
+  genStatsPos[slot][i] = values + header->values;
+  genStatsMap[slot][i] = map;
+  genStatsMapSize[slot][i] = info.st_size;
   return true;
 }
 
-bool saveIndex(int slot, int i, char* path) {
-  FILE *f = fopen(path, "wb");
+// Writes a generated index next to its file and then replaces the file,
+// so it is either the old or the new one, never a partial one
+bool saveIndex(int slot, int i, const char* path, const char* run) {
+  IndexHeader header;
+  memset(&header, 0, sizeof(header));
+  memcpy(header.magic, indexMagic, sizeof(header.magic));
+  header.version = indexVersion;
+  strncpy(header.table, tables[slot], sizeof(header.table) - 1);
+  strncpy(header.stat, validStats[i], sizeof(header.stat) - 1);
+  strncpy(header.generation, run ? run : "", sizeof(header.generation) - 1);
+  header.generatedAt = generatedAt[slot];
+
+  int* values = genStatsStart[slot][i];
+  int* pos = genStatsPos[slot][i];
+  header.values = genStatsEnd[slot][i] - values;
+  header.rows = pos[header.values];
+  header.crc = updateCrc(0, values, header.values * sizeof(int));
+  header.crc = updateCrc(header.crc, pos, (header.values + 1) * sizeof(int));
+
+  char tmpPath[256 + 8];
+  sprintf(tmpPath, "%s.tmp", path);
+  FILE *f = fopen(tmpPath, "wb");
   if (f == NULL) {
     printfd("could not write index %d\n", i);
     return false;
   }
 
-  fwrite((char*) statsStart[slot][i], sizeof(int), statsEnd[slot][i] - statsStart[slot][i], f);
+  bool written = fwrite(&header, sizeof(header), 1, f) == 1 &&
+    fwrite(values, sizeof(int), header.values, f) == header.values &&
+    fwrite(pos, sizeof(int), header.values + 1, f) == header.values + 1 &&
+    fflush(f) == 0 && fsync(fileno(f)) == 0;
   fclose(f);
 
+  if (!written || rename(tmpPath, path) != 0) {
+    printfd("could not write index %d\n", i);
+    remove(tmpPath);
+    return false;
+  }
+
   printfd("index %d written\n", i);
   return true;
 }
 
-void saveIndices(int slot) {
-  const char* path = getenvdef("INDEX_SAVE", "/data/rank_%s_index%d.bin");
-  printfd("saving indices to %s (%s)\n", path, tables[slot]);
+// Saves the generated indices of a table and serves them from their
+// files. If they can't be saved, they are served from memory.
+void saveIndices(int slot, const char* run) {
+  printfd("saving indices (%s)\n", tables[slot]);
 
   for (int i = 0; i < statsLength; i++) {
-    char buffer[256];
-    sprintf(buffer, path, tables[slot], i);
-
-    saveIndex(slot, i, buffer);
+    char path[256];
+    indexPath(path, slot, i);
+    if (!saveIndex(slot, i, path, run)) continue;
+
+    int* values = genStatsStart[slot][i];
+    int* pos = genStatsPos[slot][i];
+    IndexHeader header;
+    if (loadIndex(slot, i, path, &header)) {
+      free(values);
+      free(pos);
+    }
   }
 
   printfd("indices saved\n");
 }
 
 bool allocateParentArrays(int slot) {
-  genStatsStart[slot] = (int**) malloc(statsLength * sizeof(int*));
-  if (genStatsStart[slot] == NULL) {
-    fprintf(stderr, "failed to allocate memory for indices for %s.\n", tables[slot]);
-    return false;
-  }
-
-  genStatsEnd[slot] = (int**) malloc(statsLength * sizeof(int*));
-  if (genStatsEnd[slot] == NULL) {
+  genStatsStart[slot] = (int**) calloc(statsLength, sizeof(int*));
+  genStatsEnd[slot] = (int**) calloc(statsLength, sizeof(int*));
+  genStatsPos[slot] = (int**) calloc(statsLength, sizeof(int*));
+  genStatsMap[slot] = (void**) calloc(statsLength, sizeof(void*));
+  genStatsMapSize[slot] = (size_t*) calloc(statsLength, sizeof(size_t));
+
+  if (genStatsStart[slot] == NULL || genStatsEnd[slot] == NULL || genStatsPos[slot] == NULL ||
+      genStatsMap[slot] == NULL || genStatsMapSize[slot] == NULL) {
     fprintf(stderr, "failed to allocate memory for indices for %s.\n", tables[slot]);
     free(genStatsStart[slot]);
+    free(genStatsEnd[slot]);
+    free(genStatsPos[slot]);
+    free(genStatsMap[slot]);
+    free(genStatsMapSize[slot]);
     return false;
   }
 
@@ -279,79 +481,90 @@ bool allocateParentArrays(int slot) {
 }
 
 void moveGeneratedIndices(int slot) {
+  pthread_rwlock_wrlock(&indexLock[slot]);
+  bool hadIndices = available[slot] == 1;
+  int** oldStart = statsStart[slot];
+  int** oldEnd = statsEnd[slot];
+  int** oldPos = statsPos[slot];
+  void** oldMap = statsMap[slot];
+  size_t* oldMapSize = statsMapSize[slot];
+
   statsStart[slot] = genStatsStart[slot];
   statsEnd[slot] = genStatsEnd[slot];
+  statsPos[slot] = genStatsPos[slot];
+  statsMap[slot] = genStatsMap[slot];
+  statsMapSize[slot] = genStatsMapSize[slot];
   outdated[slot] = 0;
+  pthread_rwlock_unlock(&indexLock[slot]);
+
+  // nobody can be reading them anymore
+  if (hadIndices)
+    freeIndexArrays(oldStart, oldEnd, oldPos, oldMap, oldMapSize);
 }
 
-bool generateIndices(MYSQL *con, int slot, char* qualificationQuery) {
-  printfd("generating indices\n");
-  outdated[slot] = 1;
+// Makes sure a value and its position fit in the arrays of a stat
+bool growIndex(int slot, int i, int length, int* size) {
+  if (length < *size) return true;
 
-  // on success, allocates statsStart, statsEnd, all children arrays and returns true
-  // on failure, prints error and returns false. none of the arrays are allocated after that
-  bool setupIndices = false;
+  *size = *size > 0 ? *size * 2 : 1024;
+  int* values = (int*) realloc(genStatsStart[slot][i], *size * sizeof(int));
+  if (values == NULL) return false;
+  genStatsStart[slot][i] = values;
 
-  // check how many numbers we need to store
-  char buffer[256];
-  sprintf(buffer, "SELECT COUNT(*) FROM `%s`;", tables[slot]);
-  if (mysql_query(con, buffer) > 0) {
-    mysqlError(con);
-    goto error;
-  }
+  int* pos = (int*) realloc(genStatsPos[slot][i], (*size + 1) * sizeof(int));
+  if (pos == NULL) return false;
+  genStatsPos[slot][i] = pos;
+  return true;
+}
 
-  MYSQL_RES *countRes = mysql_use_result(con);
-  MYSQL_ROW countRow = mysql_fetch_row(countRes);
-  const int count = atoi(countRow[0]) / perIndex;
-  mysql_free_result(countRes);
+bool generateIndices(MYSQL *con, int slot, char* qualificationQuery, const char* run) {
+  printfd("generating indices\n");
+  outdated[slot] = 1;
 
-  // allocate parent arrays
+  // on success, moves the generated arrays to statsStart, statsEnd, statsPos and returns true
+  // on failure, prints error and returns false. none of the arrays are allocated after that
   if (!allocateParentArrays(slot)) return false;
 
-  // allocate children arrays
-  for (int i = 0; i < statsLength; i++) {
-    genStatsStart[slot][i] = (int*) malloc(count * sizeof(int));
-
-    if (genStatsStart[slot][i] == NULL) {
-      fprintf(stderr, "failed to allocate memory for indices.\n");
-      // could not allocate more memory, so free what we already had
-      for (int j = 0; j < i; j++)
-        free(genStatsStart[slot][j]);
-      goto error;
-    }
-  }
-  setupIndices = true;
-  printfd("memory allocated\n");
-
   // get & store all the numbers
   for (int i = 0; i < statsLength; i++) {
     const char* name = validStats[i];
 
-    // prepare mysql query
-    char* fmt = (char*) malloc(sizeof(char) * 1024);
-    if (slot == 0) {
-      char* preFmt = "SELECT `p`.`%%s` "
-                     "FROM `%%s` as `p` "
+    // prepare mysql query. period tables (`t`) are ranked with the
+    // qualification of their overall table (`p`)
+    int base = qualifySlot[slot];
+    char from[256];
+    if (base == slot)
+      snprintf(from, sizeof(from), "`%s` as `p`", tables[slot]);
+    else
+      snprintf(from, sizeof(from),
+               "`%s` as `t` INNER JOIN `%s` as `p` ON `p`.`id` = `t`.`id`",
+               tables[slot], tables[base]);
+    const char* alias = base == slot ? "p" : "t";
+
+    char fmt[1024];
+    if (base == 0) {
+      char* preFmt = "SELECT `%s`.`%%s`, COUNT(*) "
+                     "FROM %s "
                      "LEFT JOIN `disqualified` as `d` "
                      "ON `d`.`id` = `p`.`id` "
-                     "WHERE `d`.`id` IS NULL%s "
-                     "ORDER BY `p`.`%%s` DESC";
-      int length = strlen(preFmt) + 1 + strlen(qualificationQuery);
-      snprintf(fmt, length, preFmt, qualificationQuery);
-    } else if (slot == 1) {
-      char* preFmt = "SELECT `p`.`%%s` "
-                     "FROM `%%s` as `p` "
-                     "WHERE 1=1%s "
-                     "ORDER BY `p`.`%%s` DESC";
-      int length = strlen(preFmt) + 1 + strlen(qualificationQuery);
-      snprintf(fmt, length, preFmt, qualificationQuery);
+                     "WHERE `d`.`id` IS NULL AND `%s`.`%%s` > 0%s "
+                     "GROUP BY `%s`.`%%s` "
+                     "ORDER BY `%s`.`%%s` DESC";
+      snprintf(fmt, sizeof(fmt), preFmt, alias, from, alias, qualificationQuery, alias, alias);
+    } else if (base == 1) {
+      char* preFmt = "SELECT `%s`.`%%s`, COUNT(*) "
+                     "FROM %s "
+                     "WHERE `%s`.`%%s` > 0%s "
+                     "GROUP BY `%s`.`%%s` "
+                     "ORDER BY `%s`.`%%s` DESC";
+      snprintf(fmt, sizeof(fmt), preFmt, alias, from, alias, qualificationQuery, alias, alias);
     } else {
       printfd("unknown table slot %d\n", slot);
       goto error;
     }
-    int length = strlen(fmt) + 1 + strlen(tables[slot]) + strlen(name) * 2;
+    int length = strlen(fmt) + 1 + strlen(name) * 4;
     char query[length];
-    snprintf(query, length, fmt, name, tables[slot], name);
+    snprintf(query, length, fmt, name, name, name, name);
     printfd("using query %s\n", query);
 
     MYSQL_STMT *stmt = mysql_stmt_init(con);
@@ -362,14 +575,19 @@ bool generateIndices(MYSQL *con, int slot, char* qualificationQuery) {
 
     // bind result
     int statValue;
-    my_bool isNull;
-    my_bool hasError;
-    MYSQL_BIND bind[1];
+    long long rows;
+    my_bool isNull[2];
+    my_bool hasError[2];
+    MYSQL_BIND bind[2];
     memset(bind, 0, sizeof(bind));
     bind[0].buffer_type = MYSQL_TYPE_LONG;
     bind[0].buffer = (char *)&statValue;
-    bind[0].is_null = &isNull;
-    bind[0].error = &hasError;
+    bind[0].is_null = &isNull[0];
+    bind[0].error = &hasError[0];
+    bind[1].buffer_type = MYSQL_TYPE_LONGLONG;
+    bind[1].buffer = (char *)&rows;
+    bind[1].is_null = &isNull[1];
+    bind[1].error = &hasError[1];
 
     if (mysql_stmt_bind_result(stmt, bind) != 0) {
       stmtError(stmt);
@@ -382,52 +600,50 @@ bool generateIndices(MYSQL *con, int slot, char* qualificationQuery) {
     }
 
     printfd("generating indices for %s\n", name);
-    // fetch all rows
-    int* ptr = genStatsStart[slot][i];
+    // fetch every value with how many rows have it
+    int values = 0;
+    int size = 0;
+    int total = 0;
+    bool allocated = true;
     while (mysql_stmt_fetch(stmt) == 0) {
-      if (isNull || statValue == 0) {
-        *ptr = 0;
+      if (!growIndex(slot, i, values, &size)) {
+        fprintf(stderr, "failed to allocate memory for indices.\n");
+        allocated = false;
         break;
-      } else {
-        *ptr = statValue;
       }
-      ptr++;
 
-      // ignore rows we don't need
-      for (int ignored = 0; ignored < perIndex - 1; ignored++)
-        if (mysql_stmt_fetch(stmt) != 0) goto nextStat; // break out of both loops
+      genStatsStart[slot][i][values] = statValue;
+      genStatsPos[slot][i][values] = total;
+      total += rows;
+      values++;
     }
 
-nextStat: ;
     // check if there have been errors
     int stmt_errno = mysql_stmt_errno(stmt);
     if (stmt_errno != 0) {
       stmtError(stmt);
-    } else {
+    } else if (allocated && growIndex(slot, i, values, &size)) {
       printfd("index generation for %s successful\n", name);
-      genStatsEnd[slot][i] = ptr;
+      genStatsEnd[slot][i] = genStatsStart[slot][i] + values;
+      genStatsPos[slot][i][values] = total;
+    } else {
+      allocated = false;
     }
 
     // before going to the next stat, we need to cleanup
     mysql_stmt_free_result(stmt);
     mysql_stmt_close(stmt);
 
-    if (stmt_errno != 0) goto error;
+    if (stmt_errno != 0 || !allocated) goto error;
   }
 
   // if everything goes smoothly, we just save the indices in disk & return true
+  generatedAt[slot] = time(NULL);
+  saveIndices(slot, run);
   moveGeneratedIndices(slot);
-  saveIndices(slot);
   return true;
 error:
-  if (setupIndices) {
-    // indices were setup, we need to free everything
-    for (int i = 0; i < statsLength; i++)
-      free(genStatsStart[slot][i]);
-  }
-  free(genStatsStart[slot]);
-  free(genStatsEnd[slot]);
-
+  freeGeneratedIndices(slot);
   return false;
 }
 
@@ -436,14 +652,15 @@ char* getQualificationQuery() {
   if (fp == NULL)
     return "";
 
-  char* query = (char*) malloc(sizeof(char) * 2048);
-  char* line;
+  char* query = (char*) calloc(2048, sizeof(char));
+  char* line = NULL;
   size_t len = 0;
   while (getline(&line, &len, fp) != -1) {
     char field[64];
     int min;
     char minStr[10];
-    if (sscanf(line, "%s = %d", field, &min) == EOF) { continue; }
+    // skips comments and sections too
+    if (sscanf(line, "%63s = %d", field, &min) != 2) { continue; }
 
     snprintf(minStr, 10, "%d", min);
     if (min == 0) { continue; }
@@ -452,6 +669,13 @@ char* getQualificationQuery() {
     strcat(query, field);
     strcat(query, "` >= ");
     strcat(query, minStr);
+
+    // and for the rows of the feeds
+    if (qualificationLength < maxQualifications) {
+      strcpy(qualificationFields[qualificationLength], field);
+      qualificationMins[qualificationLength] = min;
+      qualificationLength++;
+    }
   }
 
   fclose(fp);
@@ -459,22 +683,364 @@ char* getQualificationQuery() {
   return query;
 }
 
-int generateAllIndices(char* qualificationQuery) {
+// Returns how many tables failed, which are the ones left set in slots
+int generateAllIndices(bool* slots, char* qualificationQuery, const char* run) {
   MYSQL *con = connectToMySQL();
 
   if (con == NULL)
-    return 1;
+    return tablesLength;
 
-  for (uint8_t slot = 0; slot < tablesLength; slot++)
-    if (generateIndices(con, slot, qualificationQuery))
+  int failed = 0;
+  for (uint8_t slot = 0; slot < tablesLength; slot++) {
+    if (!slots[slot]) continue;
+
+    if (generateIndices(con, slot, qualificationQuery, run)) {
       available[slot] = 1;
+      slots[slot] = false;
+    } else
+      failed++;
+  }
 
   mysql_close(con);
-  return 0;
+  return failed;
+}
+
+// A row that got or lost a value
+typedef struct {
+  int value;
+  int delta;
+} Change;
+
+typedef struct {
+  Change* items;
+  int length;
+  int size;
+} ChangeList;
+
+bool addChange(ChangeList* list, char* field, int delta) {
+  // rows without the stat aren't ranked (\N is NULL)
+  int value = atoi(field);
+  if (value <= 0) return true;
+
+  if (list->length == list->size) {
+    int size = list->size > 0 ? list->size * 2 : 1024;
+    Change* items = (Change*) realloc(list->items, size * sizeof(Change));
+    if (items == NULL) return false;
+
+    list->items = items;
+    list->size = size;
+  }
+
+  list->items[list->length].value = value;
+  list->items[list->length].delta = delta;
+  list->length++;
+  return true;
+}
+
+int compareChanges(const void* a, const void* b) {
+  int x = ((const Change*) a)->value;
+  int y = ((const Change*) b)->value;
+  // from the highest value
+  return (x < y) - (x > y);
+}
+
+// Generates the index of a stat from the current one and the changes of
+// a feed, in a single pass. Returns false if they don't match the index
+bool mergeChanges(int slot, int i, ChangeList* list) {
+  qsort(list->items, list->length, sizeof(Change), compareChanges);
+
+  int* values = statsStart[slot][i];
+  int* pos = statsPos[slot][i];
+  int length = statsEnd[slot][i] - values;
+  Change* changes = list->items;
+
+  int size = length + list->length;
+  int* newValues = (int*) malloc(max(size, 1) * sizeof(int));
+  int* newPos = (int*) malloc((size + 1) * sizeof(int));
+  genStatsStart[slot][i] = newValues;
+  genStatsPos[slot][i] = newPos;
+  if (newValues == NULL || newPos == NULL) return false;
+
+  int a = 0;
+  int b = 0;
+  int n = 0;
+  int total = 0;
+  while (a < length || b < list->length) {
+    int value;
+    if (b == list->length || (a < length && values[a] >= changes[b].value)) {
+      value = values[a];
+    } else {
+      value = changes[b].value;
+    }
+
+    int count = 0;
+    if (a < length && values[a] == value) {
+      count = pos[a + 1] - pos[a];
+      a++;
+    }
+    for (; b < list->length && changes[b].value == value; b++)
+      count += changes[b].delta;
+
+    if (count < 0) {
+      // removed rows that weren't there
+      printfd("%s of %s doesn't match its index\n", validStats[i], tables[slot]);
+      return false;
+    }
+    if (count == 0) continue;
+
+    newValues[n] = value;
+    newPos[n] = total;
+    total += count;
+    n++;
+  }
+
+  newPos[n] = total;
+  genStatsEnd[slot][i] = newValues + n;
+  return true;
+}
+
+// The columns of a table in a feed
+typedef struct {
+  int columns;
+  int disqualified;
+  int stats[statsLength];
+  int qualifications[maxQualifications];
+  bool known;
+} FeedTable;
+
+// Splits a line by tabs, in place. Returns the amount of fields
+int splitFields(char* line, char** fields, int size) {
+  int length = 0;
+  char* start = line;
+  while (length < size) {
+    fields[length++] = start;
+
+    char* tab = strchr(start, '\t');
+    if (tab == NULL) break;
+    *tab = '\0';
+    start = tab + 1;
+  }
+
+  char* newline = strchr(fields[length - 1], '\n');
+  if (newline != NULL) *newline = '\0';
+  return length;
 }
 
-void *generateAllIndicesThread(void *arg) {
-  generateAllIndices(globalQualificationQuery);
+void readColumns(FeedTable* table, char** fields, int length) {
+  table->columns = length - 2;
+  table->disqualified = -1;
+  for (int i = 0; i < statsLength; i++)
+    table->stats[i] = -1;
+  for (int q = 0; q < qualificationLength; q++)
+    table->qualifications[q] = -1;
+
+  for (int col = 0; col < table->columns; col++) {
+    const char* name = fields[col + 2];
+    if (strcmp(name, "disqualified") == 0)
+      table->disqualified = col;
+
+    int i = getStatIndex(name);
+    if (i != -1)
+      table->stats[i] = col;
+
+    for (int q = 0; q < qualificationLength; q++)
+      if (strcmp(name, qualificationFields[q]) == 0)
+        table->qualifications[q] = col;
+  }
+  table->known = true;
+}
+
+// Whether the values of a row starting at the given field are ranked
+bool isRanked(FeedTable* table, char** values) {
+  if (table->disqualified != -1 && strcmp(values[table->disqualified], "1") == 0)
+    return false;
+
+  for (int q = 0; q < qualificationLength; q++) {
+    int col = table->qualifications[q];
+    if (col != -1 && atoi(values[col]) < qualificationMins[q])
+      return false;
+  }
+  return true;
+}
+
+// Applies the changes of a run to the indices. Returns false if they all
+// have to be generated again, or sets rebuild for the tables that do.
+// run is set to the run of the feed if it could be read.
+bool applyFeed(const char* path, bool* rebuild, char** run) {
+  FILE* fp = fopen(path, "r");
+  if (fp == NULL) {
+    printfd("could not open feed %s\n", path);
+    return false;
+  }
+
+  bool success = false;
+  ChangeList changes[feedTablesLength][statsLength];
+  memset(changes, 0, sizeof(changes));
+  FeedTable feedTables[feedTablesLength];
+  memset(feedTables, 0, sizeof(feedTables));
+
+  char* line = NULL;
+  size_t len = 0;
+  int size = 0;
+  char** fields = NULL;
+  long long rows = 0;
+  bool ended = false;
+
+  // feed <version> <run> <previous run>
+  if (getline(&line, &len, fp) == -1) goto done;
+  char* header[4];
+  if (splitFields(line, header, 4) != 4 || strcmp(header[0], "feed") != 0 ||
+      atoi(header[1]) != feedVersion) {
+    printfd("feed %s has an unknown format\n", path);
+    goto done;
+  }
+
+  *run = strdup(header[2]);
+  if (lastRun == NULL || strcmp(header[3], lastRun) != 0) {
+    printfd("feed %s doesn't follow run %s\n", path, lastRun ? lastRun : "(none)");
+    goto done;
+  }
+
+  for (int slot = 0; slot < feedTablesLength; slot++)
+    if (!available[slot]) goto done;
+
+  while (getline(&line, &len, fp) != -1) {
+    if (size < (int) len) {
+      // a line never has more fields than characters
+      size = len;
+      free(fields);
+      fields = (char**) malloc(size * sizeof(char*));
+      if (fields == NULL) goto done;
+    }
+    int length = splitFields(line, fields, size);
+
+    if (strcmp(fields[0], "end") == 0) {
+      ended = length == 2 && atoll(fields[1]) == rows;
+      break;
+    }
+
+    if (length < 2) continue;
+    bool isColumns = strcmp(fields[0], "columns") == 0;
+    if (isColumns || strcmp(fields[0], "rebuild") == 0) {
+      int slot = getTableSlot(fields[1]);
+      if (slot == -1 || slot >= feedTablesLength) continue;
+
+      if (isColumns)
+        readColumns(&feedTables[slot], fields, length);
+      else
+        rebuild[slot] = true;
+      continue;
+    }
+
+    // <table> <kind> <id> <old values> <new values>
+    rows++;
+    int slot = getTableSlot(fields[0]);
+    if (slot == -1 || slot >= feedTablesLength || rebuild[slot]) continue;
+
+    FeedTable* table = &feedTables[slot];
+    if (!table->known || length != 3 + 2 * table->columns) {
+      printfd("feed %s has a malformed %s row\n", path, tables[slot]);
+      goto done;
+    }
+
+    char** old = fields + 3;
+    char** new = fields + 3 + table->columns;
+    bool oldRanked = isRanked(table, old);
+    bool newRanked = isRanked(table, new);
+
+    for (int i = 0; i < statsLength; i++) {
+      int col = table->stats[i];
+      if (col == -1) continue;
+
+      if ((oldRanked && !addChange(&changes[slot][i], old[col], -1)) ||
+          (newRanked && !addChange(&changes[slot][i], new[col], 1))) {
+        fprintf(stderr, "failed to allocate memory for changes.\n");
+        goto done;
+      }
+    }
+  }
+
+  if (!ended) {
+    printfd("feed %s is incomplete\n", path);
+    goto done;
+  }
+
+  // indices are generated again every RANK_REBUILD_HOURS anyway, in case
+  // they drifted. It is a week by default: runs are daily, and a rebuild
+  // every day or so would make applying feeds pointless
+  const char* rebuildStr = getenvdef("RANK_REBUILD_HOURS", "168");
+  const double rebuildAfter = atof(rebuildStr) * 3600;
+  for (int slot = 0; slot < feedTablesLength; slot++) {
+    if (rebuild[slot]) continue;
+
+    if (difftime(time(NULL), generatedAt[slot]) > rebuildAfter) {
+      printfd("indices for %s are due for a rebuild\n", tables[slot]);
+      rebuild[slot] = true;
+      continue;
+    }
+
+    if (!allocateParentArrays(slot)) {
+      rebuild[slot] = true;
+      continue;
+    }
+
+    for (int i = 0; i < statsLength && !rebuild[slot]; i++)
+      if (!mergeChanges(slot, i, &changes[slot][i]))
+        rebuild[slot] = true;
+
+    if (rebuild[slot]) {
+      freeGeneratedIndices(slot);
+      continue;
+    }
+
+    saveIndices(slot, *run);
+    moveGeneratedIndices(slot);
+    printfd("feed applied to indices for %s\n", tables[slot]);
+  }
+  success = true;
+
+done:
+  for (int slot = 0; slot < feedTablesLength; slot++)
+    for (int i = 0; i < statsLength; i++)
+      free(changes[slot][i].items);
+  free(fields);
+  free(line);
+  fclose(fp);
+  return success;
+}
+
+void *updateIndicesThread(void *arg) {
+  char* path = (char*) arg;
+  char* run = NULL;
+  bool rebuild[tablesLength];
+
+  for (int slot = 0; slot < tablesLength; slot++) {
+    outdated[slot] = 1;
+    // period tables are written from scratch every run
+    rebuild[slot] = slot >= feedTablesLength;
+  }
+
+  if (path == NULL || !applyFeed(path, rebuild, &run)) {
+    for (int slot = 0; slot < feedTablesLength; slot++)
+      rebuild[slot] = true;
+  }
+
+  generateAllIndices(rebuild, globalQualificationQuery, run);
+  for (int slot = 0; slot < feedTablesLength; slot++) {
+    if (rebuild[slot]) {
+      // stale indices can't be updated by the next feed
+      free(run);
+      run = NULL;
+      break;
+    }
+  }
+
+  // otherwise, the indices now reflect the run of the feed
+  free(lastRun);
+  lastRun = run;
+  free(path);
+
+  updating = 0;
   return NULL;
 }
 
@@ -484,22 +1050,35 @@ void *bootModule(void *arg) {
 
   uint8_t slot;
   int error = -1;
+  bool allocated = false;
+  // indices can only be updated by feeds if all of them saw the same run
+  char generation[sizeof(((IndexHeader*) 0)->generation)] = "";
+  bool sameGeneration = true;
   for (slot = 0; slot < tablesLength; slot++) {
     // try to load indices from disk first
-    if (!allocateParentArrays(slot)) {
+    allocated = allocateParentArrays(slot);
+    if (!allocated) {
       error = 0;
     } else {
-      const char* path = getenvdef("INDEX_SAVE", "/data/rank_%s_index%d.bin");
-      printfd("loading indices from %s\n", path);
+      printfd("loading indices for %s\n", tables[slot]);
       for (int i = 0; i < statsLength; i++) {
         char buffer[256];
-        sprintf(buffer, path, tables[slot], i);
+        indexPath(buffer, slot, i);
 
-        if (!loadIndex(slot, i, buffer)) {
+        IndexHeader header;
+        if (!loadIndex(slot, i, buffer, &header)) {
           printfd("could not load indices, starting index generation\n");
           error = i;
           break;
         }
+
+        if (slot == 0 && i == 0)
+          memcpy(generation, header.generation, sizeof(generation));
+        else if (memcmp(generation, header.generation, sizeof(generation)) != 0)
+          sameGeneration = false;
+
+        if (generatedAt[slot] == 0 || header.generatedAt < generatedAt[slot])
+          generatedAt[slot] = header.generatedAt;
       }
     }
 
@@ -515,23 +1094,35 @@ void *bootModule(void *arg) {
 
   if (error > -1) {
     // gotta free what we already had
-    for (int i = 0; i < error; i++)
-      free(genStatsStart[slot][i]);
-
-    free(genStatsStart[slot]);
-    free(genStatsEnd[slot]);
+    if (allocated)
+      freeGeneratedIndices(slot);
 
     // and generate indices
-    generateAllIndices(globalQualificationQuery);
+    bool slots[tablesLength];
+    for (slot = 0; slot < tablesLength; slot++)
+      slots[slot] = true;
+    generateAllIndices(slots, globalQualificationQuery, NULL);
   } else {
     printfd("all indices loaded successfully\n");
+
+    generation[sizeof(generation) - 1] = '\0';
+    if (sameGeneration && generation[0] != '\0') {
+      printfd("indices are up to date with run %s\n", generation);
+      lastRun = strdup(generation);
+    }
   }
 
   didBoot = 1;
   return NULL;
 }
 
+/* RANKING.UPDATEDONE [feed] */
+// Tells that the database got updated. With the change feed of the run,
+// indices are updated from it instead of generated again.
 int cmd_UPDATEDONE(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
+  if (argc > 2)
+    return RedisModule_WrongArity(ctx);
+
   const char* channelStr = "broadcast:update";
   const char* messageStr = "done";
 
@@ -541,8 +1132,18 @@ int cmd_UPDATEDONE(RedisModuleCtx *ctx, RedisModuleString **argv, int argc) {
   RedisModule_FreeString(ctx, channel);
   RedisModule_FreeString(ctx, message);
 
-  if (didBoot == 1) {
-    pthread_create(&generatorThreadId, NULL, generateAllIndicesThread, NULL);
+  if (didBoot == 1 && updating == 0) {
+    char* path = NULL;
+    if (argc == 2) {
+      size_t len;
+      path = strdup(RedisModule_StringPtrLen(argv[1], &len));
+    }
+
+    updating = 1;
+    pthread_create(&generatorThreadId, NULL, updateIndicesThread, path);
+  } else if (updating == 1) {
+    // the feed chain breaks, so the next update rebuilds everything
+    printfd("indices are still being updated, skipping this update\n");
   }
 
   return RedisModule_ReplyWithLongLong(ctx, 1);
@@ -579,6 +1180,8 @@ int RedisModule_OnLoad(RedisModuleCtx *ctx, RedisModuleString **argv, int argc)
   if (RedisModule_Init(ctx, "ranking", 1, REDISMODULE_APIVER_1) == REDISMODULE_ERR)
     return REDISMODULE_ERR;
 
+  setupCrc();
+
   if (RedisModule_CreateCommand(ctx, "ranking.getpos",
       cmd_GETPOS, "readonly", 1, 1, 1) == REDISMODULE_ERR)
     return REDISMODULE_ERR;
@@ -602,4 +1205,4 @@ int RedisModule_OnUnload(RedisModuleCtx *ctx) {
   REDISMODULE_NOT_USED(ctx);
   onShutdown();
   return REDISMODULE_OK;
-}
\ No newline at end of file
+}
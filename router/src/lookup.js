@@ -5,6 +5,7 @@ const {
 	service,
 	getPagination,
 	writeError,
+	normalizeName,
 	rankableFields,
 	handleServiceError,
 	handleBasicServiceResult,
@@ -152,6 +153,44 @@ function lookup(what) {
 router.get("/players", lookup("player"));
 router.get("/tribes", lookup("tribe"));
 
+function batch(what) {
+	// Basic information and stats of several players or tribes at once
+	return (req, res) => {
+		let { ids, names } = req.body;
+		ids = ids || [];
+		names = names || [];
+
+		if (!Array.isArray(ids) || !Array.isArray(names)) {
+			return writeError(res, 400, "'ids' and 'names' must be lists");
+		}
+
+		for (var i = 0; i < ids.length; i++) {
+			if (!Number.isInteger(ids[i])) {
+				return writeError(res, 400, `Invalid ID: ${ids[i]}`);
+			}
+		}
+
+		for (var i = 0; i < names.length; i++) {
+			if (typeof names[i] !== "string" || !names[i]) {
+				return writeError(res, 400, `Invalid name: ${names[i]}`);
+			}
+
+			if (what === "player") {
+				names[i] = normalizeName(names[i]);
+			}
+		}
+
+		// The lookup service enforces the size limit (BATCH_LIMIT)
+		service.request("lookup", "batch", {
+			what,
+			ids,
+			names,
+		}, handleBasicServiceResult(res));
+	};
+}
+router.post("/players/batch", batch("player"));
+router.post("/tribes/batch", batch("tribe"));
+
 router.get("/position/:field", (req, res) => {
 	let { field } = req.params;
 	let { entity, value } = req.query;
@@ -3,6 +3,7 @@ from .exceptions import ServiceUnavailable, ServiceError, \
 	UnknownRejection, InvalidEventName
 from .request import Request
 from .response import SimpleResponse, StreamResponse
+from .cache import ResponseCache
 
 
 __all__ = [
@@ -11,4 +12,5 @@ __all__ = [
 	"UnknownRejection", "InvalidEventName",
 	"Request",
 	"SimpleResponse", "StreamResponse",
+	"ResponseCache",
 ]
@@ -0,0 +1,57 @@
+import json
+import time
+
+from collections import OrderedDict
+
+
+# Fields of a request message that aren't arguments
+envelope = ("source", "worker", "type", "request_id", "request_type")
+
+
+class ResponseCache:
+	"""Least recently used cache of serialized responses, which expire
+	after ttl seconds. Responses that were being computed while the
+	cache got cleared are not stored.
+	"""
+
+	def __init__(self, size, ttl):
+		self.size = size
+		self.ttl = ttl
+		self.entries = OrderedDict()  # key: (expires at, response)
+		self.generation = 0
+
+	def clear(self):
+		self.entries.clear()
+		self.generation += 1
+
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is None:
+			return None
+
+		expires, response = entry
+		if time.monotonic() >= expires:
+			del self.entries[key]
+			return None
+
+		self.entries.move_to_end(key)
+		return json.loads(response)
+
+	def put(self, key, content, generation):
+		if generation != self.generation:
+			return
+
+		self.entries[key] = (time.monotonic() + self.ttl, json.dumps(content))
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+
+
+def request_key(request, ignore=()):
+	"""Returns the cache key of a request: its type and its arguments"""
+	args = {
+		name: value
+		for name, value in request.msg.items()
+		if name not in envelope and name not in ignore
+	}
+	return "{}:{}".format(request.type, json.dumps(args, sort_keys=True))
@@ -5,6 +5,7 @@ import uuid
 import signal
 import asyncio
 import inspect
+import functools
 import logging
 import traceback
 import multiprocessing as mp
@@ -15,6 +16,7 @@ from .exceptions import ServiceUnavailable, ServiceError, \
 	UnknownRejection, InvalidEventName
 from .request import Request
 from .response import SimpleResponse, StreamResponse
+from .cache import ResponseCache, request_key
 
 
 logger = logging.getLogger("service")
@@ -27,6 +29,11 @@ class config:
 	host = os.getenv("INFRA_ADDR", "redis:6379")
 	reconnect = float(os.getenv("INFRA_RECONNECT", "10"))
 
+	cache_size = int(os.getenv("CACHE_SIZE", "1024"))
+	cache_ttl = float(os.getenv("CACHE_TTL", "600"))
+	# broadcasts that make cached responses stale
+	cache_invalidate = ("update", "roles", "privacy")
+
 
 def worker_start(
 	worker, workers,
@@ -70,6 +77,7 @@ class Service:
 		# Request data
 		self.success = 0
 		self.errors = 0
+		self.cache = ResponseCache(config.cache_size, config.cache_ttl)
 
 		if ":" in config.host:
 			address = config.host.split(":")
@@ -112,6 +120,40 @@ class Service:
 			return handler
 		return decorator
 
+	def cached(self, ignore=(), bypass=None):
+		"""Decorator that caches the responses of a request handler,
+		by request type and arguments (except the ones in ignore), until
+		the data changes. If bypass(request) is true, the request skips
+		the cache. Rejections, errors and streams aren't cached.
+		"""
+		def decorator(handler):
+			@functools.wraps(handler)
+			async def wrapper(request):
+				if bypass is not None and bypass(request):
+					return await handler(request)
+
+				cache = request.service.cache
+				key = request_key(request, ignore)
+				response = cache.get(key)
+				if response is not None:
+					await request.send(response)
+					return
+
+				generation = cache.generation
+				send = request.send
+
+				async def send_and_store(content):
+					if not request.streaming:
+						cache.put(key, content, generation)
+					await send(content)
+
+				request.send = send_and_store
+				await handler(request)
+
+			wrapper.cached = True
+			return wrapper
+		return decorator
+
 	def event(self, handler):
 		method_name = handler.__name__
 		if method_name.startswith("on_"):
@@ -281,6 +323,9 @@ class Service:
 
 	def on_channel_message(self, channel, msg):
 		if channel.startswith("broadcast:"):
+			if channel[10:] in config.cache_invalidate:
+				self.cache.clear()
+
 			self.dispatch("broadcast", channel[10:], msg)
 			return
 
@@ -401,6 +446,13 @@ class Service:
 		await self.redis.subscribe(self.my_channel)
 		await self.redis.subscribe("service:healthcheck")
 
+		if any(
+			getattr(handler, "cached", False)
+			for handler in self.request_handlers.values()
+		):
+			for broadcast in config.cache_invalidate:
+				await self.listen_broadcast(broadcast)
+
 		await self.dispatch("boot", self)
 		self.running = True
 
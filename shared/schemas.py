@@ -172,6 +172,21 @@ schemas = {
 		"stats": Require("AllStats"),
 	},
 
+	"BatchPlayer": {
+		"__inherit": "BasicPlayer",
+
+		"stats": Require("MouseStats"),
+		"score": Require("ScoreStats", "score_"),
+	},
+
+	"BatchTribe": {
+		"__inherit": "BasicTribe",
+
+		"members": Require("TribeMemberCount"),
+		"stats": Require("MouseStats"),
+		"score": Require("ScoreStats", "score_"),
+	},
+
 	"Privacy": {
 		"soulmate": Field("soulmate", False),
 		"tribe": Field("tribe", False),
@@ -0,0 +1,116 @@
+import logging
+
+from scoring import Scorer
+
+
+def replace_query(columns, score_columns):
+	"""Builds the query that writes tribe_stats rows with their scores"""
+	return (
+		"REPLACE INTO `tribe_stats` (`{}`) VALUES ({})"
+		.format(
+			"`,`".join(columns + score_columns),
+			",".join(["%s"] * (len(columns) + len(score_columns)))
+		)
+	)
+
+
+def touched_query(changed_disq):
+	"""Builds a query that returns the tribes a player whose stats,
+	membership or disqualification changed in this run is or was in.
+	"""
+	touched = [
+		"SELECT `id` FROM `player_new`",
+		"SELECT `id` FROM `player_old`",
+		"SELECT `id_member` FROM `member_new`",
+		"SELECT `id_member` FROM `member_old`",
+	]
+	if changed_disq:
+		touched.append(
+			"SELECT `id` FROM `player` WHERE `id` IN ({})"
+			.format(",".join(map(str, changed_disq)))
+		)
+
+	return (
+		"SELECT `id_tribe` FROM `member` WHERE `id_member` IN ({touched}) \
+		UNION \
+		SELECT `id_tribe` FROM `member_old` WHERE `id_member` IN ({touched})"
+		.format(touched=" UNION ".join(touched))
+	)
+
+
+def members_query(columns, tribes):
+	"""Builds a query that counts the members and active members of the
+	given tribes, and sums their stats, the same way the full path does:
+	only the members that have stats and aren't disqualified.
+	"""
+	return (
+		"SELECT \
+			`m`.`id_tribe`, \
+			COUNT(*), \
+			COUNT(`pn`.`id`), \
+			{sums} \
+		FROM \
+			`member` as `m` \
+			INNER JOIN `player` as `p` ON `p`.`id` = `m`.`id_member` \
+			LEFT JOIN `disqualified` as `d` ON `d`.`id` = `p`.`id` \
+			LEFT JOIN `player_new` as `pn` ON `pn`.`id` = `p`.`id` \
+		WHERE `d`.`id` IS NULL AND `m`.`id_tribe` IN ({tribes}) \
+		GROUP BY `m`.`id_tribe`"
+		.format(
+			sums=",".join("SUM(`p`.`{}`)".format(col) for col in columns),
+			tribes=",".join(map(str, tribes)),
+		)
+	)
+
+
+async def aggregate_tribes(player, stats, conn, batch=1000):
+	"""Calculates tribe_stats again for the tribes affected by this run
+	only. Returns (id, members, active) for every tribe written, even the
+	ones without active members.
+	"""
+	columns = [
+		column
+		for column in stats.columns
+		if column not in ("id", "members", "active")
+	]
+	changed_disq = set()
+	if player.disqualified is not None:
+		before, after = player.disqualified
+		changed_disq = before ^ after
+
+	write_columns = ["id", "members", "active"] + columns
+	scorer = Scorer(write_columns, stats.score_columns)
+	query = replace_query(write_columns, stats.score_columns)
+
+	written = []
+	async with conn.cursor() as cursor:
+		logging.debug("[tribe] finding affected tribes")
+		await cursor.execute(touched_query(changed_disq))
+		tribes = [row[0] for row in await cursor.fetchall()]
+		logging.debug("[tribe] updating {} tribes".format(len(tribes)))
+
+		# Old stats are needed to calculate periods
+		await cursor.execute("TRUNCATE `tribe_stats_old`")
+
+		for start in range(0, len(tribes), batch):
+			chunk = tribes[start:start + batch]
+
+			await cursor.execute(
+				"INSERT INTO `tribe_stats_old` \
+				SELECT * FROM `tribe_stats` WHERE `id` IN ({})"
+				.format(",".join(map(str, chunk)))
+			)
+
+			await cursor.execute(members_query(columns, chunk))
+			counted = {row[0]: row for row in await cursor.fetchall()}
+
+			rows = []
+			for tribe in chunk:
+				# A tribe whose members all left has no row here
+				row = counted.get(tribe, (tribe, 0, 0) + (0,) * len(columns))
+				written.append(row[:3])
+				rows.append(row)
+
+			await cursor.executemany(query, scorer.apply(rows))
+
+	return written
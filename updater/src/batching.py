@@ -0,0 +1,70 @@
+import math
+
+
+class BatchSize:
+	"""The batch size of a pipeline stage.
+
+	When bounds are given, the size follows the throughput of the stage:
+	every WINDOW round trips it is moved a STEP in the same direction if
+	rows per second got better, or the other way if they got worse. A
+	single round trip slower than max_latency shrinks it right away.
+	"""
+
+	WINDOW = 8  # round trips per decision
+	STEP = 1.25
+
+	def __init__(self, size, bounds=None, max_latency=2.0):
+		self.bounds = bounds
+		self.max_latency = max_latency
+
+		self.value = size
+		if bounds is not None:
+			self.value = min(max(size, bounds[0]), bounds[1])
+
+		self.direction = 1
+		self.last = None  # rows per second of the previous window
+
+		self.rows = 0
+		self.time = 0.0
+		self.samples = 0
+
+	def record(self, rows, elapsed):
+		"""Records a round trip of the given amount of rows"""
+		if self.bounds is None:
+			return
+
+		if elapsed > self.max_latency:
+			self.direction = -1
+			self.resize()
+			return
+
+		self.rows += rows
+		self.time += elapsed
+		self.samples += 1
+		if self.samples < self.WINDOW or self.time <= 0:
+			return
+
+		throughput = self.rows / self.time
+		if self.last is not None and throughput < self.last:
+			self.direction = -self.direction
+		self.last = throughput
+
+		self.resize()
+
+	def resize(self):
+		if self.direction > 0:
+			size = math.ceil(self.value * self.STEP)
+		else:
+			size = math.floor(self.value / self.STEP)
+
+		low, high = self.bounds
+		size = min(max(size, low), high)
+		if size == self.value:
+			# Hit a bound, try the other way next time
+			self.direction = -self.direction
+		self.value = size
+
+		# Sizes aren't comparable, start a new window
+		self.rows = 0
+		self.time = 0.0
+		self.samples = 0
@@ -0,0 +1,60 @@
+import os
+import tempfile
+
+
+ESCAPES = str.maketrans({
+	"\\": "\\\\",
+	"\t": "\\t",
+	"\n": "\\n",
+	"\r": "\\r",
+	"\0": "\\0",
+})
+
+
+def tsv_value(value):
+	if value is None:
+		return "\\N"
+	if isinstance(value, bytes):
+		value = value.decode("utf-8", "replace")
+	if isinstance(value, str):
+		return value.translate(ESCAPES)
+	return str(value)
+
+
+class BulkLoader:
+	"""Writes batches of rows with LOAD DATA LOCAL INFILE instead of a
+	REPLACE query. Every batch is dumped as TSV to a local file that the
+	client then streams to the server, so rows don't have to be turned
+	into SQL literals one by one.
+
+	Both the connection and the server must allow local_infile.
+	"""
+
+	def __init__(self, table, columns):
+		fd, self.path = tempfile.mkstemp(
+			prefix="{}-".format(table), suffix=".tsv"
+		)
+		os.close(fd)
+
+		self.query = (
+			"LOAD DATA LOCAL INFILE '{}' \
+			REPLACE INTO TABLE `{}` \
+			CHARACTER SET utf8mb4 \
+			FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' \
+			LINES TERMINATED BY '\\n' \
+			(`{}`)"
+			.format(self.path, table, "`,`".join(columns))
+		)
+
+	async def write(self, cursor, rows):
+		with open(self.path, "w", encoding="utf-8") as file:
+			file.writelines(
+				"\t".join(map(tsv_value, row)) + "\n"
+				for row in rows
+			)
+
+		await cursor.execute(self.query)
+
+	def close(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+
+from bisect import bisect_right
+from datetime import datetime
+
+
+class TableProgress:
+	"""How far the extraction of a table got.
+
+	stage is one of:
+	- None: nothing done yet
+	- "extract": the pipelines are running. progress holds, per shard,
+	the last primary key written to the database (or None), and deleted
+	the rows found to be deleted so far.
+	- "post_download": every row is downloaded, data is being published
+	- "done": the table is published
+	"""
+
+	def __init__(self, data=None):
+		data = data or {}
+		self.stage = data.get("stage")
+		self.initial = data.get("initial", False)
+		self.shards = data.get("shards", [None])
+		self.progress = data.get("progress", [None])
+		self.deleted = data.get("deleted", [])
+		self.logs = data.get("logs")
+
+	def to_dict(self):
+		return {
+			"stage": self.stage,
+			"initial": self.initial,
+			"shards": self.shards,
+			"progress": self.progress,
+			"deleted": self.deleted,
+			"logs": self.logs,
+		}
+
+	@property
+	def resumed(self):
+		return self.stage is not None
+
+	def begin(self, initial, shards):
+		self.stage = "extract"
+		self.initial = initial
+		self.shards = shards
+		self.progress = [None] * len(shards)
+		self.deleted = []
+		self.logs = None
+
+	def remaining(self):
+		"""Returns the part of every shard that still has to be
+		extracted.
+		"""
+		shards = []
+		for shard, last in zip(self.shards, self.progress):
+			if last is None:
+				shards.append(shard)
+			elif shard is None:
+				shards.append([last + 1, None])
+			else:
+				shards.append([last + 1, shard[1]])
+		return shards
+
+	def advance(self, ids):
+		"""Marks the rows with the given primary keys as written. Rows
+		of a shard are written in order, so the last key of every shard
+		is its new resume point.
+		"""
+		starts = [
+			float("-inf") if shard is None or shard[0] is None else shard[0]
+			for shard in self.shards
+		]
+
+		for _id in ids:
+			idx = bisect_right(starts, _id) - 1
+			if self.progress[idx] is None or self.progress[idx] < _id:
+				self.progress[idx] = _id
+
+	def delete(self, ids):
+		"""Records rows that are gone from the external table. A resumed
+		run doesn't compare the rows before its resume point again, so
+		it wouldn't find them otherwise.
+		"""
+		self.deleted.extend(map(int, ids))
+
+
+class Checkpoint:
+	"""Progress of an updater run, stored in a JSON file so a run that
+	died halfway can be resumed instead of starting over.
+
+	With no path, nothing is stored. attempts counts how many times the
+	run was resumed, so one that keeps failing can be given up on.
+	"""
+
+	def __init__(self, path=None, interval=30):
+		self.path = path
+		self.interval = interval  # min seconds between saves
+		self.last_save = 0
+
+		self.run = None
+		self.attempts = 0
+		self.tables = {}
+
+	@property
+	def exists(self):
+		return self.path is not None and os.path.exists(self.path)
+
+	def load(self):
+		with open(self.path, "r") as file:
+			data = json.load(file)
+
+		self.run = data["run"]
+		self.attempts = data.get("attempts", 0)
+		self.tables = {
+			name: TableProgress(table)
+			for name, table in data["tables"].items()
+		}
+
+	def start(self):
+		if self.path is not None:
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+		self.run = datetime.now().strftime("%Y%m%d%H%M%S")
+		self.attempts = 0
+		self.tables = {}
+		self.save(force=True)
+
+	def table(self, name):
+		if name not in self.tables:
+			self.tables[name] = TableProgress()
+		return self.tables[name]
+
+	def save(self, force=False):
+		if self.path is None:
+			return
+
+		now = time.monotonic()
+		if not force and now - self.last_save < self.interval:
+			return
+		self.last_save = now
+
+		tmp = self.path + ".tmp"
+		with open(tmp, "w") as file:
+			json.dump({
+				"run": self.run,
+				"attempts": self.attempts,
+				"tables": {
+					name: table.to_dict()
+					for name, table in self.tables.items()
+				},
+			}, file)
+
+			file.flush()
+			os.fsync(file.fileno())
+
+		os.replace(tmp, self.path)
+
+	def finish(self):
+		"""The run is done, there is nothing to resume anymore"""
+		if self.exists:
+			os.remove(self.path)
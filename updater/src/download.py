@@ -1,10 +1,20 @@
+import os
 import sys
-import math  # DEBUG!
+import math
+import time
 import asyncio
 import logging
+import traceback
 
 from utils import env, with_cursors
-from formulas import overall_scores
+from scoring import Scorer
+from snapshot import HashSnapshot, SnapshotWriter
+from checkpoint import Checkpoint
+from metrics import TableMetrics
+from batching import BatchSize
+from bulk import BulkLoader
+from fetching import RowFetcher
+from workers import Window, diff_batch, strip_hashes, score_rows
 
 
 PROGRESS = 5  # show progress every 5%
@@ -24,62 +34,304 @@ def fetch_columns(columns):
 	return result
 
 
+def hash_column(table):
+	crc_columns = filter(
+		lambda col: col != "registration_date",
+		table.columns
+	)
+	return "CRC32(CONCAT_WS('', `{}`))".format("`,`".join(crc_columns))
+
+
+def shard_condition(column, shard):
+	if shard is None:
+		return ""
+
+	start, end = shard
+	conditions = []
+	if start is not None:
+		conditions.append("`{}` >= {}".format(column, start))
+	if end is not None:
+		conditions.append("`{}` < {}".format(column, end))
+
+	if not conditions:
+		return ""
+	return " WHERE " + " AND ".join(conditions)
+
+
 class RunnerPool:
-	def __init__(self, pipe, batch, cfm, a801):
+	def __init__(
+		self, pipe, batch, cfm, a801, *,
+		shards=1, checkpoint=None, stage_batches=None, batch_bounds=None,
+		bulk_tables=(), fetch_join=None, swap_tables=(), executor=None,
+		window=1
+	):
 		self.pipe = pipe  # pipe max size
 		self.batch = batch  # batch size
+		self.shards = shards  # parallel pipelines per table
+		# initial batch size of the database stages (grab, fetch, update)
+		self.stage_batches = stage_batches or {}
+		# (min, max) batch sizes, or None to keep them fixed
+		self.batch_bounds = batch_bounds
+		self.batch_sizes = {}
+		# tables written with LOAD DATA LOCAL INFILE instead of REPLACE
+		self.bulk_tables = bulk_tables
+		# fetch batches with at least these ids join a temporary table
+		self.fetch_join = fetch_join
+		# tables published by swapping in a rebuilt copy
+		self.swap_tables = swap_tables
+		# process pool for the CPU heavy stages, and how many batches
+		# every stage may have in it at once
+		self.executor = executor
+		self.window = window
+		# run progress, nothing is stored by default
+		self.checkpoint = checkpoint or Checkpoint()
+		self.metrics = {}  # table name -> TableMetrics
 
 		self.internal = cfm
 		self.external = a801
 
+	@with_cursors("external")
+	async def shard_ranges(self, exte, table):
+		"""Splits the table in primary key ranges, one per pipeline.
+		Returns [None] when the table is not going to be sharded.
+		"""
+		if self.shards <= 1:
+			return [None]
+
+		await exte.execute(
+			"SELECT MIN(`{0}`), MAX(`{0}`) FROM `{1}`"
+			.format(table.primary, table.name)
+		)
+		row = await exte.fetchone()
+		await exte.fetchone()
+
+		if row[0] is None:
+			# Empty table, nothing to split
+			return [None]
+
+		low, high = row[0], row[1] + 1
+		step = max(1, math.ceil((high - low) / self.shards))
+
+		shards = []
+		for start in range(low, high, step):
+			shards.append([start, min(start + step, high)])
+
+		# Leave both ends open, so rows that only exist in our
+		# database are still seen (and deleted)
+		shards[0][0] = None
+		shards[-1][1] = None
+
+		logging.debug(
+			"[{}] using {} shards of {} ids"
+			.format(table.name, len(shards), step)
+		)
+		return shards
+
 	async def extract(self, table):
 		if table.primary is None:
 			# We need table information
 			await table.extract_info(self.internal, env.cfm_db)
 
+		progress = self.checkpoint.table(table.name)
+		resumed = progress.resumed
+		if resumed:
+			# The table had data from the crashed run, not from before it
+			table.is_empty = progress.initial
+
+		if progress.stage == "done":
+			logging.info(
+				"[{}] already published in this run".format(table.name)
+			)
+			if progress.logs:
+				table.log_range = tuple(progress.logs)
+			return
+
 		logging.debug("start data extraction for table {}".format(table.name))
 
+		snapshot = HashSnapshot(self.snapshot_path(table))
+		if resumed:
+			logging.info(
+				"[{}] resuming run {} ({})"
+				.format(table.name, self.checkpoint.run, progress.stage)
+			)
+
+		elif not table.is_empty:
+			await self.truncate_temporary(table)
+
+		extracting = progress.stage in (None, "extract")
+		if extracting and not table.is_empty:
+			try:
+				snapshot.validate()
+			except (OSError, ValueError) as exc:
+				# Missing, or cut short by a crash or a full disk
+				logging.warning(
+					"[{}] bad hashes file: {}".format(table.name, exc)
+				)
+				await self.rebuild_snapshot(table)
+
+		if not resumed:
+			progress.begin(table.is_empty, await self.shard_ranges(table))
+			self.checkpoint.save(force=True)
+
+		writer = SnapshotWriter(snapshot.path)
+		if progress.stage == "extract":
+			if progress.deleted:
+				# Found before the crash, maybe not deleted yet
+				await self.delete_rows(
+					table, list(map(str, progress.deleted))
+				)
+
+			if not await self.run_pipelines(
+				table, progress.remaining(), snapshot, writer
+			):
+				# The next run will resume from the checkpoint
+				return
+
+			progress.stage = "post_download"
+			self.checkpoint.save(force=True)
+
+		if table.name == "player":
+			try:
+				table.disqualified = await self.update_disqualifications()
+			except Exception:
+				traceback.print_exc()
+
+			if resumed:
+				# Changes made before the crash are unknown, so tribes
+				# have to be fully recalculated
+				table.disqualified = None
+		await self.post_download(table)
+
+		# Data is already published, so the new hashes are valid
+		snapshot.close()
+		if resumed:
+			# Rows handled before the crash are missing from the parts
+			writer.discard()
+			await self.rebuild_snapshot(table)
+		else:
+			writer.commit()
+
+		progress.stage = "done"
+		self.checkpoint.save(force=True)
+
+		logging.info("[{}] done updating".format(table.name))
+
+	async def run_pipelines(self, table, shards, snapshot, writer):
+		"""Runs the extraction pipelines of every shard. Returns whether
+		all of them succeeded.
+		"""
+		metrics = self.table_metrics(table)
+
+		# Every pipeline writes to the same sink
+		sink = metrics.pipe("update", asyncio.Queue(maxsize=self.pipe))
+		tasks = [
+			self.update_loop(
+				table, inp=sink, out=None, producers=len(shards)
+			),
+		]
+
+		if table.score_columns:
+			# Rows go through the score loop before being written
+			update = sink
+			sink = metrics.pipe("score", asyncio.Queue(maxsize=self.pipe))
+			tasks.append(self.score_loop(
+				table, inp=sink, out=update, producers=len(shards)
+			))
+
 		if table.is_empty:
 			logging.debug("table is empty, using fetch-update process")
 
-			# If the table is empty, we have no hashes to compare
-			pipes = [
-				asyncio.Queue(maxsize=self.pipe)
-				for p in range(3)
-			]
-
-			done, pending = await asyncio.wait((
-				self.grab_loop(table, inp=None, out=pipes[0], grab_all=True),
-				self.fetch_loop(
-					table, inp=pipes[0], out=pipes[1], out2=pipes[2], grab_all=True
-				),
-				self.update_loop(table, inp=pipes[1], out=None),
-				self.hash_loop(table, inp=pipes[2], out=None),
-			), return_when=asyncio.FIRST_EXCEPTION)
+			for idx, shard in enumerate(shards):
+				# If the table is empty, we have no hashes to compare
+				pipe = metrics.pipe(
+					"grab:{}".format(idx), asyncio.Queue(maxsize=self.pipe)
+				)
+
+				tasks.extend((
+					self.grab_loop(
+						table, inp=None, out=pipe,
+						grab_all=True, shard=shard
+					),
+					self.fetch_loop(
+						table, inp=pipe, out=sink,
+						grab_all=True, snapshot=writer.part()
+					),
+				))
+
+		elif self.executor is not None:
+			logging.debug(
+				"table contains old data, diffing in worker processes"
+			)
+
+			for idx, shard in enumerate(shards):
+				pipes = [
+					metrics.pipe(
+						"{}:{}".format(name, idx),
+						asyncio.Queue(maxsize=self.pipe)
+					)
+					for name in ("grab", "filter")
+				]
+
+				# Workers read our hashes straight from the file, so
+				# there is no load loop
+				tasks.extend((
+					self.grab_loop(
+						table, inp=None, out=pipes[0],
+						grab_all=False, shard=shard
+					),
+					self.diff_loop(
+						table, inp=pipes[0], out=pipes[1],
+						path=snapshot.path, shard=shard,
+						snapshot=writer.part()
+					),
+					self.fetch_loop(
+						table, inp=pipes[1], out=sink, grab_all=False
+					),
+				))
 
 		else:
 			logging.debug(
 				"table contains old data, updating modified rows only"
 			)
-
-			# If the table isn't empty, we assume we do have hashes
-			pipes = [
-				asyncio.Queue(maxsize=self.pipe)
-				for p in range(5)
-			]
-
-			# And so, we use a more complex but faster algorithm
-			# to fetch data
-			done, pending = await asyncio.wait((
-				self.load_loop(table, inp=None, out=pipes[0]),
-				self.grab_loop(table, inp=None, out=pipes[1], grab_all=False),
-				self.filter_loop(table, inp=pipes[0], inp2=pipes[1], out=pipes[2]),
-				self.fetch_loop(
-					table, inp=pipes[2], out=pipes[3], out2=pipes[4], grab_all=False
-				),
-				self.update_loop(table, inp=pipes[3], out=None),
-				self.hash_loop(table, inp=pipes[4], out=None),
-			), return_when=asyncio.FIRST_EXCEPTION)
+			snapshot.open()
+
+			for idx, shard in enumerate(shards):
+				# If the table isn't empty, we assume we do have hashes
+				pipes = [
+					metrics.pipe(
+						"{}:{}".format(name, idx),
+						asyncio.Queue(maxsize=self.pipe)
+					)
+					for name in ("load", "grab", "filter")
+				]
+
+				# And so, we use a more complex but faster algorithm
+				# to fetch data
+				tasks.extend((
+					self.load_loop(
+						table, inp=None, out=pipes[0],
+						snapshot=snapshot, shard=shard
+					),
+					self.grab_loop(
+						table, inp=None, out=pipes[1],
+						grab_all=False, shard=shard
+					),
+					self.filter_loop(
+						table, inp=pipes[0], inp2=pipes[1], out=pipes[2],
+						snapshot=writer.part()
+					),
+					self.fetch_loop(
+						table, inp=pipes[2], out=sink, grab_all=False
+					),
+				))
+
+		reporter = asyncio.ensure_future(self.report_loop(metrics))
+		done, pending = await asyncio.wait(
+			[asyncio.ensure_future(task) for task in tasks],
+			return_when=asyncio.FIRST_EXCEPTION
+		)
+		reporter.cancel()
+		metrics.emit(final=True)
 
 		if pending:
 			# There are pending tasks, so one of them
@@ -91,376 +343,362 @@ class RunnerPool:
 
 			for task in pending:
 				task.cancel()
+			# Wait for them to stop, so they let go of the snapshot
+			await asyncio.gather(*pending, return_exceptions=True)
+
+			try:
+				for task in done | pending:
+					try:
+						task.result()
+						continue
+					except asyncio.CancelledError as exc:
+						error = exc
+					except Exception as exc:
+						task.print_stack(file=sys.stdout)
+						error = exc
+
+					# Its frames still hold slices of the snapshot
+					traceback.clear_frames(error.__traceback__)
+
+				# and so do the batches left in the pipes
+				for queue in metrics.pipes.values():
+					while not queue.empty():
+						queue.get_nowait()
+
+				snapshot.close()
+			finally:
+				writer.discard()
+
+			return False
+
+		return True
+
+	def table_metrics(self, table):
+		if table.name not in self.metrics:
+			self.metrics[table.name] = TableMetrics(table.name)
+		return self.metrics[table.name]
+
+	def stage(self, table, name):
+		return self.table_metrics(table).stage(name)
+
+	def batch_size(self, table, name):
+		"""Returns the batch size of a stage. Every shard of the stage
+		shares it, and it is tuned separately for every table.
+		"""
+		key = (table.name, name)
+		if key not in self.batch_sizes:
+			self.batch_sizes[key] = BatchSize(
+				self.stage_batches.get(name, self.batch),
+				self.batch_bounds
+			)
+			self.stage(table, name).size = self.batch_sizes[key]
+		return self.batch_sizes[key]
 
-			for task in done:
-				exc = task.exception()
+	async def report_loop(self, metrics):
+		while True:
+			await asyncio.sleep(env.metrics_interval)
+			metrics.emit()
 
-				if exc is None:
-					continue
+	@with_cursors("internal")
+	async def truncate_temporary(self, inte, table):
+		# _new holds the rows that changed in this run, and _old the
+		# rows they replace (or the ones that got deleted)
+		await inte.execute("TRUNCATE `{}_new`".format(table.name))
+		await inte.execute("TRUNCATE `{}_old`".format(table.name))
 
-				task.print_stack(file=sys.stdout)
+	def snapshot_path(self, table):
+		return os.path.join(env.hash_dir, "{}.bin".format(table.name))
 
-		else:
-			if table.name == "player":
-				try:
-					await self.update_disqualifications()
-				except Exception:
-					import traceback
-					traceback.print_exc()
-			await self.post_download(table)
+	@with_cursors("internal")
+	async def rebuild_snapshot(self, inte, table):
+		"""Generates the hashes file from our own copy of the table.
+		Rows that differ after our post-processing (like names without
+		a tag) just get fetched again once.
+		"""
+		logging.info(
+			"[{}] rebuilding hashes file".format(table.name)
+		)
 
-			logging.info("[{}] done updating".format(table.name))
+		writer = SnapshotWriter(self.snapshot_path(table))
+		part = writer.part()
+		try:
+			await inte.execute(
+				"SELECT `{0}`, {1} FROM `{2}` ORDER BY `{0}`"
+				.format(table.primary, hash_column(table), table.name)
+			)
 
-	@with_cursors("internal")
-	async def load_loop(self, inte, table, *, inp, out):
+			while True:
+				batch = await inte.fetchmany(self.batch)
+				if not batch:
+					break
+
+				for _id, hashed in batch:
+					part.append(_id, hashed)
+
+		except Exception:
+			writer.discard()
+			raise
+
+		writer.commit()
+		logging.info("[{}] hashes file rebuilt".format(table.name))
+
+	async def load_loop(self, table, *, inp, out, snapshot, shard=None):
 		assert inp is None and out is not None
 
 		logging.debug("[{}] start load loop".format(table.name))
-		# Send the query to the database
-		await inte.execute(
-			"SELECT `id`, `hashed` FROM `{}`"
-			.format(table.read_hash)
-		)
-		logging.debug("[{}] load query sent".format(table.name))
+		stage = self.stage(table, "load")
 
-		while True:
-			# And fetch in small groups so we don't spam anything
-			batch = await inte.fetchmany(self.batch)
-			if not batch:
-				# No more cached hashes
-				await out.put(None)
-				break
+		start, end = snapshot.bounds(shard)
+		for idx in range(start, end, self.batch):
+			stop = min(idx + self.batch, end)
+			# Send both columns as they are, without building tuples
+			await stage.put(out, (
+				snapshot.ids[idx:stop],
+				snapshot.hashes[idx:stop],
+			))
 
-			await out.put(batch)
+		# No more cached hashes
+		await stage.put(out, None)
 
 		logging.debug("[{}] load loop done".format(table.name))
 
 	@with_cursors("external")
-	async def grab_loop(self, exte, table, *, inp, out, grab_all):
+	async def grab_loop(self, exte, table, *, inp, out, grab_all, shard=None):
 		assert inp is None and out is not None
 
 		logging.debug("[{}] start grab loop".format(table.name))
+		stage = self.stage(table, "grab")
+		size = self.batch_size(table, "grab")
+
+		condition = shard_condition(table.primary, shard)
+		name = table.name
+		if shard is not None:
+			name = "{}:{}-{}".format(
+				table.name, shard[0] or "", shard[1] or ""
+			)
 
 		await exte.execute(
-			"SELECT COUNT(*) FROM `{}`"
-			.format(table.name)
+			"SELECT COUNT(*) FROM `{}`{}"
+			.format(table.name, condition)
 		)
 		row = await exte.fetchone()
 		await exte.fetchone()
 
-		logging.info("[{}] total rows: {}".format(table.name, row[0]))
-		progress = max(1, round(row[0] / PROGRESS / self.batch))
-		count, total = 0, math.ceil(row[0] / self.batch)
-
-		crc_columns = list(filter(
-			lambda col: col != "registration_date",
-			table.columns
-		))
+		logging.info("[{}] total rows: {}".format(name, row[0]))
+		total = row[0]
+		progress = max(1, math.ceil(total / PROGRESS))
+		count, report = 0, progress
 
 		if grab_all:
-			select = "CRC32(CONCAT_WS('', `{0}`)), {1}{2}".format(
-				"`,`".join(crc_columns),
+			select = "{0}, {1}".format(
+				hash_column(table),
 				",".join(fetch_columns(table.columns)),
-				table.composite_scores,
 			)
 		else:
-			select = "`{0}`, CRC32(CONCAT_WS('', `{1}`))".format(
+			select = "`{0}`, {1}".format(
 				table.primary,
-				"`,`".join(crc_columns),
+				hash_column(table),
 			)
 
-		await exte.execute(
+		# Hashes are written to the snapshot sorted by id
+		condition += " ORDER BY `{}`".format(table.primary)
+
+		await stage.query(exte.execute(
 			"SELECT \
 				{} \
 			FROM \
-				`{}`"
+				`{}`{}"
 			.format(
 				select,
 				table.name,
+				condition,
 			)
-		)
+		))
 
 		while True:
-			batch = await exte.fetchmany(self.batch)
+			# Rows are streamed, so this is where we wait for them
+			start = time.monotonic()
+			batch = await stage.query(exte.fetchmany(size.value))
 			if not batch:
 				break
+			size.record(len(batch), time.monotonic() - start)
 
-			await out.put(batch)
+			await stage.put(out, batch)
 
-			count += 1  # DEBUG !
-			if count % progress == 0:
+			count += len(batch)
+			if count >= report:
+				report += progress
 				logging.info(
-					"[{}] {}/{} batches processed ({}%)"
+					"[{}] {}/{} rows processed ({}%)"
 					.format(
-						table.name,
+						name,
 						count, total,
-						round(count / total * 100)
+						round(count / max(total, 1) * 100)
 					)
 				)
 
-		await out.put(None)
-		logging.debug("[{}] grab loop done".format(table.name))
+		await stage.put(out, None)
+		logging.debug("[{}] grab loop done".format(name))
 
-	async def filter_loop(self, table, *, inp, inp2, out):
+	async def filter_loop(self, table, *, inp, inp2, out, snapshot):
 		assert inp is not None and inp2 is not None and out is not None
 
 		logging.debug("[{}] start filter loop".format(table.name))
+		stage = self.stage(table, "filter")
+
+		# Both streams are sorted by id, so we can walk them at the same
+		# time (merge join) and never keep more than a batch of each.
+		# Every external hash goes to the next snapshot, so it ends up
+		# being their table with our deleted rows left out.
+		new_batch, deleted = [], []
+		append = snapshot.append
+		progress = self.checkpoint.table(table.name)
+
+		def remove(ids):
+			deleted.extend(ids)
+			progress.delete(ids)
+
+		internal, external = await stage.get(inp), await stage.get(inp2)
+		int_idx, ext_idx = 0, 0
+		if internal is not None:
+			int_ids, int_hashes = internal
+
+		while internal is not None and external:
+			int_id = int_ids[int_idx]
+			ext_id, new_hash = external[ext_idx]
+
+			if int_id == ext_id:
+				# The row is in both databases, check if it changed
+				if int_hashes[int_idx] != new_hash:
+					new_batch.append(ext_id)
+
+				append(ext_id, new_hash)
+				int_idx += 1
+				ext_idx += 1
+
+			elif int_id < ext_id:
+				# We have a row they don't have anymore
+				remove((int_id,))
+				int_idx += 1
 
-		new_batch, needed = [], self.batch
+			else:
+				# They have a row we don't have yet
+				new_batch.append(ext_id)
+				append(ext_id, new_hash)
+				ext_idx += 1
 
-		internal_hashes = {}
-		external_hashes = {}
+			if int_idx == len(int_ids):
+				internal, int_idx = await stage.get(inp), 0
+				if internal is not None:
+					int_ids, int_hashes = internal
 
-		internal_count = 0
-		external_count = 0
+			if ext_idx == len(external):
+				external, ext_idx = await stage.get(inp2), 0
 
-		get_internal = asyncio.create_task(inp.get())
-		get_external = asyncio.create_task(inp2.get())
-		tasks = {get_internal, get_external}
-		paused = None
+			if len(new_batch) == self.batch:
+				await stage.put(out, new_batch)
+				new_batch = []
 
-		while True:
-			a = max(internal_count, external_count)
-			b = min(internal_count, external_count)
-			ratio = a / max(b, 1)
-			if ratio >= 3:
-				# If one stream has stored 3x more than the other
-				# stop the stream, as it is filling up the memory
-				if paused is None:
-					if a == internal_count:
-						paused = get_internal
-					else:
-						paused = get_external
-
-					tasks.remove(paused)
-			elif ratio < 1.5 and paused is not None:
-				# If one stream has been stopped and the other caught up,
-				# resume the stopped stream
-				tasks.add(paused)
-				paused = None
-
-			# Wait until any of the internal or external fetch are complete
-			done, pending = await asyncio.wait(
-				tasks, return_when=asyncio.FIRST_COMPLETED
-			)
+		# Only one of the streams (if any) may still have data
+		while internal is not None:
+			remove(int_ids[int_idx:])
 
-			for task in done:
-				batch = task.result()
-
-				# Remove coroutine from list
-				tasks.remove(task)
-
-				if batch:
-					# There is hash data, adjust variables for easier
-					# operation
-					if task == get_internal:
-						coro = inp.get()
-						get_internal = task = asyncio.create_task(coro)
-						read, write = external_hashes, internal_hashes
-					else:
-						coro = inp2.get()
-						get_external = task = asyncio.create_task(coro)
-						read, write = internal_hashes, external_hashes
-
-					stored = 0
-					removed = 0
-					for row in batch:
-						_id, new_hash = row[0], row[1]
-
-						# If this id has been read by the other input
-						if _id in read:
-							# then we check if their hashes are different
-							if new_hash != read[_id]:
-								# then we add the new hash to the new batch
-								new_batch.append((
-									_id,
-									external_hashes[_id]
-									if task == get_internal else
-									new_hash
-								))
-								needed -= 1
-
-							# and free some memory
-							removed += 1
-							del read[_id]
-
-						# If this id hasn't been read by the other input
-						else:
-							# we mark it as read by this one
-							stored += 1
-							write[_id] = new_hash
-
-					if task == get_internal:
-						internal_count += stored
-						external_count -= removed
-					else:
-						external_count += stored
-						internal_count -= removed
-
-					# And we schedule this coroutine to run again
-					tasks.add(task)
+			internal, int_idx = await stage.get(inp), 0
+			if internal is not None:
+				int_ids, int_hashes = internal
 
-				else:
-					# No more data to check
-					break
+		while external:
+			for ext_id, new_hash in external[ext_idx:]:
+				new_batch.append(ext_id)
+				append(ext_id, new_hash)
 
-			else:
-				# previous loop hasn't reached "break", so just continue
-
-				# While there are excess of rows in the batch
-				while needed < 0:
-					# send a proper batch
-					await out.put(new_batch[:needed])
-					# and prepare the next one (even if it has an excess)
-					new_batch = new_batch[needed:]
-					needed += self.batch
-
-				if needed == 0:
-					# No more needed rows for this batch, just send it
-					await out.put(new_batch)
-					# and prepare the next one
-					new_batch, needed = [], self.batch
+				if len(new_batch) == self.batch:
+					await stage.put(out, new_batch)
+					new_batch = []
 
-				continue
-			# previous loop did reach break, propagate it
-			break
-
-		if get_internal in tasks:
-			# This chunk is not executed in get_external was in tasks
-			logging.info("[{}] get_internal in tasks".format(table.name))
-
-			batch = await get_internal
-			while batch is not None:
-				for row in batch:
-					_id, new_hash = row[0], row[1]
-
-					# If this id has been read by external
-					if _id in external_hashes:
-						# then we check if their hashes are different
-						if new_hash != external_hashes[_id]:
-							# and add the new hash to the batch
-							new_batch.append((
-								_id,
-								external_hashes[_id]
-							))
-							needed -= 1
-
-						# and free some memory
-						del external_hashes[_id]
-
-					# If this id hasn't been read by the other input
-					else:
-						# we mark it as read by this one
-						internal_hashes[_id] = new_hash
-
-				# While there are excess of rows in the batch
-				while needed < 0:
-					# send a proper batch
-					await out.put(new_batch[:needed])
-					# and prepare the next one (even if it has an excess)
-					new_batch = new_batch[needed:]
-					needed += self.batch
-
-				if needed == 0:
-					# No more needed rows for this batch, just send it
-					await out.put(new_batch)
-					# and prepare the next one
-					new_batch, needed = [], self.batch
-
-				batch = await inp.get()
-
-		# Finish transferring new data
-		if get_external in tasks:
-			# This chunk is not executed if get_internal was in tasks
-			batch = await get_external
-			while batch:
-				for (_id, new_hash) in batch:
-					if _id in internal_hashes:
-						old_hash = internal_hashes[_id]
-						del internal_hashes[_id]
-
-						if new_hash == old_hash:
-							continue
-
-					new_batch.append((
-						_id,
-						new_hash
-					))
-					needed -= 1
-
-				# While there are excess of rows in the batch
-				while needed < 0:
-					# send a proper batch
-					await out.put(new_batch[:needed])
-					# and prepare the next one (even if it has an excess)
-					new_batch = new_batch[needed:]
-					needed += self.batch
-
-				if needed == 0:
-					# No more needed rows for this batch, just send it
-					await out.put(new_batch)
-					# and prepare the next one
-					new_batch, needed = [], self.batch
-
-				batch = await inp2.get()
+			external, ext_idx = await stage.get(inp2), 0
 
-		logging.debug(
-			"[{}] internal batches done, {}-{} unpaired hashes"
-			.format(table.name, len(external_hashes), len(internal_hashes))
-		)
+		snapshot.close()
+
+		if new_batch:
+			# Batch has items, but not the required amount
+			await stage.put(out, new_batch)
 
-		new_batch.extend(external_hashes.items())
-		needed -= len(external_hashes)
+		await stage.put(out, None)  # Signal EOF
 
-		# While there are excess of rows in the batch
-		while needed < 0:
-			# send a proper batch
-			await out.put(new_batch[:needed])
-			# and prepare the next one (even if it has an excess)
-			new_batch = new_batch[needed:]
-			needed += self.batch
+		logging.debug("[{}] filter loop done".format(table.name))
 
-		if needed == 0:
-			# No more needed rows for this batch, just send it
-			await out.put(new_batch)
-			needed += self.batch
+		await self.delete_rows(table, list(map(str, deleted)))
 
-		if needed < self.batch:
-			# Batch has items, but not the required amount
-			await out.put(False)  # Signal less items
-			await out.put(new_batch)
+	async def diff_loop(self, table, *, inp, out, path, shard, snapshot):
+		"""Does the job of the load and filter loops in worker processes.
+		Every external batch is compared with our hashes for the ids
+		between the previous batch and its last id, so batches don't
+		depend on each other.
+		"""
+		assert inp is not None and out is not None
 
-		await out.put(None)  # Signal EOF
+		logging.debug("[{}] start diff loop".format(table.name))
+		stage = self.stage(table, "filter")
+		window = Window(self.executor, self.window)
 
-		logging.debug("[{}] filter loop done".format(table.name))
+		low, high = (None, None) if shard is None else shard
+		deleted = []
+		progress = self.checkpoint.table(table.name)
 
-		if len(internal_hashes) >= 100000:
-			logging.debug(
-				"[{}] too many rows to delete. did tig's db update?."
-				.format(table.name)
-			)
+		async def publish(results):
+			for changed, removed, ids, hashes in results:
+				snapshot.extend(ids, hashes)
+				deleted.extend(removed)
+				progress.delete(removed)
 
-		else:
-			await self.delete_rows(
-				table,
-				list(map(str, internal_hashes.keys()))
-			)
+				# Changed ids are regrouped by the fetch loop
+				if changed:
+					await stage.put(out, changed)
+
+		while True:
+			batch = await stage.get(inp)
+			if batch is None:
+				break
+
+			last = batch[-1][0] + 1
+			await publish(await window.submit(
+				diff_batch, path, low, last, batch
+			))
+			low = last
+
+		# Our rows after their last one are gone
+		await publish(await window.submit(diff_batch, path, low, high, []))
+		await publish(await window.drain())
+		snapshot.close()
+
+		await stage.put(out, None)  # Signal EOF
+		logging.debug("[{}] diff loop done".format(table.name))
+
+		await self.delete_rows(table, list(map(str, deleted)))
 
 	async def bulk_delete(self, inte, table, batch):
 		batch = ",".join(batch)
 
+		# Keep deleted rows around, post update needs them
 		await inte.execute(
-			"DELETE FROM `{}` WHERE `{}` IN ({})"
+			"REPLACE INTO `{0}_old` \
+			SELECT * FROM `{0}` WHERE `{1}` IN ({2})"
 			.format(
 				table.name,
 				table.primary,
 				batch
 			)
 		)
+		if table.name in self.swap_tables:
+			# Left out when the next version of the table is built
+			return
+
 		await inte.execute(
-			"DELETE FROM `{}` WHERE `id` IN ({})"
+			"DELETE FROM `{}` WHERE `{}` IN ({})"
 			.format(
-				table.read_hash,
+				table.name,
+				table.primary,
 				batch
 			)
 		)
@@ -486,136 +724,202 @@ class RunnerPool:
 		logging.debug("[{}] done delete".format(table.name))
 
 	@with_cursors("external")
-	async def fetch_loop(self, exte, table, *, inp, out, out2, grab_all):
+	async def fetch_loop(
+		self, exte, table, *, inp, out, grab_all, snapshot=None
+	):
 		assert inp is not None and out is not None
 
 		logging.debug("[{}] start fetch loop".format(table.name))
+		stage = self.stage(table, "fetch")
 
 		primary_idx = table.columns.index(table.primary)
 
+		if grab_all and self.executor is not None:
+			# Same as below, in worker processes
+			window = Window(self.executor, self.window)
+
+			async def publish(results):
+				for rows, ids, hashes in results:
+					snapshot.extend(ids, hashes)
+					await stage.put(out, rows)
+
+			while True:
+				batch = await stage.get(inp)
+				if not batch:
+					break
+
+				await publish(await window.submit(
+					strip_hashes, batch, primary_idx
+				))
+
+			await publish(await window.drain())
+			snapshot.close()
+			await stage.put(out, None)
+
+			logging.debug("[{}] fetch loop done".format(table.name))
+			return
+
 		if grab_all:
 			# There is nothing to compare, so just fetch and update
 			while True:
-				batch = await inp.get()
+				batch = await stage.get(inp)
 				if not batch:
-					await out2.put(None)
-					await out.put(None)
+					snapshot.close()
+					await stage.put(out, None)
 					break
 
-				# Send rows and calculated hashes separately
-				hashes = []
+				# Store hashes and send rows without them
 				for idx, row in enumerate(batch):
-					#                    primary column, hash
-					hashes.append((row[primary_idx + 1], row[0]))
+					#                 primary column, hash
+					snapshot.append(row[primary_idx + 1], row[0])
 					# remove hash from item
 					batch[idx] = row[1:]
 
-				await out2.put(hashes)
-				await out.put(batch)
+				await stage.put(out, batch)
 
 			logging.debug("[{}] fetch loop done".format(table.name))
 			return
 
-		# Prepare query (it is waaaay faster this way)
-		query = (
-			"SELECT {}{} FROM `{}` WHERE `{}` IN ({})"
-			.format(
-				",".join(fetch_columns(table.columns)),
-				table.composite_scores,
-				table.name,
-				table.primary,
-				"{}," * (self.batch - 1) + "{}"  # argument placeholder
-			).format
+		size = self.batch_size(table, "fetch")
+		fetcher = RowFetcher(
+			table.name, fetch_columns(table.columns), table.primary,
+			join_size=self.fetch_join
 		)
 
-		fill_placeholders = False
-		ids = [0] * self.batch
-		while True:
+		# The IN list has its own size, so ids are regrouped
+		pending, done = [], False
+		while not done:
 			# Get filtered rows
-			batch = await inp.get()
+			batch = await stage.get(inp)
 			if batch is None:
-				await out2.put(None)
-				await out.put(None)
-				break
-
-			elif batch is False:
-				# This batch may have less items than expected
-				batch = await inp.get()
-				fill_placeholders = True
+				done = True
+			else:
+				pending.extend(batch)
 
-			# Dump batch ids into an ids list
-			for idx, row in enumerate(batch):
-				ids[idx] = row[0]
+			while len(pending) >= size.value or (done and pending):
+				ids = pending[:size.value]
+				del pending[:size.value]
 
-			if fill_placeholders:
-				# Missing items, fill with 0 (reserved for souris)
-				fill_placeholders = False
+				# Fetch all the data
+				start = time.monotonic()
+				rows = await fetcher.fetch(exte, ids, stage)
+				size.record(len(ids), time.monotonic() - start)
 
-				for idx in range(len(batch), self.batch):
-					ids[idx] = 0
+				await stage.put(out, rows)
 
-			# Fetch all the data and send hashes
-			await exte.execute(query(*ids))
-			await out2.put(batch)
-			await out.put(await exte.fetchall())
+		await stage.put(out, None)
 
 		logging.debug("[{}] fetch loop done".format(table.name))
 
-	@with_cursors("internal")
-	async def update_loop(self, inte, table, *, inp, out):
-		assert inp is not None and out is None
+	async def score_loop(self, table, *, inp, out, producers=1):
+		assert inp is not None and out is not None
 
-		logging.debug("[{}] start update loop".format(table.name))
+		logging.debug("[{}] start score loop".format(table.name))
 
-		if not table.is_empty:
-			await inte.execute("TRUNCATE `{}_new`".format(table.name))
+		stage = self.stage(table, "score")
+		if self.executor is not None:
+			window = Window(self.executor, self.window)
 
-		# Prepare query (it is waaaay faster this way)
-		query = (
-			"REPLACE INTO `{}{}` (`{}`) VALUES ({})"
-			.format(
-				table.name,
-				"" if table.is_empty else "_new",
-				"`,`".join(table.write_columns),
-				",".join(["%s"] * len(table.write_columns))
-			)
-		)
+			def score(batch):
+				return window.submit(
+					score_rows, table.columns, table.score_columns, batch
+				)
 
-		while True:
-			batch = await inp.get()
+		else:
+			scorer = Scorer(table.columns, table.score_columns)
+
+			async def score(batch):
+				return [scorer.apply(batch)]
+
+		while producers > 0:
+			batch = await stage.get(inp)
 			if batch is None:
-				break
+				# One of the pipelines is done, but rows of the rest
+				# may still be in the window
+				producers -= 1
+				if self.executor is not None:
+					for rows in await window.drain():
+						await stage.put(out, rows)
+
+				await stage.put(out, None)
+				continue
 
-			# Insert data into the database
-			await inte.executemany(query, batch)
+			for rows in await score(batch):
+				await stage.put(out, rows)
 
-		logging.debug("[{}] update loop done".format(table.name))
+		logging.debug("[{}] score loop done".format(table.name))
 
 	@with_cursors("internal")
-	async def hash_loop(self, inte, table, *, inp, out):
+	async def update_loop(self, inte, table, *, inp, out, producers=1):
 		assert inp is not None and out is None
 
-		logging.debug("[{}] start hash loop".format(table.name))
+		logging.debug("[{}] start update loop".format(table.name))
 
-		# Prepare query (it is waaaay faster this way)
-		query = (
-			"INSERT INTO `{}` (`id`, `hashed`) VALUES (%s, %s)"
-			.format(table.read_hash if table.is_empty else table.write_hash)
-		)
+		target = "{}{}".format(table.name, "" if table.is_empty else "_new")
+		if table.name in self.bulk_tables:
+			loader = BulkLoader(target, table.write_columns)
+			write = loader.write
 
-		while True:
-			batch = await inp.get()
-			if batch is None:
-				break
+		else:
+			loader = None
+			# Prepare query (it is waaaay faster this way)
+			query = (
+				"REPLACE INTO `{}` (`{}`) VALUES ({})"
+				.format(
+					target,
+					"`,`".join(table.write_columns),
+					",".join(["%s"] * len(table.write_columns))
+				)
+			)
 
-			# Insert data into the database
-			await inte.executemany(query, batch)
+			def write(cursor, rows):
+				return cursor.executemany(query, rows)
 
-		logging.debug("[{}] hash loop done".format(table.name))
+		primary_idx = table.columns.index(table.primary)
+		progress = self.checkpoint.table(table.name)
+		stage = self.stage(table, "update")
+		size = self.batch_size(table, "update")
+
+		# Rows of every pipeline are regrouped in batches of our own size
+		pending = []
+		try:
+			while producers > 0:
+				batch = await stage.get(inp)
+				if batch is None:
+					# One of the pipelines is done
+					producers -= 1
+				else:
+					pending.extend(batch)
+
+				# Leftovers are written once every pipeline is done
+				while pending and (
+					len(pending) >= size.value or producers == 0
+				):
+					rows = pending[:size.value]
+					del pending[:size.value]
+
+					# Insert data into the database
+					start = time.monotonic()
+					await stage.query(write(inte, rows))
+					size.record(len(rows), time.monotonic() - start)
+
+					# Everything up to these rows is safe now
+					progress.advance(row[primary_idx] for row in rows)
+					self.checkpoint.save()
+
+		finally:
+			if loader is not None:
+				loader.close()
+
+		logging.debug("[{}] update loop done".format(table.name))
 
 	@with_cursors("internal", "external")
 	async def update_disqualifications(self, inte, exte):
+		"""Returns the sets of disqualified ids before and after the
+		update.
+		"""
 		logging.debug("[disq] updating disqualifications")
+		before = await self.fetch_disqualified(inte)
 		await inte.execute("UPDATE `disqualified` SET `tfm` = 0")
 
 		logging.debug("[disq] old tfm disqualifications wiped")
@@ -656,21 +960,23 @@ class RunnerPool:
 		)
 
 		logging.debug("[disq] done")
+		return before, await self.fetch_disqualified(inte)
+
+	async def fetch_disqualified(self, inte):
+		await inte.execute("SELECT `id` FROM `disqualified`")
+
+		ids = set()
+		while True:
+			batch = await inte.fetchmany(self.batch)
+			if not batch:
+				break
+
+			ids.update(row[0] for row in batch)
+		return ids
 
 	@with_cursors("internal")
 	async def post_download(self, inte, table):
 		if table.name == "player":
-			logging.debug("[player] calculating overall score")
-
-			await inte.execute(
-				"UPDATE `player{}` \
-				SET `score_overall`={}"
-				.format(
-					"" if table.is_empty else "_new",
-					overall_scores["alltime"]
-				)
-			)
-
 			logging.debug("[player] renaming players without #")
 
 			await inte.execute(
@@ -685,41 +991,44 @@ class RunnerPool:
 		if table.is_empty:
 			return
 
-		await inte.execute(
-			"SELECT COUNT(*) FROM `{}`"
-			.format(table.write_hash)
-		)
-		row = await inte.fetchone()
-		await inte.fetchone()  # has to return None for next execute
+		progress = self.checkpoint.table(table.name)
+		if progress.logs is not None:
+			# The changelog was written before the crash
+			table.log_range = tuple(progress.logs) or None
 
-		logging.debug(
-			"[{}] initiate internal hash transfer ({} hashes)"
-			.format(table.name, row[0])
-		)
-
-		await inte.execute(
-			"REPLACE INTO `{0}` \
-			SELECT `w`.* \
-			FROM `{1}` as `w`"
-			.format(table.read_hash, table.write_hash)
-		)
+		else:
+			logging.debug("[{}] initiate changelog save".format(table.name))
 
-		logging.debug("[{}] truncate temp hash table".format(table.name))
+			await inte.execute(
+				"INSERT INTO `{0}_changelog` (`{1}`) \
+				SELECT `n`.* \
+				FROM `{0}_new` as `n`"
+				.format(
+					table.name,
+					"`,`".join(table.write_columns)
+				)
+			)
+			table.record_logs(inte)
 
-		await inte.execute("TRUNCATE `{}`".format(table.write_hash))
+			progress.logs = list(table.log_range or ())
+			self.checkpoint.save(force=True)
 
-		logging.debug("[{}] initiate changelog save".format(table.name))
+		logging.debug("[{}] save replaced data".format(table.name))
 
+		# Rows that are already there were saved by a crashed run,
+		# before their new data got transferred
 		await inte.execute(
-			"INSERT INTO `{0}_changelog` (`{1}`) \
-			SELECT `n`.* \
-			FROM `{0}_new` as `n`"
-			.format(
-				table.name,
-				"`,`".join(table.write_columns)
-			)
+			"INSERT IGNORE INTO `{0}_old` \
+			SELECT `o`.* \
+			FROM `{0}` as `o` \
+			INNER JOIN `{0}_new` as `n` ON `n`.`{1}` = `o`.`{1}`"
+			.format(table.name, table.primary)
 		)
 
+		if table.name in self.swap_tables:
+			await self.swap_table(inte, table)
+			return
+
 		logging.debug("[{}] transfer new data".format(table.name))
 
 		await inte.execute(
@@ -728,3 +1037,47 @@ class RunnerPool:
 			FROM `{0}_new` as `n`"
 			.format(table.name)
 		)
+
+	async def swap_table(self, inte, table):
+		"""Builds the next version of a table next to the live one and
+		swaps them at once, so readers never wait for the transfer nor
+		see it half done.
+
+		_old holds every row that got replaced or deleted, so the next
+		version is the live table without them, plus _new. Running it
+		twice gives the same table.
+		"""
+		logging.debug("[{}] building next version".format(table.name))
+
+		await inte.execute(
+			"DROP TABLE IF EXISTS `{0}_next`, `{0}_prev`".format(table.name)
+		)
+		await inte.execute(
+			"CREATE TABLE `{0}_next` LIKE `{0}`".format(table.name)
+		)
+		# Indexes are rebuilt once at the end, which is a lot faster
+		await inte.execute(
+			"ALTER TABLE `{}_next` DISABLE KEYS".format(table.name)
+		)
+		await inte.execute(
+			"INSERT INTO `{0}_next` \
+			SELECT `t`.* \
+			FROM `{0}` as `t` \
+			LEFT JOIN `{0}_old` as `o` ON `o`.`{1}` = `t`.`{1}` \
+			WHERE `o`.`{1}` IS NULL"
+			.format(table.name, table.primary)
+		)
+		await inte.execute(
+			"INSERT INTO `{0}_next` SELECT * FROM `{0}_new`"
+			.format(table.name)
+		)
+		await inte.execute(
+			"ALTER TABLE `{}_next` ENABLE KEYS".format(table.name)
+		)
+
+		logging.debug("[{}] swapping tables".format(table.name))
+		await inte.execute(
+			"RENAME TABLE `{0}` TO `{0}_prev`, `{0}_next` TO `{0}`"
+			.format(table.name)
+		)
+		await inte.execute("DROP TABLE `{}_prev`".format(table.name))
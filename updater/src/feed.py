@@ -0,0 +1,268 @@
+import os
+import logging
+import aiomysql
+
+from bulk import tsv_value
+from periods import stat_columns, score_columns
+from utils import env
+
+
+VERSION = 1
+CHUNK = 10000  # rows to read at once
+
+
+class FeedSource:
+	"""Where the feed of a table comes from: the rows the run wrote
+	and the rows they replaced or deleted.
+	"""
+
+	def __init__(self, name, primary, columns, new, old, deletes=True):
+		self.name = name
+		self.primary = primary
+		self.columns = columns
+		self.new = new  # FROM clause of the current rows, as `c`
+		self.old = old
+		self.deletes = deletes
+
+	def changes_query(self):
+		return (
+			"SELECT `c`.`{0}`, `o`.`{0}`, {1}, {2} \
+			FROM {3} \
+			LEFT JOIN `{4}` as `o` ON `o`.`{0}` = `c`.`{0}` \
+			ORDER BY `c`.`{0}`"
+			.format(
+				self.primary,
+				",".join("`o`.`{}`".format(col) for col in self.columns),
+				",".join("`c`.`{}`".format(col) for col in self.columns),
+				self.new, self.old
+			)
+		)
+
+	def deletes_query(self):
+		return (
+			"SELECT `o`.`{0}`, {1} \
+			FROM `{2}` as `o` \
+			LEFT JOIN `{3}_new` as `n` ON `n`.`{0}` = `o`.`{0}` \
+			WHERE `n`.`{0}` IS NULL \
+			ORDER BY `o`.`{0}`"
+			.format(
+				self.primary,
+				",".join("`o`.`{}`".format(col) for col in self.columns),
+				self.old, self.name
+			)
+		)
+
+
+sources = (
+	FeedSource(
+		"player", "id", ("name",) + stat_columns + score_columns,
+		"`player_new` as `c`", "player_old"
+	),
+	FeedSource(
+		"tribe", "id", ("name",),
+		"`tribe_new` as `c`", "tribe_old"
+	),
+	FeedSource(
+		"member", "id_member", ("id_tribe",),
+		"`member_new` as `c`", "member_old"
+	),
+	# Tribe stats are never deleted, and tribe_active holds every tribe
+	# written in this run
+	FeedSource(
+		"tribe_stats", "id",
+		("members", "active") + stat_columns + score_columns,
+		"`tribe_stats` as `c` \
+		INNER JOIN `tribe_active` as `a` ON `a`.`id` = `c`.`id`",
+		"tribe_stats_old", deletes=False
+	),
+)
+
+
+def feed_path(run):
+	return os.path.join(env.feed_dir, "{}.tsv".format(run))
+
+
+class FeedWriter:
+	"""Writes the change feed of a run. It is a TSV file:
+
+		feed     <version> <run> <previous run>
+		columns  <table> <column>...
+		rebuild  <table>
+		<table>  <I|U|D> <id> <old values>... <new values>...
+		end      <rows>
+
+	Inserted rows have NULL (\\N) old values and deleted rows NULL new
+	values. Tables that can't be diffed (first run, unknown
+	disqualifications) are marked to be rebuilt and have no rows. The
+	file only shows up once it is complete.
+
+	The previous run is the one of the last feed written, so consumers
+	can tell whether they missed one.
+	"""
+
+	def __init__(self, run):
+		self.run = run
+		self.path = feed_path(run)
+		self.rows = 0
+
+		os.makedirs(env.feed_dir, exist_ok=True)
+		previous = [
+			name[:-len(".tsv")] for name in feed_names()
+			if name < os.path.basename(self.path)
+		]
+
+		self.file = open(self.path + ".tmp", "w", encoding="utf-8")
+		self.line("feed", VERSION, run, previous[-1] if previous else None)
+
+	def line(self, *values):
+		self.file.write("\t".join(map(tsv_value, values)) + "\n")
+
+	def change(self, table, kind, row_id, old, new):
+		self.line(table, kind, row_id, *old, *new)
+		self.rows += 1
+
+	def commit(self):
+		self.line("end", self.rows)
+		self.file.close()
+		os.replace(self.path + ".tmp", self.path)
+
+	def discard(self):
+		self.file.close()
+		os.remove(self.path + ".tmp")
+
+
+def feed_names():
+	"""Returns the file names of the feeds, oldest first"""
+	return sorted(
+		name for name in os.listdir(env.feed_dir)
+		if name.endswith(".tsv")
+	)
+
+
+def prune_feeds(keep):
+	for name in feed_names()[:-keep]:
+		os.remove(os.path.join(env.feed_dir, name))
+
+
+async def write_source(cursor, writer, source, disqualified=None):
+	"""Writes the changes of a table. With disqualified, (before, after)
+	id sets, player rows get whether they were disqualified as their
+	first column, and players that were only (un)disqualified are
+	written too.
+	"""
+	size = len(source.columns)
+	flipped = None
+	if disqualified is not None:
+		before, after = disqualified
+		flipped = before ^ after
+
+		def flags(row_id, old, new):
+			return (
+				(int(row_id in before),) + old if old is not None else old,
+				(int(row_id in after),) + new if new is not None else new,
+			)
+
+	await cursor.execute(source.changes_query())
+	while True:
+		rows = await cursor.fetchmany(CHUNK)
+		if not rows:
+			break
+
+		for row in rows:
+			row_id, old, new = row[0], row[2:2 + size], row[2 + size:]
+			if row[1] is None:
+				kind, old = "I", None
+			else:
+				kind = "U"
+
+			if flipped is not None:
+				flipped.discard(row_id)
+				old, new = flags(row_id, old, new)
+
+			if old == new:
+				# Only columns outside of the feed changed
+				continue
+
+			writer.change(
+				source.name, kind, row_id,
+				old or (None,) * len(new), new
+			)
+
+	if source.deletes:
+		await cursor.execute(source.deletes_query())
+		while True:
+			rows = await cursor.fetchmany(CHUNK)
+			if not rows:
+				break
+
+			for row in rows:
+				row_id, old, new = row[0], row[1:], None
+				if flipped is not None:
+					flipped.discard(row_id)
+					old, new = flags(row_id, old, new)
+
+				writer.change(
+					source.name, "D", row_id, old, (None,) * len(old)
+				)
+
+	if not flipped:
+		return
+
+	# Their stats didn't change, so the current ones are the old ones
+	flipped = sorted(flipped)
+	for start in range(0, len(flipped), CHUNK):
+		await cursor.execute(
+			"SELECT `{}`, {} FROM `{}` WHERE `{}` IN ({})"
+			.format(
+				source.primary,
+				",".join("`{}`".format(col) for col in source.columns),
+				source.name, source.primary,
+				",".join(map(str, flipped[start:start + CHUNK]))
+			)
+		)
+		for row in await cursor.fetchall():
+			old, new = flags(row[0], row[1:], row[1:])
+			writer.change(source.name, "U", row[0], old, new)
+
+
+async def write_feed(tables, pool, run):
+	"""Writes the change feed of a run from the tables it left behind:
+	_new, _old, tribe_active and tribe_stats_old. Returns its path.
+	"""
+	writer = FeedWriter(run)
+	try:
+		async with pool.acquire() as conn:
+			async with conn.cursor(aiomysql.SSCursor) as cursor:
+				for source in sources:
+					table = tables[source.name]
+					columns = source.columns
+					disqualified = None
+					if source.name == "player":
+						columns = ("disqualified",) + columns
+						disqualified = table.disqualified
+
+					writer.line("columns", source.name, *columns)
+
+					if table.is_empty or (
+						source.name == "player" and disqualified is None
+					):
+						logging.debug(
+							"[feed] {} has to be rebuilt".format(source.name)
+						)
+						writer.line("rebuild", source.name)
+						continue
+
+					logging.debug("[feed] writing {}".format(source.name))
+					await write_source(cursor, writer, source, disqualified)
+
+	except BaseException:
+		writer.discard()
+		raise
+
+	writer.commit()
+	prune_feeds(env.feed_keep)
+
+	logging.debug(
+		"[feed] {} changes written to {}".format(writer.rows, writer.path)
+	)
+	return writer.path
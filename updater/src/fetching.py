@@ -0,0 +1,77 @@
+import logging
+import aiomysql
+
+
+class RowFetcher:
+	"""Fetches the rows with the given ids.
+
+	Batches smaller than join_size are fetched with an IN list. Bigger
+	ones are inserted into a temporary table, which the query joins
+	against, so the server doesn't have to parse and sort a huge IN list
+	for every batch. If temporary tables can't be created (the user
+	lacks the privilege), IN lists are always used.
+
+	Rows come back sorted by their primary key either way, as the
+	checkpoint takes the last written key as the resume point.
+	"""
+
+	def __init__(self, table, columns, primary, join_size=None):
+		self.table = table
+		self.join_size = join_size
+		self.created = False
+
+		self.in_query = (
+			"SELECT {0} FROM `{1}` WHERE `{2}` IN ({{}}) ORDER BY `{2}`"
+			.format(",".join(columns), table, primary)
+		)
+		self.join_query = (
+			"SELECT {0} \
+			FROM `{1}` \
+			INNER JOIN `fetch_ids` as `f` ON `f`.`fetch_id` = `{1}`.`{2}` \
+			ORDER BY `{1}`.`{2}`"
+			.format(",".join(columns), table, primary)
+		)
+
+	async def fetch(self, cursor, ids, stage):
+		if self.join_size is not None and len(ids) >= self.join_size:
+			if await self.create(cursor):
+				return await self.fetch_joined(cursor, ids, stage)
+
+		await stage.query(cursor.execute(
+			self.in_query.format(",".join(map(str, ids)))
+		))
+		return await stage.query(cursor.fetchall())
+
+	async def create(self, cursor):
+		if self.created:
+			return True
+
+		try:
+			# Temporary tables only exist in the connection that made them
+			await cursor.execute(
+				"CREATE TEMPORARY TABLE IF NOT EXISTS `fetch_ids` \
+				(`fetch_id` bigint(20) NOT NULL, PRIMARY KEY (`fetch_id`)) \
+				ENGINE=MEMORY"
+			)
+		except aiomysql.Error as exc:
+			logging.warning(
+				"[{}] can't create fetch_ids, using IN lists: {}"
+				.format(self.table, exc)
+			)
+			self.join_size = None
+			return False
+
+		self.created = True
+		return True
+
+	async def fetch_joined(self, cursor, ids, stage):
+		await stage.query(cursor.execute(
+			"INSERT INTO `fetch_ids` (`fetch_id`) VALUES ({})"
+			.format("),(".join(map(str, ids)))
+		))
+
+		await stage.query(cursor.execute(self.join_query))
+		rows = await stage.query(cursor.fetchall())
+
+		await stage.query(cursor.execute("TRUNCATE `fetch_ids`"))
+		return rows
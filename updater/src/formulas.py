@@ -1,49 +1,85 @@
 # Formulas for the composite scores
-formulas = {
-	"score_stats": (
-		"(POWER(`cheese_gathered`, 2) + POWER(`first`, 2) "
-		"+ POWER(`saved_mice`, 2)) / `round_played`"
-	),
-	"score_shaman": (
-		"(`shaman_cheese` * 0.05 + `{0}` * 0.2 "
-		"+ `{0}_hard`*0.35 + `{0}_divine`*0.5) "
-		"/ POWER(GREATEST(`round_played`, 1), 0.25)"
-		.format("saved_mice")
-	),
-	"score_survivor": (
-		"(1.6 * `{0}survivor_count` + 0.8 * `{0}mouse_killed`) "
-		"/ POWER(GREATEST(`{0}shaman_count` * `{0}round_played`, 1), 0.25)"
-		.format("survivor_")
-	),
-	"score_racing": (
-		"(2 * `{0}first` + `{0}podium`) "
-		"/ POWER(GREATEST(`{0}round_played` * `{0}finished_map`, 1), 0.25)"
-		.format("racing_")
-	),
-	"score_defilante": (
-		"`{0}points` / "
-		"POWER(GREATEST(`{0}round_played` * `{0}finished_map`, 1), 0.25)"
-		.format("defilante_")
-	),
+# Every formula is written once, over columns (c) and functions (f), and
+# evaluated over numpy arrays by scoring.py. They used to run as MySQL
+# queries, and keep its DOUBLE and DECIMAL semantics.
+
+
+def score_stats(c, f):
+	return (
+		f.power(c.cheese_gathered, 2) + f.power(c.first, 2)
+		+ f.power(c.saved_mice, 2)
+	) / c.round_played
+
+
+def score_shaman(c, f):
+	return f.decimal(
+		c.shaman_cheese * 0.05 + c.saved_mice * 0.2
+		+ c.saved_mice_hard * 0.35 + c.saved_mice_divine * 0.5,
+		2
+	) / f.power(f.greatest(c.round_played, 1), 0.25)
+
+
+def score_survivor(c, f):
+	return f.decimal(
+		1.6 * c.survivor_survivor_count + 0.8 * c.survivor_mouse_killed, 1
+	) / f.power(
+		f.greatest(c.survivor_shaman_count * c.survivor_round_played, 1),
+		0.25
+	)
+
+
+def score_racing(c, f):
+	return (2 * c.racing_first + c.racing_podium) / f.power(
+		f.greatest(c.racing_round_played * c.racing_finished_map, 1),
+		0.25
+	)
+
+
+def score_defilante(c, f):
+	return c.defilante_points / f.power(
+		f.greatest(c.defilante_round_played * c.defilante_finished_map, 1),
+		0.25
+	)
+
+
+score_functions = {
+	"score_stats": score_stats,
+	"score_shaman": score_shaman,
+	"score_survivor": score_survivor,
+	"score_racing": score_racing,
+	"score_defilante": score_defilante,
 }
 
 
-overall_formula = (
-	"(IFNULL(`score_stats` / {stats}, 0) + "
-	"IFNULL(`score_shaman` / {shaman}, 0) + "
-	"IFNULL(`score_survivor` / {survivor}, 0) + "
-	"IFNULL(`score_racing` / {racing}, 0) + "
-	"IFNULL(`score_defilante` / {defilante}, 0))"
-)
-overall_scores = {
-	"alltime": overall_formula.format(
+# The scores above go through POWER, so MySQL evaluates them as DOUBLE,
+# but what comes before it (like INT * 0.05) is an exact DECIMAL, marked
+# with f.decimal and the digits it has.
+# score_overall only divides INT columns by decimal literals, which MySQL
+# evaluates as DECIMAL, and that rounds differently.
+decimal_scores = ("score_overall",)
+
+
+def overall_function(stats, shaman, survivor, racing, defilante):
+	def score_overall(c, f):
+		return (
+			f.ifnull(f.decimal_div(c.score_stats, stats), 0)
+			+ f.ifnull(f.decimal_div(c.score_shaman, shaman), 0)
+			+ f.ifnull(f.decimal_div(c.score_survivor, survivor), 0)
+			+ f.ifnull(f.decimal_div(c.score_racing, racing), 0)
+			+ f.ifnull(f.decimal_div(c.score_defilante, defilante), 0)
+		)
+	return score_overall
+
+
+overall_functions = {
+	"alltime": overall_function(
 		stats=2723.477,
 		shaman=24.956,
 		survivor=1.580,
 		racing=0.861,
 		defilante=2.851,
 	),
-	"daily": overall_formula.format(
+	"daily": overall_function(
 		stats=3.1,
 		shaman=0.311,
 		survivor=0.056,
@@ -51,5 +87,5 @@ overall_scores = {
 		defilante=0.333,
 	),
 }
-overall_scores["weekly"] = overall_scores["daily"]
-overall_scores["monthly"] = overall_scores["daily"]
+overall_functions["weekly"] = overall_functions["daily"]
+overall_functions["monthly"] = overall_functions["daily"]
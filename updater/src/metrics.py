@@ -0,0 +1,140 @@
+import json
+import time
+import logging
+
+from utils import env
+
+
+def count_rows(item):
+	if isinstance(item, tuple):
+		# Batches of the load loop are (ids, hashes) columns
+		return len(item[0])
+	return len(item)
+
+
+class StageMetrics:
+	"""Counters of a pipeline stage. Every shard running the stage adds
+	to the same counters, so times can add up to more than the elapsed
+	time.
+	"""
+
+	def __init__(self):
+		self.rows_in = 0
+		self.rows_out = 0
+		self.batches_in = 0
+		self.batches_out = 0
+
+		self.get_time = 0.0  # blocked on Queue.get
+		self.put_time = 0.0  # blocked on Queue.put
+		self.query_time = 0.0  # waiting for the database
+		self.queries = 0
+
+		self.size = None  # BatchSize of the stage, if it has one
+
+	async def get(self, queue):
+		start = time.monotonic()
+		item = await queue.get()
+		self.get_time += time.monotonic() - start
+
+		if item:
+			self.batches_in += 1
+			self.rows_in += count_rows(item)
+		return item
+
+	async def put(self, queue, item):
+		start = time.monotonic()
+		await queue.put(item)
+		self.put_time += time.monotonic() - start
+
+		if item:
+			self.batches_out += 1
+			self.rows_out += count_rows(item)
+
+	async def query(self, awaitable):
+		"""Times a cursor call (execute, executemany, fetch...)"""
+		start = time.monotonic()
+		result = await awaitable
+		self.query_time += time.monotonic() - start
+		self.queries += 1
+		return result
+
+	def to_dict(self, elapsed):
+		result = {
+			"rows_in": self.rows_in,
+			"rows_out": self.rows_out,
+			"batches_in": self.batches_in,
+			"batches_out": self.batches_out,
+			"get_wait": round(self.get_time, 3),
+			"put_wait": round(self.put_time, 3),
+			"query_time": round(self.query_time, 3),
+			"queries": self.queries,
+			"rows_per_sec": round(max(self.rows_in, self.rows_out) / elapsed)
+			if elapsed > 0 else 0,
+		}
+		if self.size is not None:
+			result["batch_size"] = self.size.value
+		return result
+
+
+class TableMetrics:
+	"""Metrics of the extraction of a table, exported as JSON lines to
+	METRICS_FILE (or the log if it isn't set).
+	"""
+
+	def __init__(self, name):
+		self.name = name
+		self.start = time.monotonic()
+
+		self.stages = {}
+		self.pipes = {}
+		# queue depth samples, to get the average depth of every pipe
+		self.depths = {}
+		self.samples = 0
+
+	def stage(self, name):
+		if name not in self.stages:
+			self.stages[name] = StageMetrics()
+		return self.stages[name]
+
+	def pipe(self, name, queue):
+		self.pipes[name] = queue
+		self.depths[name] = 0
+		return queue
+
+	def report(self, final=False):
+		elapsed = time.monotonic() - self.start
+
+		if final:
+			pipes = {
+				name: round(depth / self.samples, 1) if self.samples else 0
+				for name, depth in self.depths.items()
+			}
+		else:
+			self.samples += 1
+			pipes = {}
+			for name, queue in self.pipes.items():
+				pipes[name] = queue.qsize()
+				self.depths[name] += pipes[name]
+
+		return {
+			"table": self.name,
+			"type": "summary" if final else "progress",
+			"time": round(time.time()),
+			"elapsed": round(elapsed, 3),
+			"stages": {
+				name: stage.to_dict(elapsed)
+				for name, stage in self.stages.items()
+			},
+			# current depth, or the average one in the summary
+			"pipes": pipes,
+		}
+
+	def emit(self, final=False):
+		line = json.dumps(self.report(final))
+
+		if env.metrics_file is None:
+			logging.info("[metrics] {}".format(line))
+			return
+
+		with open(env.metrics_file, "a") as file:
+			file.write(line + "\n")
@@ -0,0 +1,347 @@
+import os
+import logging
+import aiomysql
+import numpy as np
+
+from datetime import date
+
+from utils import env
+from formulas import score_functions
+from scoring import Scorer, Columns, as_list
+
+
+stat_columns = (
+	"shaman_cheese",
+	"saved_mice",
+	"saved_mice_hard",
+	"saved_mice_divine",
+
+	"round_played",
+	"cheese_gathered",
+	"first",
+	"bootcamp",
+
+	"survivor_round_played",
+	"survivor_mouse_killed",
+	"survivor_shaman_count",
+	"survivor_survivor_count",
+
+	"racing_round_played",
+	"racing_finished_map",
+	"racing_first",
+	"racing_podium",
+
+	"defilante_round_played",
+	"defilante_finished_map",
+	"defilante_points",
+)
+score_columns = tuple(score_functions) + ("score_overall",)
+
+periods = (
+	("daily", 1),
+	("weekly", 7),
+	("monthly", 30),
+)
+RING = max(days for _, days in periods)  # days of snapshots we keep
+CHUNK = 100000  # rows to process at once
+
+
+class PeriodStore:
+	"""A ring of daily snapshots for a table. The snapshot of a day holds
+	every row that changed that day, with the stats it had before the
+	change, as a sorted ids array and an array per stat column.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+
+	def day_path(self, day, kind):
+		return os.path.join(self.path, "{}.{}.npy".format(day, kind))
+
+	def load(self, day):
+		ids_path = self.day_path(day, "ids")
+		if not os.path.exists(ids_path):
+			return None
+
+		return (
+			np.load(ids_path, mmap_mode="r"),
+			np.load(self.day_path(day, "stats"), mmap_mode="r"),
+		)
+
+	def save(self, day, ids, stats):
+		"""Stores the snapshot of a day. If there already is one (the
+		updater ran twice), the oldest stats win.
+		"""
+		old = self.load(day)
+		if old is not None:
+			ids = np.concatenate((old[0], ids))
+			stats = np.concatenate((old[1], stats), axis=1)
+			ids, first = np.unique(ids, return_index=True)
+			stats = stats[:, first]
+
+		# The ids file is written last, and only then the day exists
+		for kind, array in (("stats", stats), ("ids", ids)):
+			path = self.day_path(day, kind)
+			with open(path + ".tmp", "wb") as file:
+				np.save(file, array)
+			os.replace(path + ".tmp", path)
+
+	def is_empty(self):
+		return not any(
+			name.endswith(".ids.npy") for name in os.listdir(self.path)
+		)
+
+	def prune(self, today):
+		for name in os.listdir(self.path):
+			day = name.split(".")[0]
+			if day.isdigit() and int(day) <= today - RING:
+				os.remove(os.path.join(self.path, name))
+
+	def window(self, today, days):
+		"""Returns the ids that changed in the last given days, and the
+		stats they had before their first change.
+		"""
+		ids, stats = [], []
+		for day in range(today - days + 1, today + 1):
+			snapshot = self.load(day)
+			if snapshot is not None:
+				ids.append(snapshot[0])
+				stats.append(snapshot[1])
+
+		if not ids:
+			return (
+				np.zeros(0, dtype=np.int64),
+				np.zeros((len(stat_columns), 0), dtype=np.int32),
+			)
+
+		# Oldest days come first, so np.unique picks their stats
+		ids, first = np.unique(np.concatenate(ids), return_index=True)
+		return ids, np.concatenate(stats, axis=1)[:, first]
+
+
+def as_arrays(rows):
+	"""Converts rows with an id column and the stat columns to an ids
+	array and a stats array. NULL stats are stored as 0.
+	"""
+	columns = list(zip(*rows))
+	return (
+		np.array(columns[0], dtype=np.int64),
+		np.array(
+			[
+				[value or 0 for value in column]
+				for column in columns[1:]
+			],
+			dtype=np.int32
+		),
+	)
+
+
+async def fetch_arrays(cursor, query):
+	await cursor.execute(query)
+
+	ids, stats = [], []
+	while True:
+		rows = await cursor.fetchmany(CHUNK)
+		if not rows:
+			break
+
+		chunk_ids, chunk_stats = as_arrays(rows)
+		ids.append(chunk_ids)
+		stats.append(chunk_stats)
+
+	if not ids:
+		return (
+			np.zeros(0, dtype=np.int64),
+			np.zeros((len(stat_columns), 0), dtype=np.int32),
+		)
+	return np.concatenate(ids), np.concatenate(stats, axis=1)
+
+
+async def bootstrap(cursor, store, tbl, today):
+	"""Fills a new store with the start of the weekly and monthly windows,
+	taken from the changelog rows last_log points to, so the periods
+	don't lose their history until the ring covers them.
+	"""
+	for unit, days in (("month", 30), ("week", 7)):
+		start = date.fromordinal(today - days)
+		ids, stats = await fetch_arrays(
+			cursor,
+			"SELECT `ptr`.`id`, {} \
+			FROM `last_log` as `ptr` \
+			INNER JOIN `{}_changelog` as `o` ON `o`.`log_id` = `ptr`.`{}` \
+			WHERE `ptr`.`tribe` = {} AND `o`.`log_date` >= '{}' \
+			ORDER BY `ptr`.`id`"
+			.format(
+				",".join("`o`.`{}`".format(col) for col in stat_columns),
+				tbl.name, unit,
+				1 if tbl.name == "tribe_stats" else 0,
+				start.strftime("%Y-%m-%d"),
+			)
+		)
+		if len(ids):
+			store.save(today - days + 1, ids, stats)
+
+
+class PeriodTarget:
+	"""Builds a period table in the background and swaps it in at once,
+	so readers never see it half written.
+	"""
+
+	def __init__(self, name, period, start_ids, start_stats):
+		self.name = name
+		self.next = "{}_next".format(name)
+		self.prev = "{}_prev".format(name)
+
+		self.start_ids = start_ids
+		self.start_stats = start_stats
+
+		self.scorer = Scorer(stat_columns, score_columns, period)
+		self.query = (
+			"INSERT INTO `{}` (`id`, `{}`) VALUES ({})"
+			.format(
+				self.next,
+				"`,`".join(stat_columns + score_columns),
+				",".join(["%s"] * (1 + len(stat_columns) + len(score_columns)))
+			)
+		)
+
+	async def prepare(self, cursor):
+		# A run that died while swapping may have left _prev behind
+		await cursor.execute("DROP TABLE IF EXISTS `{}`".format(self.prev))
+		await cursor.execute("DROP TABLE IF EXISTS `{}`".format(self.next))
+		await cursor.execute(
+			"CREATE TABLE `{}` LIKE `{}`".format(self.next, self.name)
+		)
+
+	async def write(self, cursor, ids, stats):
+		"""Writes the rows of a chunk of current data that belong to
+		this period.
+		"""
+		if not len(self.start_ids):
+			return
+
+		idx = np.searchsorted(self.start_ids, ids)
+		idx = np.minimum(idx, len(self.start_ids) - 1)
+		mask = self.start_ids[idx] == ids
+		if not mask.any():
+			return
+
+		ids = ids[mask]
+		deltas = stats[:, mask].astype(np.int64) \
+			- self.start_stats[:, idx[mask]].astype(np.int64)
+
+		scores = self.scorer.calculate_columns(Columns(arrays={
+			name: deltas[column].astype(float)
+			for column, name in enumerate(stat_columns)
+		}))
+
+		await cursor.executemany(self.query, list(zip(
+			ids.tolist(),
+			*(column.tolist() for column in deltas),
+			*(as_list(scores[name]) for name in score_columns)
+		)))
+
+	async def swap(self, cursor):
+		await cursor.execute(
+			"RENAME TABLE `{0}` TO `{1}`, `{2}` TO `{0}`"
+			.format(self.name, self.prev, self.next)
+		)
+		await cursor.execute("DROP TABLE `{}`".format(self.prev))
+
+
+async def write_periods(tbl, pool):
+	"""Calculates the daily, weekly and monthly tables of a table from
+	its snapshots, reading its current data only once.
+	"""
+	if tbl.is_empty:
+		# No historic data to use
+		return
+
+	if tbl.name == "tribe_stats":
+		prefix, changed, old = "tribe", "tribe_active", "tribe_stats_old"
+	else:
+		prefix, changed, old = tbl.name, "player_new", "player_old"
+
+	store = PeriodStore(os.path.join(env.period_dir, tbl.name))
+	today = date.today().toordinal()
+
+	async with pool.acquire() as read, pool.acquire() as write:
+		reader_ctx = read.cursor(aiomysql.SSCursor)
+		async with reader_ctx as reader, write.cursor() as writer:
+			if store.is_empty():
+				logging.debug(
+					"[{}] bootstrapping snapshots from the changelogs"
+					.format(prefix)
+				)
+				await bootstrap(reader, store, tbl, today)
+
+			logging.debug("[{}] storing today's snapshot".format(prefix))
+			ids, stats = await fetch_arrays(
+				reader,
+				"SELECT `c`.`id`, {} \
+				FROM `{}` as `c` \
+				LEFT JOIN `{}` as `o` ON `o`.`id` = `c`.`id` \
+				ORDER BY `c`.`id`"
+				.format(
+					",".join("`o`.`{}`".format(col) for col in stat_columns),
+					changed, old
+				)
+			)
+			store.save(today, ids, stats)
+			store.prune(today)
+
+			targets = []
+			for period, days in periods:
+				start_ids, start_stats = store.window(today, days)
+				target = PeriodTarget(
+					"{}_{}".format(prefix, period), period,
+					start_ids, start_stats
+				)
+				await target.prepare(writer)
+				targets.append(target)
+
+			# The longest period contains every other one
+			needed = targets[-1].start_ids
+			logging.debug(
+				"[{}] reading current data of {} rows"
+				.format(prefix, len(needed))
+			)
+
+			# Temporary tables only exist in the connection that made them
+			await reader.execute(
+				"CREATE TEMPORARY TABLE IF NOT EXISTS `period_ids` \
+				(`id` bigint(20) NOT NULL, PRIMARY KEY (`id`)) \
+				ENGINE=MyISAM"
+			)
+			await reader.execute("TRUNCATE `period_ids`")
+			for start in range(0, len(needed), CHUNK):
+				await reader.executemany(
+					"INSERT INTO `period_ids` (`id`) VALUES (%s)",
+					needed[start:start + CHUNK].tolist()
+				)
+
+			await reader.execute(
+				"SELECT `c`.`id`, {} \
+				FROM `{}` as `c` \
+				INNER JOIN `period_ids` as `p` ON `p`.`id` = `c`.`id` \
+				ORDER BY `c`.`id`"
+				.format(
+					",".join("`c`.`{}`".format(col) for col in stat_columns),
+					tbl.name
+				)
+			)
+			while True:
+				rows = await reader.fetchmany(CHUNK)
+				if not rows:
+					break
+
+				ids, stats = as_arrays(rows)
+				for target in targets:
+					await target.write(writer, ids, stats)
+
+			for target in targets:
+				logging.debug("[{}] publishing".format(target.name))
+				await target.swap(writer)
+
+	logging.debug("[{}] periods done".format(prefix))
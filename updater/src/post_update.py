@@ -1,224 +1,172 @@
-import asyncio
 import logging
+import aiomysql
 
 from datetime import datetime, timedelta
 
-from table import Table
 from utils import env
-from formulas import formulas, overall_scores
+from aggregate import aggregate_tribes, replace_query
+from scoring import Scorer
 
 
-stat_columns = (
-	"shaman_cheese",
-	"saved_mice",
-	"saved_mice_hard",
-	"saved_mice_divine",
+BATCH = 1000  # tribes written at once
 
-	"round_played",
-	"cheese_gathered",
-	"first",
-	"bootcamp",
 
-	"survivor_round_played",
-	"survivor_mouse_killed",
-	"survivor_shaman_count",
-	"survivor_survivor_count",
-
-	"racing_round_played",
-	"racing_finished_map",
-	"racing_first",
-	"racing_podium",
-
-	"defilante_round_played",
-	"defilante_finished_map",
-	"defilante_points",
-)
+async def update_tribes(player, tribe, member, stats, cfm):
+	# Extract stats info
+	await stats.extract_info(cfm, env.cfm_db)
 
+	async with cfm.acquire() as conn:
+		async with conn.cursor() as inte:
+			# Finding the affected tribes needs every table's old data,
+			# and to know which disqualifications changed
+			full = player.is_empty or tribe.is_empty or member.is_empty
+			if full or player.disqualified is None:
+				await write_tribe_logs(tribe, stats, cfm, inte)
+			else:
+				await write_tribe_changes(player, stats, conn, inte)
 
-async def post_update(player, tribe, member, cfm, a801):
-	tribe_stats = Table("tribe_stats")
-	# Extract stats info
-	await tribe_stats.extract_info(cfm, env.cfm_db, hashes=False)
 
+async def write_log_pointers(tbl, cfm):
 	async with cfm.acquire() as conn:
 		async with conn.cursor() as inte:
-			await write_tribe_logs(tribe, tribe_stats, inte)
-
-			for table in ("player", "tribe_stats"):
-				await update_log_pointers(table, inte)
-
-	return await asyncio.wait([
-		write_periodic_rank(tbl, period, days, cfm)
-		for (tbl, period, days) in (
-			(player, "daily", 1),
-			(player, "weekly", 7),
-			(player, "monthly", 30),
-			(tribe_stats, "daily", 1),
-			(tribe_stats, "weekly", 7),
-			(tribe_stats, "monthly", 30),
-		)
-	])
+			await update_log_pointers(tbl, inte)
 
 
-async def update_log_pointers(tbl, inte):
-	tribe = 1 if tbl == "tribe_stats" else 0
-	logging.debug("[{}] inserting new log pointers".format(tbl))
+async def log_bounds(changelog, start, end, inte):
+	"""Returns the [first, last) log ids written between two dates, or
+	None if there are none. log_id grows with log_date, so both bounds
+	are found through the log_date index.
+	"""
 	await inte.execute(
-		"INSERT INTO `last_log` (`tribe`, `id`) \
-		SELECT \
-			{tribe} as `tribe`, \
-			`new`.`id` \
-		FROM \
-			`{table}` as `new` \
-			LEFT JOIN `last_log` as `ptr` \
-				ON `ptr`.`tribe` = {tribe} AND `ptr`.`id` = `new`.`id` \
-		WHERE `ptr`.`id` IS NULL"
+		"SELECT \
+			(SELECT MIN(`log_id`) FROM `{0}` WHERE `log_date` >= '{1}'), \
+			(SELECT MIN(`log_id`) FROM `{0}` WHERE `log_date` >= '{2}')"
 		.format(
-			tribe=tribe,
-			table="player_new" if tbl == "player" else "tribe_active",
+			changelog,
+			start.strftime("%Y-%m-%d"),
+			end.strftime("%Y-%m-%d"),
 		)
 	)
+	first, last = await inte.fetchone()
+	if first is None or first == last:
+		return None
+	return first, last
 
+
+async def update_log_pointers(tbl, inte):
+	tribe = 1 if tbl.name == "tribe_stats" else 0
+	changelog = "{}_changelog".format(tbl.name)
+
+	# Logs written in this run are the latest ones
+	ranges = {}
+	if tbl.log_range is not None:
+		ranges["latest"] = tbl.log_range
+
+	now = datetime.now()
 	for days, period in (
-		(0, "latest"),
 		(1, "day"),
 		(7, "week"),
 		(30, "month"),
 	):
-		logging.debug(
-			"[{}] updating log pointers for a {} ago".format(tbl, period)
+		bounds = await log_bounds(
+			changelog,
+			now - timedelta(days=days),
+			now - timedelta(days=days - 1),
+			inte
 		)
+		if bounds is not None:
+			ranges[period] = bounds
 
-		start = datetime.now() - timedelta(days=days)
-		end = datetime.now() - timedelta(days=days - 1)
-		await inte.execute(
-			"UPDATE \
-				`last_log` as `ptr` \
-				INNER JOIN `{table}` as `log` \
-					ON `log`.`id` = `ptr`.`id` \
-					AND `log`.`log_date` >= '{start}' \
-					AND `log`.`log_date` < '{end}' \
-			SET `{period}` = `log`.`log_id` \
-			WHERE `ptr`.`tribe` = {tribe}"
-			.format(
-				tribe=tribe,
-				start=start.strftime("%Y-%m-%d"),
-				end=end.strftime("%Y-%m-%d"),
-				period=period,
-				table=f"{tbl}_changelog"
-			)
-		)
-
-
-async def write_periodic_rank(tbl, period, days, pool):
-	async with pool.acquire() as conn:
-		async with conn.cursor() as cursor:
-			return await _write_periodic_rank(tbl, period, days, cursor)
-
-
-async def _write_periodic_rank(tbl, period, days, inte):
-	if tbl.is_empty:
-		# No historic data to use
+	if not ranges:
 		return
 
-	if tbl.name == "tribe_stats":
-		format_name = "tribe@{}".format(period)
-		target = "tribe_{}".format(period)
-	else:
-		format_name = "{}@{}".format(tbl.name, period)
-		target = "{}_{}".format(tbl.name, period)
-
-	columns = "`,`".join(stat_columns)
-	calculations = ",".join([
-		"`c`.`{0}` - `o`.`{0}`"
-		.format(column)
-		for column in stat_columns
-	])
-	log = "{}_changelog".format(tbl.name)
-	score_formulas = ",".join([
-		"`{}` = {}"
-		.format(column, formula)
-		for column, formula in formulas.items()
-	])
-
-	if period == "daily":
-		period_unit = "day"
-	elif period == "weekly":
-		period_unit = "week"
-	elif period == "monthly":
-		period_unit = "month"
-
-	logging.debug("[{}] fetching start point".format(format_name))
-	start = datetime.now() - timedelta(days=days - 1)
+	def in_range(period):
+		first, last = ranges[period]
+		if last is None:
+			return "`log_id` >= {}".format(first)
+		return "`log_id` >= {} AND `log_id` < {}".format(first, last)
+
+	logging.debug("[{}] calculating log pointers".format(tbl.name))
+	# Everything is read from the changelog in a single pass, without
+	# holding the last_log lock
 	await inte.execute(
-		"SELECT MIN(`log_id`) \
-		FROM `{log}` \
-		WHERE `log_date` >= '{start}' \
-		LIMIT 1"
-		.format(
-			log=log,
-			start=start.strftime("%Y-%m-%d"),
-		)
+		"CREATE TEMPORARY TABLE IF NOT EXISTS `log_pointers` \
+		LIKE `last_log`"
 	)
-	row = await inte.fetchone()
-	await inte.fetchone()
-
-	await inte.execute(f"TRUNCATE `{target}`")
-	logging.debug("[{}] calculating periods".format(format_name))
+	await inte.execute("TRUNCATE `log_pointers`")
 	await inte.execute(
-		"INSERT INTO \
-			`{target}` (`id`, `{columns}`) \
-		SELECT \
-			`ptr`.`id`, \
-			{calculations} \
-		FROM \
-			`last_log` as `ptr` \
-			INNER JOIN `{log}` as `o` \
-				ON `ptr`.`{period}` = `o`.`log_id` \
-			INNER JOIN `{log}` as `c` \
-				ON `ptr`.`latest` = `c`.`log_id` \
-		WHERE \
-			`ptr`.`tribe` = {tribe} \
-			AND `ptr`.`latest` >= {start}"
+		"INSERT INTO `log_pointers` (`tribe`, `id`, `{periods}`) \
+		SELECT {tribe}, `id`, {pointers} \
+		FROM `{table}` \
+		WHERE {ranges} \
+		GROUP BY `id`"
 		.format(
-			target=target,
-			columns=columns,
-			calculations=calculations,
-			log=log,
-			tribe=1 if tbl.name == "tribe_stats" else 0,
-			start=row[0],
-			period=period_unit,
+			tribe=tribe,
+			table=changelog,
+			periods="`,`".join(ranges),
+			pointers=",".join(
+				"MAX(IF({}, `log_id`, NULL))".format(in_range(period))
+				for period in ranges
+			),
+			ranges=" OR ".join(
+				"({})".format(in_range(period))
+				for period in ranges
+			),
 		)
 	)
 
-	logging.debug("[{}] calculating scores".format(format_name))
+	logging.debug("[{}] updating log pointers".format(tbl.name))
 	await inte.execute(
-		"UPDATE `{target}` \
-		SET {formulas}"
+		"INSERT INTO `last_log` (`tribe`, `id`, `{periods}`) \
+		SELECT `tribe`, `id`, `{periods}` FROM `log_pointers` \
+		ON DUPLICATE KEY UPDATE {updates}"
 		.format(
-			target=target,
-			formulas=score_formulas,
+			periods="`,`".join(ranges),
+			updates=",".join(
+				"`{0}` = IFNULL(VALUES(`{0}`), `{0}`)".format(period)
+				for period in ranges
+			),
 		)
 	)
 
-	logging.debug("[{}] calculating overall score".format(format_name))
+
+async def write_tribe_changes(player, stats, conn, inte):
+	stats.is_empty = False
+	written = await aggregate_tribes(player, stats, conn)
+
+	# Every tribe whose stats were written goes into tribe_active, so the
+	# changelog, periods and feed see the ones that only lost members too
+	logging.debug("[tribe] writing changed tribes")
+	await inte.execute("TRUNCATE `tribe_active`")
+	await inte.executemany(
+		"INSERT INTO `tribe_active` (`id`, `members`, `active`) \
+		VALUES (%s, %s, %s)",
+		written
+	)
+
+	await write_tribe_changelog(stats, inte)
+
+
+async def write_tribe_changelog(stats, inte):
+	logging.debug("[tribe] write stats changelogs")
 	await inte.execute(
-		"UPDATE `{target}` \
-		SET \
-			`score_overall` = {formula}"
+		"INSERT INTO `tribe_stats_changelog` (`{}`) \
+		SELECT `o`.* \
+		FROM `tribe_active` as `n` \
+		INNER JOIN `tribe_stats` as `o` ON `n`.`id` = `o`.`id`"
 		.format(
-			target=target,
-			formula=overall_scores[period]
+			"`,`".join(stats.write_columns)
 		)
 	)
-
-	logging.debug("[{}] done".format(format_name))
+	stats.record_logs(inte)
 
 
-async def write_tribe_logs(tribe, stats, inte):
+async def write_tribe_logs(tribe, stats, cfm, inte):
 	if not tribe.is_empty:
 		stats.is_empty = False
 		logging.debug("[tribe] calculating active tribes")
+		# Members are counted like everywhere else: the ones that have
+		# stats and aren't disqualified
 
 		await inte.execute("TRUNCATE `tribe_active`")
 		await inte.execute(
@@ -228,18 +176,32 @@ async def write_tribe_logs(tribe, stats, inte):
 			SELECT \
 				`t`.`id`, \
 				COUNT(`m`.`id_member`) as `members`, \
-				COUNT(`p`.`id`) as `active` \
+				COUNT(`p_n`.`id`) as `active` \
 			FROM \
 				`tribe` as `t` \
 				INNER JOIN `member` as `m` \
 					ON `t`.`id` = `m`.`id_tribe` \
-				LEFT JOIN `player_new` as `p` \
-					ON `m`.`id_member` = `p`.`id` \
+				INNER JOIN `player` as `p` \
+					ON `p`.`id` = `m`.`id_member` \
+				LEFT JOIN `disqualified` as `d` \
+					ON `d`.`id` = `p`.`id` \
+				LEFT JOIN `player_new` as `p_n` \
+					ON `p_n`.`id` = `p`.`id` \
+			WHERE `d`.`id` IS NULL \
 			GROUP BY `t`.`id` \
 			HAVING `active` > 0"
 		)
 
-	logging.debug("[tribe] calculating stats")
+		logging.debug("[tribe] saving old stats")
+		await inte.execute("TRUNCATE `tribe_stats_old`")
+		await inte.execute(
+			"INSERT INTO `tribe_stats_old` \
+			SELECT `s`.* \
+			FROM `tribe_stats` as `s` \
+			INNER JOIN `tribe_active` as `a` ON `a`.`id` = `s`.`id`"
+		)
+
+	logging.debug("[tribe] calculating stats and scores")
 
 	# Prepare query
 	stats_columns = ["id", "members", "active"]
@@ -266,73 +228,45 @@ async def write_tribe_logs(tribe, stats, inte):
 			)
 			stats_columns.append(column)
 
-	# Run query
-	await inte.execute(
-		"REPLACE INTO `tribe_stats` (`{3}`) \
-		SELECT \
-			`t`.`id`, \
-			{0} \
-		FROM \
-			`tribe{1}` as `t` \
-			INNER JOIN `member` as `m` \
-				ON `t`.`id` = `m`.`id_tribe` \
-			INNER JOIN `player` as `p` \
-				ON `p`.`id` = `m`.`id_member` \
-			LEFT JOIN `disqualified` as `d` \
-				ON `d`.`id` = `p`.`id` \
-			{2} \
-		WHERE `d`.`id` IS NULL \
-		GROUP BY `t`.`id`"
-		.format(
-			",".join(columns),
-			"" if tribe.is_empty else "_active",
+	# Scores are calculated here, the same way as in every other path
+	scorer = Scorer(stats_columns, stats.score_columns)
+	query = replace_query(stats_columns, stats.score_columns)
 
-			"LEFT JOIN `player_new` as `p_n` ON `p_n`.`id` = `p`.`id`"
-			if tribe.is_empty else
-			# No need to join player_new if we are using tribe_active
-			"",
-
-			"`,`".join(stats_columns),
-		)
-	)
+	async with cfm.acquire() as conn:
+		async with conn.cursor(aiomysql.SSCursor) as reader:
+			await reader.execute(
+				"SELECT \
+					`t`.`id`, \
+					{0} \
+				FROM \
+					`tribe{1}` as `t` \
+					INNER JOIN `member` as `m` \
+						ON `t`.`id` = `m`.`id_tribe` \
+					INNER JOIN `player` as `p` \
+						ON `p`.`id` = `m`.`id_member` \
+					LEFT JOIN `disqualified` as `d` \
+						ON `d`.`id` = `p`.`id` \
+					{2} \
+				WHERE `d`.`id` IS NULL \
+				GROUP BY `t`.`id`"
+				.format(
+					",".join(columns),
+					"" if tribe.is_empty else "_active",
+
+					"LEFT JOIN `player_new` as `p_n` ON `p_n`.`id` = `p`.`id`"
+					if tribe.is_empty else
+					# No need to join player_new if we are using tribe_active
+					"",
+				)
+			)
 
-	logging.debug("[tribe] calculating scores")
-	await inte.execute(
-		"UPDATE `tribe_stats` as `t` {1} \
-		SET {0}"
-		.format(
-			",".join((
-				"`t`.`{}` = {}"
-				.format(column, formula)
-				for column, formula in formulas.items()
-			)),
-
-			""
-			if tribe.is_empty else
-			"INNER JOIN `tribe_active` as `a` ON `a`.`id` = `t`.`id`"
-		)
-	)
-	await inte.execute(
-		"UPDATE `tribe_stats` as `t` {1} \
-		SET `t`.`score_overall` = {0}"
-		.format(
-			overall_scores["alltime"],
+			while True:
+				rows = await reader.fetchmany(BATCH)
+				if not rows:
+					break
 
-			""
-			if tribe.is_empty else
-			"INNER JOIN `tribe_active` as `a` ON `a`.`id` = `t`.`id`"
-		)
-	)
+				await inte.executemany(query, scorer.apply(rows))
 
 	# Write changelogs
 	if not tribe.is_empty:
-		logging.debug("[tribe] write stats changelogs")
-		await inte.execute(
-			"INSERT INTO `tribe_stats_changelog` (`{}`) \
-			SELECT `o`.* \
-			FROM `tribe_active` as `n` \
-			INNER JOIN `tribe_stats` as `o` ON `n`.`id` = `o`.`id`"
-			.format(
-				"`,`".join(stats.write_columns)
-			)
-		)
+		await write_tribe_changelog(stats, inte)
@@ -0,0 +1,156 @@
+import time
+import asyncio
+import logging
+
+
+class Step:
+	"""A step of the update job. It can start once every step writing
+	one of its inputs is done, and while it runs it holds the given
+	amount of database connections from the scheduler budget.
+	"""
+
+	def __init__(self, name, func, inputs=(), outputs=(), connections=1):
+		self.name = name
+		self.func = func  # coroutine function without arguments
+		self.inputs = set(inputs)
+		self.outputs = set(outputs)
+		self.connections = connections
+
+		self.depends = []
+		self.ready = None  # when every input was ready
+		self.start = None
+		self.end = None
+		self.failed = False
+		self.skipped = False
+
+	@property
+	def duration(self):
+		if self.start is None or self.end is None:
+			return 0
+		return self.end - self.start
+
+
+class Scheduler:
+	"""Runs steps as soon as their inputs are ready, in parallel, without
+	going over a budget of connections.
+	"""
+
+	def __init__(self, budget):
+		self.budget = budget
+		self.available = budget
+		self.steps = []
+		self.start = None
+
+	def add(self, *args, **kwargs):
+		step = Step(*args, **kwargs)
+		self.steps.append(step)
+		return step
+
+	def resolve(self):
+		writers = {}
+		for step in self.steps:
+			for output in step.outputs:
+				writers.setdefault(output, []).append(step)
+
+		for step in self.steps:
+			step.depends = [
+				writer
+				for resource in step.inputs
+				for writer in writers.get(resource, ())
+				if writer is not step
+			]
+
+	async def run(self):
+		"""Runs every step. Returns whether all of them succeeded."""
+		self.resolve()
+		self.start = time.monotonic()
+		budget = asyncio.Condition()
+		tasks = {}
+
+		async def run_step(step):
+			for dependency in step.depends:
+				await tasks[dependency]
+
+			if any(dep.failed or dep.skipped for dep in step.depends):
+				logging.error("[{}] skipped, an input failed".format(step.name))
+				step.skipped = True
+				return
+
+			step.ready = time.monotonic()
+			needed = min(step.connections, self.budget)
+			async with budget:
+				await budget.wait_for(lambda: self.available >= needed)
+				self.available -= needed
+
+			step.start = time.monotonic()
+			try:
+				await step.func()
+			except Exception:
+				logging.exception("[{}] failed".format(step.name))
+				step.failed = True
+			finally:
+				step.end = time.monotonic()
+
+				async with budget:
+					self.available += needed
+					budget.notify_all()
+
+		# Tasks only start once all of them exist, so every dependency
+		# has a task to wait for
+		for step in self.steps:
+			tasks[step] = asyncio.ensure_future(run_step(step))
+		await asyncio.gather(*tasks.values())
+
+		self.report()
+		return not any(step.failed or step.skipped for step in self.steps)
+
+	def critical_path(self):
+		"""Returns the chain of steps that determined the total time:
+		the last step to finish, the dependency that finished right
+		before it started, and so on.
+		"""
+		done = [step for step in self.steps if step.end is not None]
+		if not done:
+			return []
+
+		path = [max(done, key=lambda step: step.end)]
+		while True:
+			depends = [dep for dep in path[-1].depends if dep.end is not None]
+			if not depends:
+				break
+			path.append(max(depends, key=lambda step: step.end))
+
+		return path[::-1]
+
+	def report(self):
+		logging.info("[schedule] step timings:")
+		for step in self.steps:
+			if step.start is None:
+				logging.info("[schedule]   {:<24} not run".format(step.name))
+				continue
+
+			logging.info(
+				"[schedule]   {:<24} start {:>8.1f}s  took {:>8.1f}s  "
+				"waited {:>6.1f}s for connections{}"
+				.format(
+					step.name,
+					step.start - self.start,
+					step.duration,
+					step.start - step.ready,
+					"  FAILED" if step.failed else "",
+				)
+			)
+
+		path = self.critical_path()
+		if path:
+			logging.info(
+				"[schedule] critical path ({:.1f}s of {:.1f}s): {}"
+				.format(
+					sum(step.duration for step in path),
+					path[-1].end - self.start,
+					" -> ".join(
+						"{} ({:.1f}s)".format(step.name, step.duration)
+						for step in path
+					),
+				)
+			)
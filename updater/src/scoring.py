@@ -0,0 +1,133 @@
+import numpy as np
+
+from formulas import score_functions, overall_functions, decimal_scores
+
+
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+# Digits MySQL adds to the scale of a DECIMAL division
+# (div_precision_increment)
+DIV_SCALE = 4
+
+
+def round_half_up(array):
+	"""Rounds half away from zero"""
+	return np.sign(array) * np.floor(np.abs(array) + 0.5)
+
+
+class numpy_functions:
+	power = staticmethod(np.power)
+	greatest = staticmethod(np.maximum)
+
+	@staticmethod
+	def ifnull(value, default):
+		return np.where(np.isnan(value), default, value)
+
+	@staticmethod
+	def decimal(value, scale):
+		"""A DECIMAL expression with scale digits: drops the float error
+		MySQL doesn't have.
+		"""
+		return np.round(value, scale)
+
+	@staticmethod
+	def decimal_div(value, literal):
+		"""An INT divided by a decimal literal is a DECIMAL with
+		DIV_SCALE digits, rounded half away from zero.
+		"""
+		scale = 10 ** DIV_SCALE
+		return round_half_up(value / literal * scale) / scale
+
+
+class Columns:
+	"""Gives access to the columns of a batch as float arrays.
+	NULL values are represented as NaN.
+	"""
+
+	def __init__(self, names=(), rows=(), arrays=None):
+		self.index = {name: idx for idx, name in enumerate(names)}
+		self.values = list(zip(*rows))
+		self.arrays = {} if arrays is None else dict(arrays)
+
+	def __getattr__(self, name):
+		if name not in self.arrays:
+			self.arrays[name] = np.array(
+				self.values[self.index[name]], dtype=float
+			)
+		return self.arrays[name]
+
+	def store(self, name, array):
+		self.arrays[name] = array
+
+
+def as_int_column(array, decimal=False):
+	"""Mimics MySQL storing an expression in an INT column: division by
+	0 turns into NULL, and values are rounded and clamped. A DOUBLE is
+	rounded half to even (like rint), a DECIMAL half away from zero.
+	"""
+	array[~np.isfinite(array)] = np.nan
+	if decimal:
+		# Sums of DECIMALs are exact, so drop the float error first
+		array = round_half_up(np.round(array, DIV_SCALE))
+	else:
+		array = np.rint(array)
+	return np.clip(array, INT_MIN, INT_MAX)
+
+
+def as_list(array):
+	"""Converts a score array to a list of ints (or None)"""
+	return [
+		None if value != value else int(value)
+		for value in array.tolist()
+	]
+
+
+class Scorer:
+	"""Calculates the composite scores of fetched rows, so they don't
+	have to be calculated by any database.
+	"""
+
+	def __init__(self, columns, scores, period="alltime"):
+		self.columns = columns
+		self.scores = scores
+		self.overall = overall_functions[period]
+
+	def calculate_columns(self, columns):
+		"""Returns a dict with the score arrays of the given Columns.
+		NULL scores are represented as NaN.
+		"""
+		# score_overall uses the (already rounded) scores, like the SQL
+		# version does, so it has to be calculated last
+		order = sorted(self.scores, key=lambda name: name == "score_overall")
+
+		result = {}
+		with np.errstate(divide="ignore", invalid="ignore"):
+			for name in order:
+				if name == "score_overall":
+					array = self.overall(columns, numpy_functions)
+				else:
+					array = score_functions[name](columns, numpy_functions)
+
+				result[name] = as_int_column(array, name in decimal_scores)
+				columns.store(name, result[name])
+
+		return result
+
+	def calculate(self, rows):
+		"""Returns the score columns of the given rows, as a list of
+		tuples sorted like self.scores
+		"""
+		result = self.calculate_columns(Columns(self.columns, rows))
+		return list(zip(*(
+			as_list(result[name])
+			for name in self.scores
+		)))
+
+	def apply(self, rows):
+		"""Appends the score columns to every row"""
+		if not rows:
+			return rows
+
+		return [
+			tuple(row) + scores
+			for row, scores in zip(rows, self.calculate(rows))
+		]
@@ -0,0 +1,182 @@
+import os
+import mmap
+import shutil
+import struct
+
+from array import array
+from bisect import bisect_left
+
+
+# magic, version, row count
+HEADER = struct.Struct("<4sIQ")
+MAGIC = b"CFMH"
+VERSION = 1
+
+FLUSH_SIZE = 65536  # rows to buffer before writing them to disk
+
+assert array("q").itemsize == 8 and array("I").itemsize == 4
+
+
+class HashSnapshot:
+	"""A read-only view of the hashes file of a table.
+
+	The file holds a header followed by all the ids (int64, sorted) and
+	then all the hashes (uint32), so both columns can be read straight
+	from the memory map without unpacking any tuple.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+
+		self.ids = None
+		self.hashes = None
+
+		self._file = None
+		self._map = None
+
+	def validate(self):
+		"""Checks the header and size of the file without mapping it.
+		Returns the row count, or raises ValueError if it is corrupt.
+		"""
+		with open(self.path, "rb") as file:
+			header = file.read(HEADER.size)
+			size = os.fstat(file.fileno()).st_size
+
+		if len(header) < HEADER.size:
+			raise ValueError("{} is truncated".format(self.path))
+
+		magic, version, count = HEADER.unpack(header)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError("{} is not a hash snapshot".format(self.path))
+
+		if size != HEADER.size + count * 12:
+			raise ValueError("{} is truncated".format(self.path))
+		return count
+
+	def open(self):
+		count = self.validate()
+		self._file = open(self.path, "rb")
+		self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		ids_end = HEADER.size + count * 8
+		view = memoryview(self._map)
+		self.ids = view[HEADER.size:ids_end].cast("q")
+		self.hashes = view[ids_end:].cast("I")
+
+	def bounds(self, shard):
+		"""Returns the slice of the snapshot that belongs to a shard"""
+		if shard is None:
+			return 0, len(self.ids)
+
+		start, end = shard
+		return (
+			0 if start is None else bisect_left(self.ids, start),
+			len(self.ids) if end is None else bisect_left(self.ids, end),
+		)
+
+	def close(self):
+		if self.ids is not None:
+			self.ids.release()
+			self.hashes.release()
+			self.ids = self.hashes = None
+
+		if self._map is not None:
+			self._map.close()
+			self._file.close()
+			self._map = self._file = None
+
+
+class SnapshotPart:
+	"""Stores a sorted range of (id, hash) pairs in temporary files.
+	Parts are joined together when the snapshot is committed.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.count = 0
+
+		self.ids = array("q")
+		self.hashes = array("I")
+
+		self._ids = open(path + ".ids", "wb")
+		self._hashes = open(path + ".hashes", "wb")
+
+	def append(self, _id, hashed):
+		self.ids.append(_id)
+		self.hashes.append(hashed)
+
+		if len(self.ids) >= FLUSH_SIZE:
+			self.flush()
+
+	def extend(self, ids, hashes):
+		"""Appends packed ids and hashes (as made by array.tobytes)"""
+		self.ids.frombytes(ids)
+		self.hashes.frombytes(hashes)
+
+		if len(self.ids) >= FLUSH_SIZE:
+			self.flush()
+
+	def flush(self):
+		self.ids.tofile(self._ids)
+		self.hashes.tofile(self._hashes)
+		self.count += len(self.ids)
+
+		del self.ids[:]
+		del self.hashes[:]
+
+	def close(self):
+		if self._ids.closed:
+			return
+
+		self.flush()
+		self._ids.close()
+		self._hashes.close()
+
+	def remove(self):
+		self.close()
+		os.remove(self.path + ".ids")
+		os.remove(self.path + ".hashes")
+
+
+class SnapshotWriter:
+	"""Builds the next hashes file of a table. Nothing is visible until
+	commit is called, which atomically replaces the old file.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.parts = []
+
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+	def part(self):
+		"""Creates a new part. Parts must be created in id order."""
+		part = SnapshotPart("{}.part{}".format(self.path, len(self.parts)))
+		self.parts.append(part)
+		return part
+
+	def commit(self):
+		for part in self.parts:
+			part.close()
+
+		tmp = self.path + ".tmp"
+		with open(tmp, "wb") as target:
+			target.write(HEADER.pack(
+				MAGIC, VERSION, sum(part.count for part in self.parts)
+			))
+
+			for suffix in (".ids", ".hashes"):
+				for part in self.parts:
+					with open(part.path + suffix, "rb") as source:
+						shutil.copyfileobj(source, target)
+
+			target.flush()
+			os.fsync(target.fileno())
+
+		os.replace(tmp, self.path)
+		self.discard()
+
+	def discard(self):
+		for part in self.parts:
+			part.remove()
+		self.parts = []
@@ -1,10 +1,17 @@
 import os
 import asyncio
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
 import logging
 import aiomysql
 
+from checkpoint import Checkpoint
 from download import RunnerPool
-from post_update import post_update
+from feed import write_feed, feed_path
+from periods import write_periods
+from post_update import update_tribes, write_log_pointers
+from scheduler import Scheduler
 from table import Table
 from utils import env
 
@@ -23,6 +30,39 @@ except ImportError:
 	logging.warning("Can't use uvloop.")
 
 
+SHARDS = int(os.getenv("SHARDS", "1"))
+# 3 tables are extracted at once, and every shard keeps up to
+# 2 connections open in each pool (load & delete / grab & fetch)
+POOL_SIZE = max(10, 3 * (2 * SHARDS + 2))
+
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "100"))
+# Stages that talk to a database may start with their own batch size
+STAGE_BATCHES = {
+	stage: int(os.getenv("{}_BATCH_SIZE".format(stage.upper()), BATCH_SIZE))
+	for stage in ("grab", "fetch", "update")
+}
+# and tune it within these bounds, unless ADAPTIVE_BATCH=0
+BATCH_BOUNDS = None
+if os.getenv("ADAPTIVE_BATCH", "1") != "0":
+	BATCH_BOUNDS = (
+		int(os.getenv("BATCH_MIN", "10")),
+		int(os.getenv("BATCH_MAX", "5000")),
+	)
+
+
+# Fetch batches of at least this size join a temporary table of ids
+# instead of using an IN list (0 to disable)
+FETCH_JOIN = int(os.getenv("FETCH_JOIN_SIZE", "1000")) or None
+# Tables written with LOAD DATA LOCAL INFILE (comma separated)
+BULK_TABLES = set(filter(None, os.getenv("BULK_LOAD", "").split(",")))
+# Processes for the CPU heavy stages (0 runs them in the event loop)
+WORKERS = int(os.getenv("WORKERS", "0"))
+# Tables published by swapping in a rebuilt copy (comma separated)
+SWAP_TABLES = set(filter(None, os.getenv("SWAP_PUBLISH", "").split(",")))
+# A run that failed this many resumes is discarded instead
+MAX_RESUMES = int(os.getenv("MAX_RESUMES", "3"))
+
+
 def start(loop):
 	return loop.run_until_complete(asyncio.gather(
 		# CFM DB
@@ -30,19 +70,21 @@ def start(loop):
 			host=env.cfm_ip, port=3306,
 			user=env.cfm_user, password=env.cfm_pass,
 			db=env.cfm_db, loop=loop,
-			autocommit=True
+			autocommit=True, maxsize=POOL_SIZE,
+			local_infile=bool(BULK_TABLES)
 		),
 
 		# Atelier801 API
 		aiomysql.create_pool(
 			host=env.a801_ip, port=3306,
 			user=env.a801_user, password=env.a801_pass,
-			db=env.a801_db, loop=loop
+			db=env.a801_db, loop=loop,
+			maxsize=POOL_SIZE
 		),
 	))
 
 
-async def notify_redis():
+async def notify_redis(run):
 	if ":" in env.host:
 		address = env.host.split(":")
 		address[1] = int(address[1])
@@ -55,28 +97,168 @@ async def notify_redis():
 		loop=asyncio.get_event_loop()
 	)
 	await client.start()
-	await client.send("ranking.updatedone")
 
+	path = feed_path(run)
+	if not os.path.exists(path):
+		await client.send("ranking.updatedone")
+		return
 
-def run(loop, pools):
-	runner = RunnerPool(
-		int(os.getenv("PIPE_SIZE", "100")),
-		int(os.getenv("BATCH_SIZE", "100")),
-		*pools
+	# Consumers read the stream to catch up with the runs they missed
+	await client.send(
+		"xadd", "updater:feed", "maxlen", "~", env.feed_keep, "*",
+		"run", run, "path", path
 	)
+	# The ranking module updates its indices from the feed
+	await client.send("ranking.updatedone", path)
+
+
+def open_checkpoint(args):
+	checkpoint = Checkpoint(env.checkpoint)
+
+	if args.restart or not checkpoint.exists:
+		if args.resume:
+			raise SystemExit("there is no run to resume")
+
+		checkpoint.start()
+		logging.debug("starting run {}".format(checkpoint.run))
+
+	else:
+		checkpoint.load()
+
+		if checkpoint.attempts >= MAX_RESUMES and not args.resume:
+			# Something keeps failing, resuming would fail again
+			logging.error(
+				"run {} failed {} resumes, starting over"
+				.format(checkpoint.run, checkpoint.attempts)
+			)
+			checkpoint.start()
+			logging.debug("starting run {}".format(checkpoint.run))
+
+		else:
+			checkpoint.attempts += 1
+			checkpoint.save(force=True)
+			logging.info(
+				"resuming run {} (attempt {})"
+				.format(checkpoint.run, checkpoint.attempts)
+			)
+
+	return checkpoint
+
+
+def schedule(runner, checkpoint, cfm):
+	"""Declares every step of the update job with the tables it reads
+	and writes. Steps run as soon as the tables they read are ready.
+	"""
+	scheduler = Scheduler(POOL_SIZE)
 
 	player = Table("player")
 	tribe = Table("tribe")
 	member = Table("member")
+	tribe_stats = Table("tribe_stats")
+
+	def extract(table):
+		async def step():
+			# Tables that were already published return right away
+			await runner.extract(table)
+
+			if checkpoint.table(table.name).stage != "done":
+				raise RuntimeError(
+					"extraction didn't finish, the next run will resume it"
+				)
+		return step
+
+	for table in (player, tribe, member):
+		scheduler.add(
+			"extract " + table.name, extract(table),
+			outputs=(
+				table.name, table.name + "_new", table.name + "_old",
+				table.name + "_changelog",
+			),
+			# every shard keeps up to 2 connections open in each pool
+			connections=2 * SHARDS + 2
+		)
+
+	scheduler.add(
+		"tribe stats",
+		lambda: update_tribes(player, tribe, member, tribe_stats, cfm),
+		inputs=(
+			"player", "player_new", "player_old",
+			"tribe", "member", "member_new", "member_old",
+		),
+		outputs=(
+			"tribe_stats", "tribe_active", "tribe_stats_old",
+			"tribe_stats_changelog",
+		),
+	)
+
+	scheduler.add(
+		"player log pointers", lambda: write_log_pointers(player, cfm),
+		inputs=("player_changelog",),
+		outputs=("last_log",),
+	)
+	scheduler.add(
+		"tribe log pointers", lambda: write_log_pointers(tribe_stats, cfm),
+		inputs=("tribe_stats_changelog", "last_log"),
+		# the tribe rows of last_log, so player periods don't wait for them
+		outputs=("tribe_last_log",),
+	)
+
+	scheduler.add(
+		"player periods", lambda: write_periods(player, cfm),
+		# a new snapshot store starts from the log pointers
+		inputs=("player", "player_new", "player_old", "last_log"),
+		connections=2
+	)
+	scheduler.add(
+		"tribe periods", lambda: write_periods(tribe_stats, cfm),
+		inputs=(
+			"tribe_stats", "tribe_active", "tribe_stats_old",
+			"tribe_last_log",
+		),
+		connections=2
+	)
+
+	tables = {
+		table.name: table
+		for table in (player, tribe, member, tribe_stats)
+	}
+	scheduler.add(
+		"change feed", lambda: write_feed(tables, cfm, checkpoint.run),
+		inputs=(
+			"player_new", "player_old", "tribe_new", "tribe_old",
+			"member_new", "member_old", "tribe_stats", "tribe_active",
+			"tribe_stats_old",
+		),
+	)
+
+	return scheduler
+
+
+def run(loop, pools, checkpoint, executor):
+	runner = RunnerPool(
+		int(os.getenv("PIPE_SIZE", "100")),
+		BATCH_SIZE,
+		*pools,
+		shards=SHARDS,
+		checkpoint=checkpoint,
+		stage_batches=STAGE_BATCHES,
+		batch_bounds=BATCH_BOUNDS,
+		bulk_tables=BULK_TABLES,
+		fetch_join=FETCH_JOIN,
+		swap_tables=SWAP_TABLES,
+		executor=executor,
+		window=2 * WORKERS
+	)
 
 	logging.debug("start all")
-	loop.run_until_complete(asyncio.wait((
-		runner.extract(player),
-		runner.extract(tribe),
-		runner.extract(member),
-	)))
-	loop.run_until_complete(post_update(player, tribe, member, *pools))
-	loop.run_until_complete(notify_redis())
+	scheduler = schedule(runner, checkpoint, pools[0])
+	if not loop.run_until_complete(scheduler.run()):
+		logging.error("the update didn't finish")
+		return
+
+	checkpoint.finish()
+
+	loop.run_until_complete(notify_redis(checkpoint.run))
 	logging.debug("end all")
 
 
@@ -89,14 +271,38 @@ def stop(loop, pools):
 	loop.run_until_complete(asyncio.wait(tasks))
 
 
+def parse_args():
+	parser = argparse.ArgumentParser(description="Database updater")
+
+	mode = parser.add_mutually_exclusive_group()
+	mode.add_argument(
+		"--resume", action="store_true",
+		help="resume the last run, fail if there is none"
+	)
+	mode.add_argument(
+		"--restart", action="store_true",
+		help="discard the last run, even if it didn't finish"
+	)
+	return parser.parse_args()
+
+
 if __name__ == "__main__":
+	args = parse_args()
 	if uvloop is not None:
 		uvloop.install()
 
 	loop = asyncio.get_event_loop()
 
+	checkpoint = open_checkpoint(args)
+
+	executor = None
+	if WORKERS > 0:
+		executor = ProcessPoolExecutor(WORKERS)
+
 	pools = start(loop)
 	try:
-		run(loop, pools)
+		run(loop, pools, checkpoint, executor)
 	finally:
 		stop(loop, pools)
+		if executor is not None:
+			executor.shutdown()
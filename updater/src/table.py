@@ -1,5 +1,4 @@
 from utils import with_cursors
-from formulas import formulas
 
 
 class Table:
@@ -8,14 +7,26 @@ class Table:
 	columns: list = None
 	is_empty: bool = False
 
-	read_hash: str = None
-	write_hash: str = None
+	# (before, after) disqualified ids, only for player
+	disqualified: tuple = None
+	# [first, last) log ids written to the changelog in this run
+	log_range: tuple = None
 
 	def __init__(self, name):
 		self.name = name
 
+	def record_logs(self, cursor):
+		"""Records the log ids generated by a changelog INSERT. MyISAM
+		assigns consecutive ids to every row of a single INSERT.
+		"""
+		if cursor.rowcount > 0:
+			self.log_range = (
+				cursor.lastrowid,
+				cursor.lastrowid + cursor.rowcount
+			)
+
 	@with_cursors()
-	async def extract_info(self, cursor, database, hashes=True):
+	async def extract_info(self, cursor, database):
 		self.primary = "id"
 		if self.name == "member":
 			self.primary += "_member"  # ugly naming tig...
@@ -33,23 +44,15 @@ class Table:
 		)
 		self.columns = []
 		self.write_columns = []
-		self.composite_scores = []
+		self.score_columns = []
 		for row in await cursor.fetchall():
 			if row[0].startswith("score_"):
-				if self.name == "tribe_stats" or row[0] == "score_overall":
-					# This score is calculated post-download
-					self.composite_scores.append(",1 as `{}`".format(row[0]))
-
-				else:
-					self.composite_scores.append(
-						",{} as `{}`".format(formulas[row[0]], row[0])
-					)
+				# Scores are calculated by us, not fetched
+				self.score_columns.append(row[0])
 			else:
 				self.columns.append(row[0])
 			self.write_columns.append(row[0])
 
-		self.composite_scores = "".join(self.composite_scores)
-
 		# Check if the table is empty
 		await cursor.execute(
 			"SELECT \
@@ -61,15 +64,3 @@ class Table:
 		row = await cursor.fetchone()
 		await cursor.fetchone()  # has to return None so i can execute
 		self.is_empty = row[0] == 0
-
-		if hashes:
-			# Know which tables we are gonna use for hash cache
-			hash_table = "{}_hashes_{{}}".format(self.name)
-			self.read_hash = hash_table.format(0)
-			self.write_hash = hash_table.format(1)
-
-			# Truncate the write hash cache
-			await cursor.execute(
-				"TRUNCATE `{}`"
-				.format(self.write_hash)
-			)
@@ -13,6 +13,17 @@ class env:
 	cfm_pass = os.getenv("DB_PASS", "test")
 	cfm_db = os.getenv("DB", "api_data")
 
+	hash_dir = os.getenv("HASH_DIR", "/hashes")
+	period_dir = os.getenv("PERIOD_DIR", "/periods")
+	feed_dir = os.getenv("FEED_DIR", "/feed")
+	feed_keep = int(os.getenv("FEED_KEEP", "10"))  # feeds of past runs
+	metrics_file = os.getenv("METRICS_FILE")  # log them if not set
+	metrics_interval = float(os.getenv("METRICS_INTERVAL", "30"))
+
+	checkpoint = os.getenv(
+		"CHECKPOINT_FILE", os.path.join(hash_dir, "checkpoint.json")
+	)
+
 	host = os.getenv("INFRA_ADDR", "redis:6379")
 	reconnect = float(os.getenv("INFRA_RECONNECT", "10"))
 
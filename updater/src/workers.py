@@ -0,0 +1,115 @@
+# CPU heavy parts of the pipeline, run in worker processes.
+# Everything here has to be picklable: module level functions that
+# receive plain data, and keep their own state per process.
+import asyncio
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+from scoring import Scorer
+from snapshot import HashSnapshot
+
+
+_snapshots = {}
+_scorers = {}
+
+
+def open_snapshot(path):
+	"""Every worker maps the hashes file on its own, so the page cache
+	is the only copy of it. Maps are kept until the worker exits: a run
+	diffs every table once, and the file is only replaced after that.
+	"""
+	if path not in _snapshots:
+		snapshot = HashSnapshot(path)
+		snapshot.open()
+		_snapshots[path] = snapshot
+	return _snapshots[path]
+
+
+def diff_batch(path, low, high, batch):
+	"""Compares a batch of external (id, hash) rows with the hashes we
+	have for ids in [low, high) (None for no bound).
+
+	Returns the changed ids, the deleted ids, and the ids and hashes of
+	the batch as bytes, to be written to the next snapshot.
+	"""
+	snapshot = open_snapshot(path)
+	ids, hashes = snapshot.ids, snapshot.hashes
+
+	idx = 0 if low is None else bisect_left(ids, low)
+	end = len(ids) if high is None else bisect_left(ids, high)
+
+	changed, deleted = [], []
+	new_ids, new_hashes = array("q"), array("I")
+	for ext_id, new_hash in batch:
+		new_ids.append(ext_id)
+		new_hashes.append(new_hash)
+
+		while idx < end and ids[idx] < ext_id:
+			# We have a row they don't have anymore
+			deleted.append(ids[idx])
+			idx += 1
+
+		if idx < end and ids[idx] == ext_id:
+			# The row is in both databases, check if it changed
+			if hashes[idx] != new_hash:
+				changed.append(ext_id)
+			idx += 1
+
+		else:
+			# They have a row we don't have yet
+			changed.append(ext_id)
+
+	deleted.extend(ids[idx:end])
+	return changed, deleted, new_ids.tobytes(), new_hashes.tobytes()
+
+
+def strip_hashes(batch, primary_idx):
+	"""Splits rows grabbed with their hash in front into the rows and
+	the ids and hashes (as bytes) for the next snapshot.
+	"""
+	rows = []
+	ids, hashes = array("q"), array("I")
+	for row in batch:
+		#                 primary column
+		ids.append(row[primary_idx + 1])
+		hashes.append(row[0])
+		rows.append(row[1:])
+
+	return rows, ids.tobytes(), hashes.tobytes()
+
+
+def score_rows(columns, scores, rows):
+	key = (tuple(columns), tuple(scores))
+	if key not in _scorers:
+		_scorers[key] = Scorer(columns, scores)
+	return _scorers[key].apply(rows)
+
+
+class Window:
+	"""Keeps up to size jobs running in a process pool and hands their
+	results back in the order they were submitted.
+	"""
+
+	def __init__(self, executor, size):
+		self.executor = executor
+		self.size = size
+		self.jobs = deque()
+
+	async def submit(self, func, *args):
+		"""Submits a job. Returns the results that are due: the oldest
+		one if the window is full, or none.
+		"""
+		loop = asyncio.get_event_loop()
+		self.jobs.append(loop.run_in_executor(self.executor, func, *args))
+
+		if len(self.jobs) < self.size:
+			return []
+		return [await self.jobs.popleft()]
+
+	async def drain(self):
+		results = []
+		while self.jobs:
+			results.append(await self.jobs.popleft())
+		return results
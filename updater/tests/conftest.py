@@ -0,0 +1,27 @@
+import os
+import sys
+
+
+here = os.path.dirname(__file__)
+# The updater modules are imported the way start.py imports them, and
+# shared from the repository root
+sys.path.insert(0, os.path.join(here, "..", ".."))
+sys.path.insert(0, os.path.join(here, "..", "src"))
+
+import pytest  # noqa: E402
+
+from snapshot import HashSnapshot, SnapshotWriter  # noqa: E402
+
+
+@pytest.fixture
+def write_snapshot(tmp_path):
+	"""Writes a hashes file of (id, hash) rows and returns it, unopened"""
+	def write(rows, name="player.bin"):
+		path = str(tmp_path / name)
+		writer = SnapshotWriter(path)
+		part = writer.part()
+		for _id, hashed in rows:
+			part.append(_id, hashed)
+		writer.commit()
+		return HashSnapshot(path)
+	return write
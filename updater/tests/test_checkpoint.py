@@ -0,0 +1,154 @@
+import asyncio
+
+from argparse import Namespace
+
+import pytest
+
+import start
+
+from checkpoint import Checkpoint, TableProgress
+from download import RunnerPool
+from table import Table
+from utils import env
+
+
+def test_save_and_load(tmp_path):
+	path = str(tmp_path / "checkpoint.json")
+	checkpoint = Checkpoint(path)
+	checkpoint.start()
+	checkpoint.attempts = 2
+
+	progress = checkpoint.table("player")
+	progress.begin(False, [[None, 100], [100, None]])
+	progress.advance([5, 150, 7])
+	progress.delete(["3", "120"])
+	progress.logs = [10, 20]
+	checkpoint.save(force=True)
+
+	loaded = Checkpoint(path)
+	loaded.load()
+	assert loaded.run == checkpoint.run
+	assert loaded.attempts == 2
+	assert loaded.tables["player"].to_dict() == progress.to_dict()
+
+	loaded.finish()
+	assert not loaded.exists
+
+
+def test_saves_are_throttled(tmp_path):
+	checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"), interval=60)
+	checkpoint.start()
+	checkpoint.attempts = 1
+	checkpoint.save()
+
+	loaded = Checkpoint(checkpoint.path)
+	loaded.load()
+	assert loaded.attempts == 0
+
+
+def test_remaining_shards():
+	progress = TableProgress()
+	progress.begin(False, [[None, 100], [100, 200], [200, None]])
+	assert progress.remaining() == [[None, 100], [100, 200], [200, None]]
+
+	progress.advance([50, 10, 250])
+	assert progress.remaining() == [[51, 100], [100, 200], [251, None]]
+
+	progress = TableProgress()
+	progress.begin(True, [None])
+	progress.advance([3, 8])
+	assert progress.remaining() == [[9, None]]
+
+
+def resumed_runner(tmp_path, checkpoint):
+	"""A runner whose extraction stops at the pipelines, recording the
+	database calls it made.
+	"""
+	runner = RunnerPool(10, 2, None, None, checkpoint=checkpoint)
+	calls = []
+
+	async def delete_rows(table, rows):
+		calls.append(("delete", rows))
+
+	async def run_pipelines(table, shards, snapshot, writer):
+		calls.append(("pipelines", shards))
+		return False
+
+	async def rebuild_snapshot(table):
+		calls.append(("rebuild",))
+
+	runner.delete_rows = delete_rows
+	runner.run_pipelines = run_pipelines
+	runner.rebuild_snapshot = rebuild_snapshot
+	runner.snapshot_path = lambda table: str(tmp_path / "player.bin")
+	return runner, calls
+
+
+def test_resume_deletes_pending_rows_first(tmp_path, write_snapshot):
+	write_snapshot([(1, 1)])
+	checkpoint = Checkpoint()
+	progress = checkpoint.table("player")
+	progress.begin(False, [None])
+	progress.advance([40])
+	progress.delete([3, 7])
+
+	runner, calls = resumed_runner(tmp_path, checkpoint)
+	table = Table("player")
+	table.primary = "id"
+	asyncio.run(runner.extract(table))
+
+	assert calls == [
+		("delete", ["3", "7"]),
+		("pipelines", [[41, None]]),
+	]
+	# The pipelines failed, so the next run resumes from here again
+	assert progress.stage == "extract"
+	assert progress.deleted == [3, 7]
+
+
+def open_checkpoint(monkeypatch, path, **args):
+	monkeypatch.setattr(env, "checkpoint", path)
+	args = Namespace(**dict({"resume": False, "restart": False}, **args))
+	return start.open_checkpoint(args)
+
+
+def failed_run(path, attempts):
+	checkpoint = Checkpoint(path)
+	checkpoint.start()
+	checkpoint.run = "20200101000000"
+	checkpoint.attempts = attempts
+	checkpoint.table("player").begin(False, [None])
+	checkpoint.save(force=True)
+
+
+def test_resumes_failed_runs(tmp_path, monkeypatch):
+	path = str(tmp_path / "checkpoint.json")
+	failed_run(path, start.MAX_RESUMES - 1)
+
+	checkpoint = open_checkpoint(monkeypatch, path)
+	assert checkpoint.run == "20200101000000"
+	assert checkpoint.attempts == start.MAX_RESUMES
+	assert checkpoint.table("player").resumed
+
+
+def test_gives_up_after_max_resumes(tmp_path, monkeypatch):
+	path = str(tmp_path / "checkpoint.json")
+	failed_run(path, start.MAX_RESUMES)
+
+	checkpoint = open_checkpoint(monkeypatch, path)
+	assert checkpoint.run != "20200101000000"
+	assert checkpoint.attempts == 0
+	assert not checkpoint.table("player").resumed
+
+	# unless the run is resumed on purpose
+	failed_run(path, start.MAX_RESUMES)
+	checkpoint = open_checkpoint(monkeypatch, path, resume=True)
+	assert checkpoint.run == "20200101000000"
+	assert checkpoint.attempts == start.MAX_RESUMES + 1
+
+
+def test_resume_without_a_run(tmp_path, monkeypatch):
+	with pytest.raises(SystemExit):
+		open_checkpoint(
+			monkeypatch, str(tmp_path / "checkpoint.json"), resume=True
+		)
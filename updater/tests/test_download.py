@@ -0,0 +1,160 @@
+import asyncio
+
+from array import array
+
+import pytest
+
+from download import RunnerPool
+from snapshot import HashSnapshot, SnapshotWriter
+from table import Table
+
+
+def make_table(name="player"):
+	table = Table(name)
+	table.primary = "id"
+	table.columns = ["id", "name"]
+	table.write_columns = ["id", "name"]
+	table.score_columns = []
+	return table
+
+
+def column_batch(rows):
+	"""A load loop batch: the ids and hashes columns of some rows"""
+	return (
+		array("q", [_id for _id, _ in rows]),
+		array("I", [hashed for _, hashed in rows]),
+	)
+
+
+async def run_filter(runner, table, internal, external, writer):
+	inp, inp2, out = asyncio.Queue(), asyncio.Queue(), asyncio.Queue()
+	for batch in internal:
+		inp.put_nowait(column_batch(batch))
+	inp.put_nowait(None)
+	for batch in external:
+		inp2.put_nowait(batch)
+	inp2.put_nowait(None)
+
+	await runner.filter_loop(
+		table, inp=inp, inp2=inp2, out=out, snapshot=writer.part()
+	)
+
+	batches = []
+	while True:
+		batch = out.get_nowait()
+		if batch is None:
+			return batches
+		batches.append(batch)
+
+
+def filter_rows(tmp_path, internal, external, batch=100):
+	"""Runs the filter loop over the given batches of (id, hash) rows.
+	Returns the batches of ids to fetch, the deleted ids and the
+	snapshot it wrote.
+	"""
+	runner = RunnerPool(10, batch, None, None)
+	deleted = []
+
+	async def delete_rows(table, rows):
+		deleted.extend(map(int, rows))
+	runner.delete_rows = delete_rows
+
+	table = make_table()
+	writer = SnapshotWriter(str(tmp_path / "player.bin"))
+	batches = asyncio.run(
+		run_filter(runner, table, internal, external, writer)
+	)
+	writer.commit()
+
+	# and the deletions are recorded to resume the run
+	assert runner.checkpoint.table(table.name).deleted == deleted
+	return batches, deleted, writer.path
+
+
+def read_rows(path):
+	snapshot = HashSnapshot(path)
+	snapshot.open()
+	rows = list(zip(snapshot.ids, snapshot.hashes))
+	snapshot.close()
+	return rows
+
+
+def test_filter_interleaved_ids(tmp_path):
+	internal = [[(1, 10), (3, 30), (5, 50), (7, 70)]]
+	external = [[(2, 20), (3, 30), (5, 51), (6, 60), (7, 70), (8, 80)]]
+
+	batches, deleted, path = filter_rows(tmp_path, internal, external)
+
+	assert batches == [[2, 5, 6, 8]]
+	assert deleted == [1]
+	assert read_rows(path) == external[0]
+
+
+@pytest.mark.parametrize("internal, external, changed, deleted", [
+	# at both ends of the internal batches
+	(
+		[[(1, 1), (2, 2), (3, 3)], [(4, 4), (5, 5), (6, 6)]],
+		[[(2, 2)], [(5, 5)]],
+		[], [1, 3, 4, 6],
+	),
+	# between external batches, and after the last one
+	(
+		[[(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)]],
+		[[(1, 1)], [(3, 3)], [(4, 40)]],
+		[4], [2, 5],
+	),
+	# external batches ending right before a deleted internal batch
+	(
+		[[(1, 1)], [(2, 2)], [(3, 3)]],
+		[[(1, 1)], [(3, 3)]],
+		[], [2],
+	),
+])
+def test_filter_deletions(tmp_path, internal, external, changed, deleted):
+	batches, found, path = filter_rows(tmp_path, internal, external)
+
+	assert sum(batches, []) == changed
+	assert found == deleted
+	assert read_rows(path) == sum(external, [])
+
+
+@pytest.mark.parametrize("internal, external", [
+	([], [[(1, 1), (2, 2)], [(3, 3)]]),
+	([[(1, 1), (2, 2)], [(3, 3)]], []),
+	([], []),
+])
+def test_filter_empty_sides(tmp_path, internal, external):
+	batches, deleted, path = filter_rows(tmp_path, internal, external)
+
+	external_ids = [_id for batch in external for _id, _ in batch]
+	assert sum(batches, []) == external_ids
+	assert deleted == [_id for batch in internal for _id, _ in batch]
+	assert read_rows(path) == sum(external, [])
+
+
+def test_filter_batches(tmp_path):
+	internal = [[(_id, 0) for _id in range(0, 10, 2)]]
+	external = [[(_id, 1) for _id in range(5)], [(_id, 1) for _id in range(5, 9)]]
+
+	batches, deleted, path = filter_rows(tmp_path, internal, external, batch=3)
+
+	assert batches == [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
+	assert deleted == []
+
+
+def test_failed_pipelines_release_the_snapshot(tmp_path, write_snapshot):
+	# Without database pools, the grab and update loops fail right away
+	# while the load loop has filled its pipe with slices of the map
+	snapshot = write_snapshot([(_id, _id) for _id in range(1000)])
+	snapshot.open()
+	writer = SnapshotWriter(snapshot.path)
+
+	runner = RunnerPool(2, 10, None, None)
+	result = asyncio.run(
+		runner.run_pipelines(make_table(), [None], snapshot, writer)
+	)
+
+	assert result is False
+	assert snapshot.ids is None
+	assert writer.parts == []
+	assert sorted(p.name for p in tmp_path.iterdir()) == ["player.bin"]
@@ -0,0 +1,205 @@
+import random
+
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+import pytest
+
+from formulas import decimal_scores, overall_functions, score_functions
+from scoring import DIV_SCALE, INT_MIN, INT_MAX, Scorer, as_int_column, \
+	as_list
+
+
+STATS = (
+	"round_played", "cheese_gathered", "first", "saved_mice",
+	"shaman_cheese", "saved_mice_hard", "saved_mice_divine",
+	"survivor_survivor_count", "survivor_mouse_killed",
+	"survivor_shaman_count", "survivor_round_played",
+	"racing_first", "racing_podium", "racing_round_played",
+	"racing_finished_map", "defilante_points", "defilante_round_played",
+	"defilante_finished_map",
+)
+SCORES = list(score_functions) + ["score_overall"]
+
+
+class Value:
+	"""A MySQL value: NULL (None), an exact DECIMAL or a DOUBLE. INT
+	columns and literals are exact, POWER returns a DOUBLE, and mixing
+	both gives a DOUBLE.
+	"""
+
+	def __init__(self, value, exact):
+		self.value = value
+		self.exact = exact
+
+	@classmethod
+	def of(cls, value):
+		if isinstance(value, Value):
+			return value
+		# 0.05 in a query is a DECIMAL literal, not a DOUBLE
+		return cls(Decimal(repr(value)), True)
+
+	def _op(self, other, op, reverse=False):
+		a, b = self, Value.of(other)
+		if reverse:
+			a, b = b, a
+		if a.value is None or b.value is None:
+			return Value(None, True)
+		if a.exact and b.exact:
+			return Value(op(a.value, b.value), True)
+		return Value(op(float(a.value), float(b.value)), False)
+
+	def __add__(self, other):
+		return self._op(other, lambda a, b: a + b)
+
+	def __radd__(self, other):
+		return self._op(other, lambda a, b: a + b, True)
+
+	def __mul__(self, other):
+		return self._op(other, lambda a, b: a * b)
+
+	def __rmul__(self, other):
+		return self._op(other, lambda a, b: a * b, True)
+
+	def __truediv__(self, other):
+		return divide(self, Value.of(other))
+
+	def __rtruediv__(self, other):
+		return divide(Value.of(other), self)
+
+
+def divide(a, b):
+	"""Division by 0 is NULL. A DECIMAL division keeps the scale of the
+	dividend plus div_precision_increment, rounded half away from zero.
+	"""
+	if a.value is None or b.value is None or b.value == 0:
+		return Value(None, True)
+	if not (a.exact and b.exact):
+		return Value(float(a.value) / float(b.value), False)
+
+	scale = max(0, -a.value.as_tuple().exponent) + DIV_SCALE
+	quotient = (a.value / b.value).quantize(
+		Decimal(1).scaleb(-scale), rounding=ROUND_HALF_UP
+	)
+	return Value(quotient, True)
+
+
+class mysql_functions:
+	@staticmethod
+	def power(base, exp):
+		base, exp = Value.of(base), Value.of(exp)
+		if base.value is None:
+			return Value(None, False)
+		return Value(float(base.value) ** float(exp.value), False)
+
+	@staticmethod
+	def greatest(a, b):
+		a, b = Value.of(a), Value.of(b)
+		if a.value is None or b.value is None:
+			return Value(None, True)
+		if a.exact and b.exact:
+			return Value(max(a.value, b.value), True)
+		return Value(max(float(a.value), float(b.value)), False)
+
+	@staticmethod
+	def ifnull(value, default):
+		return value if value.value is not None else Value.of(default)
+
+	@staticmethod
+	def decimal(value, scale):
+		return value
+
+	@staticmethod
+	def decimal_div(value, literal):
+		return divide(Value.of(value), Value.of(literal))
+
+
+class mysql_columns:
+	def __init__(self, row):
+		self.row = row
+
+	def __getattr__(self, name):
+		value = self.row[name]
+		return Value(None if value is None else Decimal(value), True)
+
+
+def store_int(value):
+	"""Stores a value in an INT column: a DOUBLE is rounded half to even
+	(rint), a DECIMAL half away from zero, and both are clamped.
+	"""
+	if value.value is None:
+		return None
+	if value.exact:
+		number = int(value.value.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+	else:
+		number = round(value.value)
+	return min(max(number, INT_MIN), INT_MAX)
+
+
+def mysql_scores(row, period):
+	row = dict(zip(("id",) + STATS, row))
+	for name, function in score_functions.items():
+		row[name] = store_int(function(mysql_columns(row), mysql_functions))
+
+	overall = overall_functions[period](mysql_columns(row), mysql_functions)
+	row["score_overall"] = store_int(overall)
+	return tuple(row[name] for name in SCORES)
+
+
+def random_rows(count, seed=801):
+	rand = random.Random(seed)
+	rows = []
+	for _id in range(count):
+		# Plenty of zeros, to divide by 0 now and then
+		rows.append((_id,) + tuple(
+			rand.choice((0, 0, 1, rand.randint(0, 50), rand.randint(0, 10 ** 5)))
+			for _ in STATS
+		))
+	return rows
+
+
+def stats_row(_id, **stats):
+	return (_id,) + tuple(stats.get(column, 0) for column in STATS)
+
+
+@pytest.mark.parametrize("period", ["alltime", "daily"])
+def test_numpy_matches_mysql(period):
+	rows = random_rows(2000)
+	scorer = Scorer(("id",) + STATS, SCORES, period)
+
+	expected = [mysql_scores(row, period) for row in rows]
+	assert scorer.calculate(rows) == expected
+
+
+def test_double_scores_round_half_to_even():
+	# score_stats is a DOUBLE, and these land on .5 exactly
+	rows = [
+		stats_row(1, round_played=2, cheese_gathered=1),  # 0.5
+		stats_row(2, round_played=2, cheese_gathered=3),  # 4.5
+		stats_row(3, round_played=2, cheese_gathered=1, first=1, saved_mice=1),
+	]
+	scorer = Scorer(("id",) + STATS, ["score_stats"])
+
+	assert scorer.calculate(rows) == [(0,), (4,), (2,)]
+	assert [mysql_scores(row, "alltime")[0] for row in rows] == [0, 4, 2]
+
+
+def test_decimal_score_rounds_half_away_from_zero():
+	# 27 / 2723.477 = 0.0099 and 257 / 0.861 = 298.4901, so the DECIMAL
+	# sum is 298.5000, while the floats add up to 298.49999...
+	assert "score_overall" in decimal_scores
+	columns = [
+		"score_stats", "score_shaman", "score_survivor", "score_racing",
+		"score_defilante",
+	]
+	scorer = Scorer(columns, ["score_overall"], "alltime")
+
+	assert scorer.calculate([(27, 0, 0, 257, 0)]) == [(299,)]
+
+
+def test_as_int_column():
+	array = np.array([0.5, 1.5, 2.5, -0.5, -2.5, 2.4, float("inf")])
+	assert as_list(as_int_column(array.copy())) == [0, 2, 2, 0, -2, 2, None]
+	assert as_list(as_int_column(array.copy(), decimal=True)) == \
+		[1, 2, 3, -1, -3, 2, None]
+	assert as_list(as_int_column(np.array([1e12, -1e12]))) == [INT_MAX, INT_MIN]
@@ -0,0 +1,37 @@
+import pytest
+
+from snapshot import HEADER, HashSnapshot
+
+
+def test_round_trip(write_snapshot):
+	snapshot = write_snapshot([(1, 10), (5, 50)])
+
+	assert snapshot.validate() == 2
+	snapshot.open()
+	assert list(snapshot.ids) == [1, 5]
+	assert list(snapshot.hashes) == [10, 50]
+	assert snapshot.bounds((2, None)) == (1, 2)
+	snapshot.close()
+
+
+@pytest.mark.parametrize("corrupt", [
+	lambda data: b"",
+	lambda data: data[:HEADER.size - 1],
+	lambda data: data[:-1],
+	lambda data: b"XXXX" + data[4:],
+])
+def test_corrupt_files(tmp_path, write_snapshot, corrupt):
+	snapshot = write_snapshot([(1, 10), (5, 50)])
+	path = tmp_path / "player.bin"
+	path.write_bytes(corrupt(path.read_bytes()))
+
+	with pytest.raises(ValueError):
+		snapshot.validate()
+	with pytest.raises(ValueError):
+		snapshot.open()
+	assert snapshot.ids is None
+
+
+def test_missing_file(tmp_path):
+	with pytest.raises(OSError):
+		HashSnapshot(str(tmp_path / "player.bin")).validate()
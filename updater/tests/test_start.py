@@ -0,0 +1,20 @@
+from start import schedule
+
+
+def dependencies(scheduler):
+	scheduler.resolve()
+	return {
+		step.name: {dependency.name for dependency in step.depends}
+		for step in scheduler.steps
+	}
+
+
+def test_tribe_periods_wait_for_tribe_log_pointers():
+	depends = dependencies(schedule(None, None, None))
+
+	assert "tribe log pointers" in depends["tribe periods"]
+	assert "player log pointers" in depends["tribe log pointers"]
+	# player periods only read the player rows of last_log
+	assert depends["player periods"] == {
+		"extract player", "player log pointers",
+	}
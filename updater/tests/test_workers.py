@@ -0,0 +1,40 @@
+from array import array
+
+import pytest
+
+from workers import diff_batch
+
+
+@pytest.fixture
+def path(write_snapshot):
+	return write_snapshot([(1, 10), (3, 30), (5, 50), (7, 70), (9, 90)]).path
+
+
+def diff(path, low, high, batch):
+	changed, deleted, ids, hashes = diff_batch(path, low, high, batch)
+	# The batch goes to the next snapshot as bytes
+	return changed, deleted, (
+		array("q", ids).tolist(), array("I", hashes).tolist()
+	)
+
+
+def test_diff_interleaved_ids(path):
+	batch = [(2, 20), (3, 30), (5, 51), (6, 60), (9, 90)]
+
+	changed, deleted, written = diff(path, None, None, batch)
+
+	assert changed == [2, 5, 6]
+	assert deleted == [1, 7]
+	assert written == ([2, 3, 5, 6, 9], [20, 30, 51, 60, 90])
+
+
+def test_diff_bounds(path):
+	# Only ids in [low, high) belong to this batch
+	assert diff(path, 3, 7, [(3, 30)])[:2] == ([], [5])
+	assert diff(path, 7, None, [(8, 80)])[:2] == ([8], [7, 9])
+	assert diff(path, None, 3, [(1, 10)])[:2] == ([], [])
+
+
+def test_diff_empty_sides(path):
+	assert diff(path, None, None, [])[:2] == ([], [1, 3, 5, 7, 9])
+	assert diff(path, 10, None, [(10, 1), (11, 1)])[:2] == ([10, 11], [])